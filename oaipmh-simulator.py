@@ -19,11 +19,22 @@ Copyright 2016 Simeon Warner
 import json
 import logging
 import optparse
+import os.path
 import sys
 
 from oaipmh_simulator._version import __version__
-from oaipmh_simulator.flask_app import get_flask_app, index_handler, oaipmh_baseurl_handler
-from oaipmh_simulator.repository import Repository
+from oaipmh_simulator.admission import AdmissionController
+from oaipmh_simulator.blob_store import BlobStore
+from oaipmh_simulator.crosswalk import DEFAULT_CACHE_SIZE
+from oaipmh_simulator.fast_path import FastPath
+from oaipmh_simulator.flask_app import get_flask_app, index_handler, oaipmh_baseurl_handler, bulk_get_record_handler
+from oaipmh_simulator.prerender import prerender
+from oaipmh_simulator.repository import Repository, load_repositories
+from oaipmh_simulator.scenario import runner_from_cfg
+from oaipmh_simulator.serializer import available_serializers
+from oaipmh_simulator.sharding import shard_cfg, shard_handler, ShardedRepository, start_local_shards
+from oaipmh_simulator.sqlite_storage import SQLiteStorage
+from oaipmh_simulator.validate import ValidationCache
 
 def main():
     """Command line simulator setup."""
@@ -44,8 +55,87 @@ def main():
                  help='path to run at (default %default)')
     p.add_option('--repo-json', '-r', action='store', default='data/repo1.json',
                  help='JSON file describing repository (default %default)')
+    p.add_option('--repo-shards', action='store',
+                 help='glob pattern for JSON files that together describe the '
+                      'repository, loaded in parallel (overrides --repo-json)')
+    p.add_option('--repo-dir', action='store',
+                 help='directory of JSON files each describing a repository, '
+                      'these are all served with repository NAME from NAME.json '
+                      'at path/NAME (overrides --repo-json)')
+    p.add_option('--sqlite', action='store',
+                 help='SQLite database file to hold items and records instead '
+                      'of memory, for large repositories. If the file has not '
+                      'already been loaded then --repo-json or --repo-shards '
+                      'is imported into it')
+    p.add_option('--shard', action='store',
+                 help='serve only shard I of N (given as I/N, numbered from 0) '
+                      'of the --repo-json repository, for a --router')
+    p.add_option('--router', action='store',
+                 help='comma separated baseURLs of the --shard 0/N ... N-1/N '
+                      'nodes, in order, to route requests to instead of '
+                      'serving a repository')
+    p.add_option('--local-shards', action='store', type='int', default=0,
+                 help='start this many local processes each serving a shard of '
+                      'the --repo-json repository and route requests to them')
+    p.add_option('--compress-metadata', action='store_true',
+                 help="hold metadata gzip compressed in memory, and send "
+                      "responses gzip encoded to clients that accept that")
+    p.add_option('--crosswalk-cache', action='store', type='int', default=DEFAULT_CACHE_SIZE,
+                 help='number of crosswalked metadata records kept for each '
+                      'repository (default %default)')
+    p.add_option('--prewarm-crosswalks', action='store_true',
+                 help="crosswalk records in the background on startup, in "
+                      "the order a harvest would request them")
+    p.add_option('--scenario', action='store',
+                 help="apply the time-compressed growth scenario defined in "
+                      "this JSON file to the repository while serving")
+    p.add_option('--validate', action='store_true',
+                 help="check that all metadata and set descriptions are "
+                      "well-formed XML before starting")
+    p.add_option('--validation-cache', action='store',
+                 help="file to cache validation results in so that unchanged "
+                      "fragments are not checked again on restart")
     p.add_option('--no-post', action='store_true',
                  help="do not support POST requests (part of OAI-PMH v2)")
+    p.add_option('--max-in-flight', action='store', type='int', default=0,
+                 help='maximum number of baseURL requests handled at once, '
+                      '0 for no limit (default %default)')
+    p.add_option('--max-queue', action='store', type='int', default=100,
+                 help='maximum number of requests waiting when --max-in-flight '
+                      'requests are being handled (default %default)')
+    p.add_option('--queue-timeout', action='store', type='float', default=5.0,
+                 help='seconds a request may wait in the queue (default %default)')
+    p.add_option('--client-rate', action='store', type='float', default=0,
+                 help='maximum requests per second from each client, '
+                      '0 for no limit (default %default)')
+    p.add_option('--client-burst', action='store', type='int', default=0,
+                 help='burst size allowed above --client-rate (default the rate)')
+    p.add_option('--no-coalesce', action='store_true',
+                 help="compute a response for every request rather than "
+                      "sharing one between identical concurrent requests")
+    p.add_option('--page-size', action='store', type='int', default=100,
+                 help='maximum number of records in each ListRecords or '
+                      'ListIdentifiers response (default %default)')
+    p.add_option('--token-lifetime', action='store', type='int', default=600,
+                 help='seconds a resumptionToken keeps the repository '
+                      'generation it pages through (default %default)')
+    p.add_option('--serializer', action='store', default='stdlib',
+                 choices=available_serializers(),
+                 help='XML serializer for responses, one of %s (default %%default), '
+                      'see python -m oaipmh_simulator.serializer for a benchmark'
+                      % (', '.join(available_serializers())))
+    p.add_option('--fast-path', action='store_true',
+                 help="answer Identify, ListMetadataFormats and GetRecord "
+                      "requests with a lean WSGI application rather than "
+                      "through Flask")
+    p.add_option('--bulk', action='store_true',
+                 help="support non-standard bulk GetRecord requests at "
+                      "<path>/bulk (POST only)")
+    p.add_option('--prerender', action='store',
+                 help="instead of running the server, write all responses to "
+                      "files in this directory along with urlmap.json mapping "
+                      "query strings to files. Only responses that have "
+                      "changed since the last run are written")
     p.add_option('--debug', '-d', action='store_true',
                  help="set debugging mode")
 
@@ -54,20 +144,119 @@ def main():
         p.print_help()
         return
 
+    if (options.validate and (options.router or options.local_shards > 0)):
+        p.error("--validate cannot be used with --router or --local-shards, "
+                "validate the shards instead")
+
+    if (options.scenario and (options.router or options.local_shards > 0 or
+                              options.repo_dir or options.prerender)):
+        p.error("--scenario cannot be used with --router, --local-shards, "
+                "--repo-dir or --prerender")
+
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%dT%H:%M:%S', level=logging.INFO)
 
     app = get_flask_app()
     app.config['no_post'] = options.no_post
     app.config['port'] = options.port
+    app.config['page_size'] = options.page_size
+    app.config['token_lifetime'] = options.token_lifetime
+    app.config['serializer'] = options.serializer
+    app.config['no_coalesce'] = options.no_coalesce
+    if (options.max_in_flight > 0 or options.client_rate > 0):
+        app.config['admission'] = AdmissionController(
+            max_in_flight=options.max_in_flight,
+            max_queue=options.max_queue,
+            queue_timeout=options.queue_timeout,
+            client_rate=options.client_rate,
+            client_burst=options.client_burst )
     app.config['path'] = '/%s' % (options.path) # add leading slash
+    app.config['gzip'] = options.compress_metadata
+    blob_store = BlobStore(compress=options.compress_metadata)
+    shard_processes = []
     app.config['base_url'] = 'http://%s:%d/%s' % (options.host, options.port, options.path)
 
-    with open(options.repo_json, 'r') as fh:
-        app.config['repo'] = Repository( cfg=json.load(fh) )
+    if (options.router or options.local_shards > 0):
+        if (options.router):
+            shard_urls = options.router.split(',')
+        else:
+            with open(options.repo_json, 'r') as fh:
+                cfg = json.load(fh)
+            (shard_processes, shard_urls) = start_local_shards(cfg, options.local_shards,
+                                                         path=app.config['path'])
+            logging.info("Started local shards at %s" % (', '.join(shard_urls)))
+        app.config['repo'] = ShardedRepository( shard_urls )
+        path = app.config['path']
+    elif (options.shard):
+        (index, count) = [int(n) for n in options.shard.split('/')]
+        with open(options.repo_json, 'r') as fh:
+            app.config['repo'] = Repository( cfg=shard_cfg(json.load(fh), index, count),
+                                             blob_store=blob_store )
+        path = app.config['path']
+        app.add_url_rule(path + '/shard', view_func=shard_handler)
+    elif (options.repo_dir):
+        app.config['repos'] = load_repositories(options.repo_dir, blob_store=blob_store)
+        path = app.config['path'] + '/<repo_name>'
+    elif (options.sqlite):
+        storage = SQLiteStorage(options.sqlite)
+        if (storage.load_settings() is not None):
+            app.config['repo'] = Repository( storage=storage )
+        elif (options.repo_shards):
+            app.config['repo'] = Repository( shards=options.repo_shards, storage=storage )
+        else:
+            with open(options.repo_json, 'r') as fh:
+                app.config['repo'] = Repository( cfg=json.load(fh), storage=storage )
+        path = app.config['path']
+    elif (options.repo_shards):
+        app.config['repo'] = Repository( shards=options.repo_shards, blob_store=blob_store )
+        path = app.config['path']
+    else:
+        with open(options.repo_json, 'r') as fh:
+            app.config['repo'] = Repository( cfg=json.load(fh), blob_store=blob_store )
+        path = app.config['path']
+
+    for repo in app.config.get('repos', {'': app.config.get('repo')}).values():
+        if (isinstance(repo, Repository) and len(repo.crosswalks) > 0):
+            repo.crosswalks.memo.size = options.crosswalk_cache
+            if (options.prewarm_crosswalks and not options.prerender):
+                repo.prewarm_crosswalks()
+
+    if (options.validate):
+        cache = ValidationCache(options.validation_cache)
+        repos = app.config.get('repos', {'': app.config.get('repo')})
+        bad = []
+        for name in sorted(repos):
+            for (location, error) in repos[name].validate(cache=cache):
+                bad.append("%s%s: %s" % (name + ' ' if name else '', location, error))
+        cache.save()
+        if (len(bad)>0):
+            sys.exit("Malformed XML fragments:\n" + "\n".join(bad))
+
+    if (options.prerender):
+        if (options.repo_dir):
+            for name in sorted(app.config['repos']):
+                prerender(app, os.path.join(options.prerender, name), repo_name=name)
+        else:
+            prerender(app, options.prerender)
+        return
 
     app.add_url_rule('/', view_func=index_handler)
-    app.add_url_rule(app.config['path'] , methods=("GET","POST"), view_func=oaipmh_baseurl_handler)
-    app.run(host=options.host, port=options.port, debug=options.debug)
+    app.add_url_rule(path, methods=("GET","POST"), view_func=oaipmh_baseurl_handler)
+    if (options.bulk):
+        app.add_url_rule(path + '/bulk', methods=("POST",), view_func=bulk_get_record_handler)
+    if (options.fast_path):
+        app.wsgi_app = FastPath(app)
+    runner = None
+    if (options.scenario):
+        with open(options.scenario, 'r') as fh:
+            runner = runner_from_cfg(app.config['repo'], json.load(fh))
+        runner.start()
+    try:
+        app.run(host=options.host, port=options.port, debug=options.debug)
+    finally:
+        if (runner is not None):
+            runner.stop()
+        for process in shard_processes:
+            process.terminate()
 
 if __name__ == "__main__":
     main()
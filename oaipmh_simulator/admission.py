@@ -0,0 +1,148 @@
+"""Admission control for requests to the OAI-PMH simulator.
+
+Limits the number of requests being handled at once (the in-flight
+cap), holds a bounded number of requests beyond that in a queue for a
+limited time, and limits the rate of requests from each client with
+a token bucket. Requests that are not admitted should get a 503 Service
+Unavailable response with a Retry-After header, which OAI-PMH
+harvesters are expected to honor:
+https://www.openarchives.org/OAI/2.0/guidelines-repository.htm#FlowControl
+"""
+
+import math
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket allowing rate requests/s with bursts of up to burst."""
+
+    def __init__(self, rate, burst, now):
+        """Initialize full bucket at time now."""
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = now
+
+    def refill(self, now):
+        """Add tokens for time elapsed since last refill."""
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, now):
+        """Take a token if there is one, return True if taken."""
+        self.refill(now)
+        if (self.tokens >= 1.0):
+            self.tokens -= 1.0
+            return( True )
+        return( False )
+
+    def wait_time(self):
+        """Seconds until the next token is available after last refill."""
+        return( max(0.0, (1.0 - self.tokens) / self.rate) )
+
+
+class AdmissionController(object):
+    """Global in-flight cap with bounded queue, and per-client rate limits.
+
+    max_in_flight requests (0 for no limit) may be handled at once.
+    When that many are in flight up to max_queue more requests wait up
+    to queue_timeout seconds for a slot. If client_rate is set then
+    each client (identified by address) may make client_rate requests/s
+    with bursts of client_burst. Call admit() before handling a request
+    and, if admitted, release() after.
+    """
+
+    def __init__(self, max_in_flight=0, max_queue=0, queue_timeout=5.0,
+                 client_rate=None, client_burst=None, retry_after=5,
+                 max_clients=10000, clock=time.time):
+        """Initialize AdmissionController."""
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.client_rate = client_rate
+        self.client_burst = client_burst if client_burst else max(1, client_rate or 1)
+        self.retry_after = retry_after
+        self.max_clients = max_clients
+        self.clock = clock
+        self.buckets = {} #index by client
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        # Counters
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    def _take_client_token(self, client):
+        """Take token from client's bucket, return None or seconds to wait.
+
+        Must be called with condition held. Full buckets are equivalent
+        to new ones so they are discarded if there are too many clients.
+        """
+        now = self.clock()
+        bucket = self.buckets.get(client)
+        if (bucket is None):
+            if (len(self.buckets) >= self.max_clients):
+                for (c, b) in list(self.buckets.items()):
+                    b.refill(now)
+                    if (b.tokens >= b.burst):
+                        del self.buckets[c]
+            bucket = TokenBucket(self.client_rate, self.client_burst, now)
+            self.buckets[client] = bucket
+        if (bucket.take(now)):
+            return( None )
+        return( bucket.wait_time() )
+
+    def admit(self, client=None):
+        """Try to admit request from client.
+
+        Returns (True, None) if admitted, or (False, retry_after) where
+        retry_after is the number of seconds the client should wait.
+        """
+        with self.condition:
+            if (self.client_rate):
+                wait = self._take_client_token(client)
+                if (wait is not None):
+                    self.rate_limited += 1
+                    self.rejected += 1
+                    return( (False, max(1, int(math.ceil(wait)))) )
+            if (self.max_in_flight <= 0 or self.in_flight < self.max_in_flight):
+                self.in_flight += 1
+                self.admitted += 1
+                return( (True, None) )
+            if (self.waiting >= self.max_queue):
+                self.rejected += 1
+                return( (False, self.retry_after) )
+            self.waiting += 1
+            self.queued += 1
+            deadline = self.clock() + self.queue_timeout
+            try:
+                while (self.in_flight >= self.max_in_flight):
+                    remaining = deadline - self.clock()
+                    if (remaining <= 0):
+                        self.rejected += 1
+                        return( (False, self.retry_after) )
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            return( (True, None) )
+
+    def release(self):
+        """Release slot of admitted request that has been handled."""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def counters(self):
+        """Dict of counters and current state."""
+        with self.condition:
+            return( {'admitted': self.admitted,
+                     'queued': self.queued,
+                     'rejected': self.rejected,
+                     'rate_limited': self.rate_limited,
+                     'in_flight': self.in_flight,
+                     'waiting': self.waiting} )
@@ -0,0 +1,135 @@
+"""Content-addressed storage of metadata for OAI-PMH simulator."""
+
+from collections import OrderedDict
+import hashlib
+import threading
+import zlib
+
+
+def gzip_member(data, level=6):
+    """Compress bytes data as one complete gzip member.
+
+    Any number of members concatenated is a valid gzip stream which
+    decompresses to the concatenation of their data (RFC 1952).
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # 31 = gzip wrapper
+    return( compressor.compress(data) + compressor.flush() )
+
+
+class CompressedBlob(object):
+    """Blob held as a gzip member, decompressed through a HotCache."""
+
+    __slots__ = ('member', 'cache')
+
+    def __init__(self, blob, cache):
+        """Compress string blob, later decompressions use cache."""
+        self.member = gzip_member(blob.encode('utf-8'))
+        self.cache = cache
+
+    def text(self):
+        """Decompressed string."""
+        return( self.cache.get(self) )
+
+    def decompress(self):
+        """Decompressed string, bypassing the cache."""
+        return( zlib.decompress(self.member, 31).decode('utf-8') )
+
+
+class HotCache(object):
+    """Small LRU cache of decompressed CompressedBlobs."""
+
+    def __init__(self, size=256):
+        """Initialize cache holding at most size strings."""
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, blob):
+        """Decompressed string for CompressedBlob blob."""
+        key = id(blob)
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None and entry[0] is blob):
+                self.entries[key] = self.entries.pop(key) # most recently used
+                self.hits += 1
+                return( entry[1] )
+        text = blob.decompress()
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = (blob, text)
+            if (len(self.entries) > self.size):
+                self.entries.popitem(last=False)
+        return( text )
+
+
+class BlobStore(object):
+    """Content-addressed, deduplicating store for metadata blobs.
+
+    Blobs (XML metadata and set description fragments) are indexed by
+    the SHA-1 digest of their content so that identical blobs loaded
+    by any number of repositories are held in memory only once: add()
+    returns the stored copy which callers should keep in place of the
+    one passed in. Short strings such as set names are shared the same
+    way via share() but indexed by value.
+
+    A single BlobStore may be shared by many Repository objects.
+
+    With compress set, blobs are held compressed as CompressedBlob
+    objects, each a separate gzip member so that a blob can be
+    decompressed, or sent to a client as gzip content, on its own.
+    Decompressed blobs are kept in a HotCache of cache_size.
+    """
+
+    def __init__(self, compress=False, cache_size=256):
+        """Initialize empty BlobStore."""
+        self.blobs = {} #index by digest
+        self.strings = {}
+        self.compress = compress
+        self.cache = HotCache(cache_size) if compress else None
+
+    @staticmethod
+    def key(blob):
+        """Content key (SHA-1 hex digest) for blob."""
+        return( hashlib.sha1(blob.encode('utf-8')).hexdigest() )
+
+    def add(self, blob, key=None):
+        """Add blob to store, return the stored copy.
+
+        None is passed through so that optional values can be
+        added without special handling by the caller. If the content
+        key of blob has already been calculated then it may be passed
+        in as key to avoid calculating it again. If the store
+        compresses, the stored copy is a CompressedBlob.
+        """
+        if (blob is None):
+            return( None )
+        if (key is None):
+            key = self.key(blob)
+        stored = self.blobs.get(key)
+        if (stored is None):
+            stored = CompressedBlob(blob, self.cache) if self.compress else blob
+            stored = self.blobs.setdefault(key, stored)
+        return( stored )
+
+    def get(self, key):
+        """Get blob with content key as a string, None if not present."""
+        return( text(self.blobs.get(key)) )
+
+    def share(self, string):
+        """Share string by value, return the stored copy."""
+        if (string is None):
+            return( None )
+        return( self.strings.setdefault(string, string) )
+
+    def __len__(self):
+        """Number of distinct blobs stored."""
+        return( len(self.blobs) )
+
+
+def text(blob):
+    """String content of blob which may be a CompressedBlob or None."""
+    if (isinstance(blob, CompressedBlob)):
+        return( blob.text() )
+    return( blob )
@@ -0,0 +1,49 @@
+"""Keep-alive HTTP connections for the harvester and the sharding router.
+
+Both make many requests to the same servers, so connections are kept
+open and reused. Only the standard library is needed, on python2 too.
+"""
+
+try: #python3
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit
+    import queue
+except ImportError: #python2
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlsplit
+    import Queue as queue
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP connections to one host."""
+
+    def __init__(self, base_url, size=10, timeout=60):
+        """Initialize pool for connections to host of base_url."""
+        parts = urlsplit(base_url)
+        self.connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+
+    def get(self):
+        """Get an idle connection, or a new one if there are none."""
+        try:
+            return( self.idle.get_nowait() )
+        except queue.Empty:
+            return( self.connection_class(self.netloc, timeout=self.timeout) )
+
+    def put(self, conn):
+        """Return connection to pool, close it if the pool is full."""
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while (True):
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
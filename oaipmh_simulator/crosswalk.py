@@ -0,0 +1,314 @@
+"""Crosswalks to disseminate records in formats derived from other formats.
+
+Fixtures often have metadata in just one rich format. A crosswalk
+makes a record in a target format from the record of an item in a
+source format when it is asked for, so that the item can also be
+disseminated in the target format without the variant being stored.
+Crosswalks are defined in the repository definition under the key
+"crosswalks", indexed by target metadataPrefix:
+
+    "crosswalks": {
+      "oai_dc": {
+        "source": "mods",
+        "namespaces": {"mods": "http://www.loc.gov/mods/v3",
+                       "oai_dc": "http://www.openarchives.org/OAI/2.0/oai_dc/",
+                       "dc": "http://purl.org/dc/elements/1.1/"},
+        "root": "oai_dc:dc",
+        "fields": [["mods:titleInfo/mods:title", "dc:title"],
+                   ["mods:name/mods:namePart", "dc:creator"]]
+      },
+      "summary": {
+        "source": "mods",
+        "transform": "mypackage.transforms:summary"
+      }
+    }
+
+A field mapping crosswalk (FieldCrosswalk) makes an element named root
+with, for each [path, name] pair of fields in order, an element named
+name for each element matching ElementTree path in the source metadata,
+with the text content of that element. Prefixes in paths and names are
+those of namespaces. Otherwise transform names a function, given as
+module:function, that takes the source metadata string and returns the
+target metadata string (TransformCrosswalk).
+
+Crosswalked records have the datestamp and status of their source
+record and so are selected through the same datestamp and set
+selections. The metadata is made when first used and kept in a
+bounded MemoCache keyed by source record and target format, which
+Crosswalks.prewarm() can fill in a background pool of threads.
+"""
+
+from collections import OrderedDict
+import copy
+import importlib
+import logging
+import threading
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+# Number of crosswalked metadata strings kept unless otherwise set
+DEFAULT_CACHE_SIZE = 10000
+
+
+class Crosswalk(object):
+    """Derivation of metadata in target format from metadata in source format."""
+
+    def __init__(self, target, source):
+        """Initialize crosswalk from metadataPrefix source to target."""
+        self.target = target
+        self.source = source
+
+    def transform(self, metadata):
+        """Target metadata string made from source metadata string."""
+        raise NotImplementedError()
+
+
+class FieldCrosswalk(Crosswalk):
+    """Crosswalk by mapping elements of source to fields of target."""
+
+    def __init__(self, target, source, root, fields, namespaces=None):
+        """Initialize field mapping crosswalk, see module description."""
+        super(FieldCrosswalk, self).__init__(target, source)
+        self.root = root
+        self.fields = [tuple(field) for field in fields]
+        self.namespaces = dict(namespaces or {})
+        prefixes = set()
+        for name in [root] + [name for (path, name) in self.fields]:
+            if (':' in name):
+                prefixes.add(name.split(':', 1)[0])
+        declarations = ''.join([' xmlns:%s=%s' % (prefix, quoteattr(self.namespaces[prefix]))
+                                for prefix in sorted(prefixes)])
+        self.start = '<%s%s>' % (root, declarations)
+        self.end = '</%s>' % (root)
+
+    def transform(self, metadata):
+        """Target metadata string made from source metadata string."""
+        try:
+            source = ElementTree.fromstring(metadata)
+        except ElementTree.ParseError as e:
+            logging.getLogger('oaipmh_simulator').warning(
+                "Cannot crosswalk to %s, bad %s metadata: %s" % (self.target, self.source, str(e)))
+            source = ElementTree.Element('empty')
+        parts = [self.start]
+        for (path, name) in self.fields:
+            for element in source.findall(path, self.namespaces):
+                parts.append( '<%s>%s</%s>' % (name, escape(''.join(element.itertext())), name) )
+        parts.append(self.end)
+        return( ''.join(parts) )
+
+
+class TransformCrosswalk(Crosswalk):
+    """Crosswalk with a local function, given as module:function."""
+
+    def __init__(self, target, source, transform):
+        """Initialize crosswalk using function named transform."""
+        super(TransformCrosswalk, self).__init__(target, source)
+        (module, function) = transform.split(':', 1)
+        self.function = getattr(importlib.import_module(module), function)
+
+    def transform(self, metadata):
+        """Target metadata string made from source metadata string."""
+        return( self.function(metadata) )
+
+
+def crosswalk_from_cfg(target, cfg):
+    """Crosswalk to target from its definition cfg, see module description.
+
+    Raises ValueError if the definition is not valid.
+    """
+    try:
+        if ('transform' in cfg):
+            return( TransformCrosswalk(target, cfg['source'], cfg['transform']) )
+        return( FieldCrosswalk(target, cfg['source'], cfg['root'], cfg.get('fields', []),
+                               cfg.get('namespaces')) )
+    except (KeyError, ValueError, ImportError, AttributeError) as e:
+        raise ValueError("Bad crosswalk definition for %s: %s" % (target, str(e)))
+
+
+class MemoCache(object):
+    """Bounded LRU cache of crosswalked metadata.
+
+    Keyed by identifier and target metadataPrefix, an entry is used
+    only while the source metadata it was made from is unchanged.
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        """Initialize cache holding at most size metadata strings."""
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, record, crosswalk):
+        """Metadata of source Record record crosswalked with crosswalk."""
+        key = (record.identifier, crosswalk.target)
+        source = record.metadata
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None and entry[0] == source):
+                self.entries[key] = self.entries.pop(key) # most recently used
+                self.hits += 1
+                return( entry[1] )
+        metadata = crosswalk.transform(source)
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = (source, metadata)
+            while (len(self.entries) > self.size):
+                self.entries.popitem(last=False)
+        return( metadata )
+
+    def __len__(self):
+        """Number of entries."""
+        return( len(self.entries) )
+
+
+class Crosswalks(object):
+    """Crosswalks of a repository, indexed by target metadataPrefix."""
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+        """Initialize with no crosswalks."""
+        self.crosswalks = {}
+        self.memo = MemoCache(cache_size)
+
+    def configure(self, cfg):
+        """Add crosswalks from dict of definitions indexed by target.
+
+        A crosswalk already defined for a target is kept.
+        """
+        for (target, crosswalk_cfg) in (cfg or {}).items():
+            if (target not in self.crosswalks):
+                self.crosswalks[target] = crosswalk_from_cfg(target, crosswalk_cfg)
+
+    def __len__(self):
+        """Number of crosswalks."""
+        return( len(self.crosswalks) )
+
+    def source(self, target):
+        """Source metadataPrefix for target, None if there is no crosswalk."""
+        crosswalk = self.crosswalks.get(target)
+        return( None if crosswalk is None else crosswalk.source )
+
+    def formats(self, metadata_formats):
+        """Sorted metadata_formats with the targets of crosswalks from them."""
+        formats = set(metadata_formats)
+        for crosswalk in self.crosswalks.values():
+            if (crosswalk.source in metadata_formats):
+                formats.add(crosswalk.target)
+        return( sorted(formats) )
+
+    def record(self, item, target):
+        """CrosswalkRecord for item in target, None if there is no crosswalk for it."""
+        crosswalk = self.crosswalks.get(target)
+        if (crosswalk is None or crosswalk.source not in item.records):
+            return( None )
+        return( CrosswalkRecord(item.records[crosswalk.source], crosswalk, self.memo) )
+
+    def item_view(self, item):
+        """Item itself, or a view of it with crosswalked records added.
+
+        The view shares the records and sets of item, it must not be
+        changed or stored.
+        """
+        records = None
+        for target in self.crosswalks:
+            if (target not in item.records):
+                record = self.record(item, target)
+                if (record is not None):
+                    if (records is None):
+                        records = dict(item.records)
+                    records[target] = record
+        if (records is None):
+            return( item )
+        view = copy.copy(item)
+        view.records = records
+        return( view )
+
+    def prewarm(self, records, workers=4):
+        """Crosswalk records in a background pool of workers threads.
+
+        Records are taken in order, up to the size of the memo cache.
+        Returns the executor, call shutdown() on it to wait. On python2
+        this needs the futures backport.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=workers)
+        for (n, record) in enumerate(records):
+            if (n >= self.memo.size):
+                break
+            if (isinstance(record, CrosswalkRecord) and record.source.has_metadata):
+                executor.submit(self.memo.get, record.source, record.crosswalk)
+        return( executor )
+
+
+class CrosswalkRecord(object):
+    """Record in a target format crosswalked from a source Record.
+
+    Has the attributes of Record used for dissemination, the metadata
+    is made through memo when needed.
+    """
+
+    __slots__ = ('source', 'crosswalk', 'memo')
+
+    def __init__(self, source, crosswalk, memo):
+        """Initialize record crosswalked from Record source."""
+        self.source = source
+        self.crosswalk = crosswalk
+        self.memo = memo
+
+    @property
+    def metadataPrefix(self):
+        """Target format."""
+        return( self.crosswalk.target )
+
+    @property
+    def datestamp(self):
+        """Datestamp string of source record."""
+        return( self.source.datestamp )
+
+    @property
+    def ds(self):
+        """Datestamp of source record."""
+        return( self.source.ds )
+
+    @property
+    def status(self):
+        """Status of source record."""
+        return( self.source.status )
+
+    @property
+    def about(self):
+        """About of source record."""
+        return( self.source.about )
+
+    @property
+    def item(self):
+        """Item of source record."""
+        return( self.source.item )
+
+    @property
+    def identifier(self):
+        """Identifier of parent item."""
+        return( self.source.identifier )
+
+    @property
+    def set_specs(self):
+        """The setSpecs for parent item."""
+        return( self.source.set_specs )
+
+    @property
+    def has_metadata(self):
+        """True if the source record has metadata."""
+        return( self.source.has_metadata )
+
+    @property
+    def metadata(self):
+        """Crosswalked metadata, None if the source record has none."""
+        if (not self.source.has_metadata):
+            return( None )
+        return( self.memo.get(self.source, self.crosswalk) )
+
+    @property
+    def metadata_gzip(self):
+        """None, crosswalked metadata is not held compressed."""
+        return( None )
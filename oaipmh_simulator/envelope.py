@@ -0,0 +1,140 @@
+"""Precomputed envelopes of OAI-PMH responses.
+
+Every OAI-PMH response has the same start, the XML declaration, the
+OAI-PMH root element with its namespace declarations, a responseDate
+and a request element echoing the baseURL and request arguments, and
+the same end. An Envelope holds that text split into constant parts
+for a baseURL, verb and set of argument names, so that the start of a
+response is made by joining those parts with the response date and
+the escaped argument values. Envelopes are kept by get_envelope().
+
+As required by the protocol the request element has the verb and the
+arguments as attributes, except in badVerb and badArgument error
+responses where it has none, see
+https://www.openarchives.org/OAI/openarchivesprotocol.html#XMLResponse
+
+The responseDate is the current UTC time in seconds granularity from
+response_date(), which formats it only once a second.
+"""
+
+import threading
+import time
+
+from oaipmh_simulator.serializer import XML_DECLARATION
+
+OAI_PMH_START = ('<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" '
+                 'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                 'xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ '
+                 'http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd">')
+OAI_PMH_END = '</OAI-PMH>'
+
+# Order of argument attributes in the request element, after verb
+ARGUMENT_ORDER = ('identifier', 'metadataPrefix', 'from', 'until', 'set', 'resumptionToken')
+
+# Number of envelopes kept by get_envelope() before starting again
+MAX_ENVELOPES = 1000
+
+
+def escape(text):
+    """Escape text for element content as ElementTree does."""
+    return( text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;') )
+
+
+def escape_attribute(text):
+    """Escape text for a double quoted attribute value as ElementTree does."""
+    text = escape(text).replace('"', '&quot;')
+    if ('\n' in text or '\r' in text or '\t' in text):
+        text = text.replace('\r', '&#13;').replace('\n', '&#10;').replace('\t', '&#09;')
+    return( text )
+
+
+class ResponseDate(object):
+    """Current time as an OAI-PMH responseDate, formatted once a second.
+
+    clock gives the time in seconds since the epoch.
+    """
+
+    def __init__(self, clock=time.time):
+        """Initialize with clock."""
+        self.clock = clock
+        self.last = (None, None)
+
+    def __call__(self):
+        """The responseDate string for now."""
+        second = int(self.clock())
+        last = self.last # replaced not changed, so safe between threads
+        if (last[0] != second):
+            last = (second, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(second)))
+            self.last = last
+        return( last[1] )
+
+response_date = ResponseDate()
+
+
+class Envelope(object):
+    """Start and end of responses to requests with verb and argument names.
+
+    With verb None the request element has no attributes, as for
+    badVerb and badArgument errors.
+    """
+
+    def __init__(self, base_url, verb=None, names=()):
+        """Initialize envelope for requests to base_url.
+
+        names are the names of the arguments other than verb, in
+        ARGUMENT_ORDER, the values of which will be given to start().
+        """
+        self.names = tuple(names)
+        self.head = XML_DECLARATION + OAI_PMH_START + '<responseDate>'
+        request_end = '">' + escape(base_url) + '</request>'
+        if (verb is None):
+            self.parts = ['</responseDate><request>' + escape(base_url) + '</request>']
+        else:
+            parts = ['</responseDate><request verb="' + escape_attribute(verb)]
+            for name in self.names:
+                parts[-1] += '" %s="' % (name)
+                parts.append('')
+            parts[-1] += request_end
+            self.parts = parts
+        self.end = OAI_PMH_END
+
+    def start(self, values=(), date=None):
+        """Start of response, up to the body, for argument values.
+
+        values are in the order of names, date defaults to now.
+        """
+        parts = self.parts
+        out = [self.head, response_date() if date is None else date, parts[0]]
+        for (n, value) in enumerate(values):
+            out.append(escape_attribute(value))
+            out.append(parts[n + 1])
+        return( ''.join(out) )
+
+    def wrap(self, body, values=(), date=None):
+        """Response with body string in this envelope."""
+        return( self.start(values, date) + body + self.end )
+
+
+_envelopes = {}
+_envelopes_lock = threading.Lock()
+
+def get_envelope(base_url, verb=None, arguments=None):
+    """(Envelope, values) for request with verb and dict of arguments to base_url.
+
+    values are the argument values to give to Envelope.start(). The
+    arguments are ignored if verb is None.
+    """
+    names = ()
+    values = ()
+    if (verb is not None and arguments):
+        names = tuple([name for name in ARGUMENT_ORDER if name in arguments])
+        values = [arguments[name] for name in names]
+    key = (base_url, verb, names)
+    envelope = _envelopes.get(key)
+    if (envelope is None):
+        envelope = Envelope(base_url, verb, names)
+        with _envelopes_lock:
+            if (len(_envelopes) >= MAX_ENVELOPES):
+                _envelopes.clear()
+            _envelopes[key] = envelope
+    return( (envelope, values) )
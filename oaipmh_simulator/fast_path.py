@@ -0,0 +1,231 @@
+"""Lean WSGI fast path for the OAI-PMH baseURL.
+
+For small requests such as GetRecord and Identify the cost of Flask
+routing, request argument parsing, response objects and building an
+OAI_PMH_Handler is more than that of the lookup in the Repository.
+FastPath wraps the WSGI application of the Flask app and answers GET
+requests for the baseURL itself: the query string is parsed directly,
+checked against the VERB_ARGUMENTS table used by OAI_PMH_Handler,
+and the response is put together from the same precomputed Envelope
+(XML declaration, root element, responseDate and request) and
+fragments for the records.
+
+Only Identify, ListMetadataFormats and GetRecord responses and error
+responses for any verb are made here, the output is byte for byte
+that of OAI_PMH_Handler. Everything else (the index page, the list
+verbs, POST requests, gzip encoded responses, ...) is passed on to
+Flask unchanged. Fast path requests are subject to admission control
+but are not coalesced, they are cheaper to repeat than to share.
+"""
+
+try: #python3
+    from urllib.parse import parse_qsl
+except ImportError: #python2
+    from urlparse import parse_qsl
+
+from oaipmh_simulator.envelope import get_envelope
+from oaipmh_simulator.flask_app import OAI_PMH_Handler, request_arguments
+from oaipmh_simulator.repository import OAI_PMH_Exception, BadVerb, BadArgument
+
+# Verbs whose responses are made by FastPath
+FAST_VERBS = ('Identify', 'GetRecord', 'ListMetadataFormats')
+
+
+def escape(text):
+    """Escape text for element content as ElementTree does."""
+    if ('&' in text):
+        text = text.replace('&', '&amp;')
+    if ('<' in text):
+        text = text.replace('<', '&lt;')
+    if ('>' in text):
+        text = text.replace('>', '&gt;')
+    return( text )
+
+
+def text_element(tag, text):
+    """Serialized element named tag with content text, '' if text is None."""
+    if (text is None):
+        return( '' )
+    if (text == ''):
+        return( '<%s />' % (tag) )
+    return( '<%s>%s</%s>' % (tag, escape(text), tag) )
+
+
+def parse_query(query_string):
+    """Parse WSGI QUERY_STRING into a dict of the first value of each argument.
+
+    Repeated arguments are thus treated as by the Flask request.args
+    MultiDict that OAI_PMH_Handler.handle() gets.
+    """
+    if (not isinstance(query_string, type(u''))):
+        query_string = query_string.decode('latin-1')
+    # WSGI gives the raw bytes of the query string as latin-1
+    query_string = query_string.encode('latin-1')
+    if (str is not bytes): #python3 parse_qsl decodes %-escapes as UTF-8
+        query_string = query_string.decode('utf-8', 'replace')
+    args = {}
+    for (name, value) in parse_qsl(query_string, keep_blank_values=True):
+        if (str is bytes): #python2 parse_qsl gives bytes for bytes
+            (name, value) = (name.decode('utf-8', 'replace'), value.decode('utf-8', 'replace'))
+        args.setdefault(name, value)
+    return( args )
+
+
+class FastPath(object):
+    """WSGI application answering small OAI-PMH requests without Flask.
+
+    Use by wrapping the WSGI application of the Flask app:
+
+        app.wsgi_app = FastPath(app)
+
+    after the routes have been added. The baseURL is app.config['path']
+    for app.config['repo'] and app.config['path'] followed by the name
+    for each of app.config['repos'].
+    """
+
+    def __init__(self, app, wsgi_app=None):
+        """Initialize for Flask app, passing other requests to wsgi_app.
+
+        wsgi_app defaults to app.wsgi_app.
+        """
+        self.app = app
+        self.wsgi_app = app.wsgi_app if wsgi_app is None else wsgi_app
+        self.bodies = {}  # (repo_name, verb) -> (generation, body)
+
+    def __call__(self, environ, start_response):
+        """Handle WSGI request."""
+        target = None
+        if (environ.get('REQUEST_METHOD') == 'GET' and not self.gzip_wanted(environ)):
+            target = self.target(environ.get('PATH_INFO', ''))
+        if (target is None):
+            return( self.wsgi_app(environ, start_response) )
+        (repo_name, repo) = target
+        args = parse_query(environ.get('QUERY_STRING', ''))
+        verb = args.get('verb')
+        try:
+            arguments = request_arguments(args)
+            if (verb not in FAST_VERBS):
+                return( self.wsgi_app(environ, start_response) )
+        except OAI_PMH_Exception as e:
+            arguments = e
+        controller = self.app.config.get('admission')
+        if (controller is None):
+            data = self.respond(repo_name, repo, verb, arguments)
+        else:
+            (admitted, retry_after) = controller.admit(environ.get('REMOTE_ADDR'))
+            if (not admitted):
+                data = ("Service temporarily unavailable, retry after %d seconds.\n" %
+                        (retry_after)).encode('utf-8')
+                start_response('503 SERVICE UNAVAILABLE',
+                               [('Content-Type', 'text/plain'),
+                                ('Content-Length', str(len(data))),
+                                ('Retry-After', str(retry_after))])
+                return( [data] )
+            try:
+                data = self.respond(repo_name, repo, verb, arguments)
+            finally:
+                controller.release()
+        start_response('200 OK', [('Content-Type', 'application/xml'),
+                                  ('Content-Length', str(len(data)))])
+        return( [data] )
+
+    def gzip_wanted(self, environ):
+        """True if the response could be gzip encoded, left to Flask."""
+        return( bool(self.app.config.get('gzip')) and
+                'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '') )
+
+    def target(self, path):
+        """(repo_name, repo) for the baseURL path, None if path is not one."""
+        config = self.app.config
+        base = config.get('path', '/oai')
+        if (path == base and 'repo' in config):
+            return( (None, config['repo']) )
+        if (path.startswith(base + '/')):
+            repo_name = path[len(base) + 1:]
+            if (repo_name in config.get('repos', {})):
+                return( (repo_name, config['repos'][repo_name]) )
+        return( None )
+
+    def respond(self, repo_name, repo, verb, arguments):
+        """Response data for request, arguments is an exception for an error."""
+        if (isinstance(arguments, OAI_PMH_Exception)):
+            return( self.error(repo_name, verb, None, arguments) )
+        try:
+            if (verb == 'GetRecord'):
+                record = repo.select_record( arguments['identifier'], arguments['metadataPrefix'] )
+                body = self.get_record_body(record)
+            elif (verb == 'ListMetadataFormats' and 'identifier' in arguments):
+                metadata_formats = repo.select_item( arguments['identifier'] ).metadata_formats()
+                body = self.list_metadata_formats_body(metadata_formats)
+            else:
+                body = self.prebuilt(repo_name, repo, verb)
+            return( self.wrap(repo_name, verb, arguments, body) )
+        except OAI_PMH_Exception as e:
+            return( self.error(repo_name, verb, arguments, e) )
+
+    def error(self, repo_name, verb, arguments, e):
+        """Error response data for exception e.
+
+        For badVerb and badArgument errors the request is not echoed.
+        """
+        if (isinstance(e, (BadVerb, BadArgument))):
+            verb = None
+        body = '<error code="%s">%s</error>' % (e.code, escape(str(e)))
+        return( self.wrap(repo_name, verb, arguments, body) )
+
+    def base_url(self, repo_name):
+        """The baseURL for the repository repo_name, as for OAI_PMH_Handler."""
+        base_url = self.app.config['base_url']
+        if (repo_name is not None):
+            base_url += '/' + repo_name
+        return( base_url )
+
+    def wrap(self, repo_name, verb, arguments, body):
+        """Response data for body string in envelope for verb and arguments."""
+        (envelope, values) = get_envelope(self.base_url(repo_name), verb, arguments)
+        return( envelope.wrap(body, values).encode('utf-8') )
+
+    def prebuilt(self, repo_name, repo, verb):
+        """Body of response for request for verb without arguments.
+
+        Made by OAI_PMH_Handler and kept until the repository generation
+        changes.
+        """
+        key = (repo_name, verb)
+        body = self.bodies.get(key)
+        if (body is None or body[0] != repo.generation):
+            generation = repo.generation
+            handler = OAI_PMH_Handler( self.app, repo_name )
+            with self.app.app_context():
+                handler.handle({'verb': verb})
+            body = (generation, handler.substitute(handler.serialize_body()))
+            self.bodies[key] = body
+        return( body[1] )
+
+    def header(self, record):
+        """Serialized <header> for record, as OAI_PMH_Handler.add_header()."""
+        parts = ['<header>', text_element('identifier', record.identifier),
+                 text_element('datestamp', record.datestamp)]
+        for set_spec in record.set_specs:
+            parts.append( text_element('setSpec', set_spec) )
+        parts.append( text_element('status', record.status) )
+        parts.append( '</header>' )
+        return( ''.join(parts) )
+
+    def get_record_body(self, record):
+        """Serialized <GetRecord> for record."""
+        metadata = record.metadata
+        if (metadata is None):
+            return( '<GetRecord>' + self.header(record) + '</GetRecord>' )
+        return( '<GetRecord>' + self.header(record) + '<metadata>' + metadata +
+                '</metadata></GetRecord>' )
+
+    def list_metadata_formats_body(self, metadata_formats):
+        """Serialized <ListMetadataFormats> for metadata_formats."""
+        if (len(metadata_formats) == 0):
+            return( '<ListMetadataFormats />' )
+        parts = ['<ListMetadataFormats>']
+        for m in metadata_formats:
+            parts.append( '<metadataFormat>' + text_element('metadataPrefix', m) + '</metadataFormat>' )
+        parts.append( '</ListMetadataFormats>' )
+        return( ''.join(parts) )
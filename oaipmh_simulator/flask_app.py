@@ -1,87 +1,208 @@
 """Flask application to implement simulator."""
 
-from flask import Flask, request, render_template, flash, session, redirect, url_for, logging, make_response
+from flask import Flask, request, render_template, flash, session, redirect, url_for, logging, make_response, Response, stream_with_context, abort
 import json
 import logging
 import optparse
 import os.path
 import re
 import sys
-from xml.etree.ElementTree import ElementTree, Element, SubElement
-try: #python2, must try this first as a different io exists in python2
-    import StringIO as io
-except ImportError: #python3
-    import io
+try: #python3
+    from urllib.parse import urlencode, parse_qsl
+except ImportError: #python2
+    from urllib import urlencode
+    from urlparse import parse_qsl
 
 from oaipmh_simulator._version import __version__
-from oaipmh_simulator.repository import Repository, OAI_PMH_Exception, BadVerb, BadArgument, BadResumptionToken, sanitize
+from oaipmh_simulator.blob_store import gzip_member
+from oaipmh_simulator.envelope import get_envelope, response_date
+from oaipmh_simulator.serializer import SubElement, get_serializer
+from oaipmh_simulator.single_flight import SingleFlight
+from oaipmh_simulator.repository import Repository, Datestamp, OAI_PMH_Exception, BadVerb, BadArgument, BadResumptionToken, CannotDisseminateFormat, IdDoesNotExist, NoRecordsMatch, sanitize
 
 app = Flask(__name__)
 
+# Coalescing of identical concurrent baseURL requests
+single_flight = SingleFlight()
+
+# Number of records in each ListRecords or ListIdentifiers response
+# unless app.config['page_size'] is set
+DEFAULT_PAGE_SIZE = 100
+
+# Markers for XML chunks to be inserted into serialized responses
+SUB_MARKER = "#-#-#-#-#--SUB--%d--#-#-#-#-#"
+SUB_REGEX = re.compile(r"#-#-#-#-#--SUB--\d+--#-#-#-#-#")
+
+# Seconds a resumptionToken keeps the repository generation it pages
+# through unless app.config['token_lifetime'] is set, None for tokens
+# that keep no generation and do not expire
+DEFAULT_TOKEN_LIFETIME = 600
+
 def get_flask_app():
     """Get app object."""
     return(app) # FIXME - make this actually create app
 
 def index_handler():
     """Render index page for server."""
+    base_urls = []
+    if ('repo' in app.config):
+        base_urls.append(app.config['base_url'])
+    for name in sorted(app.config.get('repos', {})):
+        base_urls.append(app.config['base_url'] + '/' + name)
+    admission = None
+    if (app.config.get('admission') is not None):
+        admission = app.config['admission'].counters()
     return render_template('index.html',
-                           base_url=app.config['base_url'])
+                           base_urls=base_urls,
+                           admission=admission)
+
+def oaipmh_baseurl_handler(repo_name=None):
+    """Support requests for OAI-PMH baseURL, subject to admission control.
+
+    If app.config['admission'] is an AdmissionController then requests
+    it does not admit get a 503 response with Retry-After, see
+    oaipmh_request_handler() for the rest.
+    """
+    controller = app.config.get('admission')
+    if (controller is None):
+        return( oaipmh_request_handler(repo_name) )
+    (admitted, retry_after) = controller.admit(request.remote_addr)
+    if (not admitted):
+        response = make_response( "Service temporarily unavailable, retry after %d seconds.\n" % (retry_after), 503 )
+        response.headers['Retry-After'] = str(retry_after)
+        response.headers['Content-type'] = 'text/plain'
+        return( response )
+    try:
+        return( oaipmh_request_handler(repo_name) )
+    finally:
+        controller.release()
 
-def oaipmh_baseurl_handler():
-    """Support requests for OAI-PMH baseURL."""
+def oaipmh_request_handler(repo_name=None):
+    """Handle request for OAI-PMH baseURL.
+
+    If repo_name is given then the request is for that one of the
+    repositories mounted under the path, else for the single repository.
+
+    Unless app.config['no_coalesce'] is set, identical concurrent
+    requests (same repository, repository generation, arguments and
+    encoding) are coalesced so that only one response is computed.
+
+    If app.config['gzip'] is set and the client accepts gzip then the
+    response is gzip encoded, see OAI_PMH_Handler.make_xml_response().
+    """
     if (request.method == 'GET'):
         args = request.args
     elif (app.config['no_post']):
-        alert(405) # Method Not Allowed
+        abort(405) # Method Not Allowed
     else:
         args = request.form
-    handler = OAI_PMH_Handler( app )
+    handler = OAI_PMH_Handler( app, repo_name )
+    handler.gzip = bool(app.config.get('gzip') and request.accept_encodings['gzip'] > 0)
+    if (app.config.get('no_coalesce')):
+        return( handler.handle(args) )
+    key = (repo_name, handler.repo.generation, handler.gzip, tuple(sorted(args.items(multi=True))))
+    (data, status, headers) = single_flight.do(key, lambda: response_parts(handler.handle(args)))
+    return( Response(data, status=status, headers=headers) )
+
+def response_parts(response):
+    """Data, status code and headers of Flask response, these can be shared."""
+    return( (response.get_data(), response.status_code, list(response.headers)) )
+
+def bulk_get_record_handler(repo_name=None):
+    """Support non-standard bulk GetRecord requests next to the baseURL.
+
+    Takes metadataPrefix as a query or form parameter and a list of
+    identifiers, one per line, either as an uploaded file named
+    identifiers, as a form parameter identifiers, or as the raw body
+    of the POST request. The response is streamed.
+    """
+    handler = OAI_PMH_Handler( app, repo_name )
     try:
-        # Now get the params
-        verb = args.get('verb')
-        if (verb is None):
-            raise BadVerb(verb=verb)
-        arguments = {}
-        for arg in ['identifier','metadataPrefix','from',
-                    'until','set','resumptionToken']:
-            if (arg in args):
-                arguments[arg] = args.get(arg)
-        if (len(arguments)+1 != len(args)):
-            raise BadArgument("Extra illegal arguments given.")
-        # What to do?
-        if (verb == 'Identify'):
-            handler.check_args( verb, arguments )
-            return handler.identify()
-        elif (verb == 'GetRecord'):
-            handler.check_args( verb, arguments,
-                                required=['identifier', 'metadataPrefix'] )
-            return handler.get_record( **arguments )
-        elif (verb == 'ListIdentifiers'):
-            handler.check_args( verb, arguments,
-                                optional=['from','until','set'],
-                                required=['metadataPrefix'],
-                                exclusive='resumptionToken' )
-            return handler.list_either( False, **arguments )
-        elif (verb == 'ListRecords'):
-            handler.check_args( verb, arguments,
-                                optional=['from','until','set'],
-                                required=['metadataPrefix'],
-                                exclusive='resumptionToken' )
-            return handler.list_either( True, **arguments )
-        elif (verb == 'ListMetadataFormats'):
-            handler.check_args( verb, arguments,
-                                optional=['identifier'] )
-            return handler.list_metadata_formats( **arguments )
-        elif (verb == 'ListSets'):
-            handler.check_args( verb, arguments, 
-                                exclusive='resumptionToken' )
-            return handler.list_sets( **arguments )
+        metadataPrefix = request.values.get('metadataPrefix')
+        if (metadataPrefix is None):
+            raise BadArgument("Arguments (metadataPrefix) required but missing in BulkGetRecord request")
+        if ('identifiers' in request.files):
+            # Read now, the upload is closed before the response is streamed
+            identifiers = request.files['identifiers'].read().decode('utf-8').splitlines()
+        elif ('identifiers' in request.form):
+            identifiers = request.form['identifiers'].splitlines()
         else:
-            bad_verb=verb
-            verb=None
-            raise BadVerb(verb=bad_verb)
+            identifiers = request.get_data(as_text=True).splitlines()
     except OAI_PMH_Exception as e:
-        return( handler.error(e, verb) )
+        return( handler.error(e, 'BulkGetRecord') )
+    xml = handler.bulk_get_record( identifiers, metadataPrefix )
+    return Response( stream_with_context(xml), mimetype='application/xml' )
+
+
+def make_resumption_token(select_args, offset, last_record, generation=None):
+    """Make resumptionToken for records after last_record in selection select_args.
+
+    Tokens are stateless, the selection arguments, the offset of the
+    next record and the datestamp and identifier of last_record (see
+    Repository.select_records()) are simply encoded in the token, along
+    with the repository generation the selection was made in if any.
+    """
+    after = [('offset', str(offset)),
+             ('afterDatestamp', last_record.ds.datetime.strftime('%Y-%m-%dT%H:%M:%SZ')),
+             ('afterIdentifier', last_record.identifier)]
+    if (generation is not None):
+        after.append( ('generation', str(generation)) )
+    return( urlencode(sorted(select_args.items()) + after) )
+
+def parse_resumption_token(token):
+    """Parse resumptionToken made by make_resumption_token().
+
+    Returns (select_args, offset, after, generation) where generation
+    is None if the token has none. Will raise BadResumptionToken if the
+    token is not valid.
+    """
+    try:
+        select_args = dict(parse_qsl(token, keep_blank_values=True, strict_parsing=True))
+        offset = int(select_args.pop('offset'))
+        after = (Datestamp(select_args.pop('afterDatestamp'), 'seconds').datetime,
+                 select_args.pop('afterIdentifier'))
+        generation = select_args.pop('generation', None)
+        if (generation is not None):
+            generation = int(generation)
+    except (ValueError, KeyError, BadArgument):
+        raise BadResumptionToken(token)
+    if (offset < 0 or 'metadataPrefix' not in select_args or
+        set(select_args) - set(['metadataPrefix','from','until','set'])):
+        raise BadResumptionToken(token)
+    return( (select_args, offset, after, generation) )
+
+
+# Arguments allowed for each verb as (optional, required, exclusive),
+# see OAI_PMH_Handler.check_args()
+VERB_ARGUMENTS = {
+    'Identify': ([], [], None),
+    'GetRecord': ([], ['identifier', 'metadataPrefix'], None),
+    'ListIdentifiers': (['from', 'until', 'set'], ['metadataPrefix'], 'resumptionToken'),
+    'ListRecords': (['from', 'until', 'set'], ['metadataPrefix'], 'resumptionToken'),
+    'ListMetadataFormats': (['identifier'], [], None),
+    'ListSets': ([], [], 'resumptionToken') }
+
+def request_arguments(args):
+    """Check OAI-PMH request args, return dict of the arguments other than verb.
+
+    args is a dict-like object of the request arguments, including verb.
+    Will raise BadVerb if the verb is missing or not an OAI-PMH verb,
+    BadArgument if the arguments are not allowed for the verb.
+    """
+    verb = args.get('verb')
+    if (verb is None):
+        raise BadVerb(verb=verb)
+    arguments = {}
+    for arg in ['identifier','metadataPrefix','from',
+                'until','set','resumptionToken']:
+        if (arg in args):
+            arguments[arg] = args.get(arg)
+    if (len(arguments)+1 != len(args)):
+        raise BadArgument("Extra illegal arguments given.")
+    if (verb not in VERB_ARGUMENTS):
+        raise BadVerb(verb=verb)
+    OAI_PMH_Handler.check_args( verb, arguments, *VERB_ARGUMENTS[verb] )
+    return( arguments )
 
 
 def TextSubElement( parent, tag, text=None ):
@@ -94,40 +215,113 @@ def TextSubElement( parent, tag, text=None ):
 class OAI_PMH_Handler(object):
     """Class to handle request against OAI-PMH baseURL in a Flask app."""
 
-    def __init__(self, app=None ):
-        """Initialize OAI-PMH baseURL handler."""
+    def __init__(self, app=None, repo_name=None ):
+        """Initialize OAI-PMH baseURL handler.
+
+        With repo_name set, handle requests for that one of the
+        repositories in app.config['repos'] (which is mounted under
+        the path of the baseURL) instead of the single app.config['repo'].
+        Will abort with 404 if there is no such repository.
+        """
         self.app = app
-        self.repo = app.config['repo'] if app else None
+        self.repo_name = repo_name
+        if (app is None):
+            self.repo = None
+        elif (repo_name is None):
+            self.repo = app.config['repo']
+        elif (repo_name in app.config.get('repos', {})):
+            self.repo = app.config['repos'][repo_name]
+        else:
+            abort(404)
+        self.serializer = get_serializer(None if app is None else app.config.get('serializer'))
+        # Arguments other than verb of the request, echoed in the envelope
+        self.arguments = {}
+        self.envelope = None
+        self.envelope_values = ()
+        # Taken before anything is selected from the repository, so that
+        # a harvest from this responseDate sees all later changes
+        self.response_date = response_date()
         self.root = None
         # Record substitutions we need to make in XML output
         self.sub_num = 0
         self.subs = {}
+        # With gzip set, responses are gzip encoded and metadata held
+        # compressed is spliced in as gzip members
+        self.gzip = False
+        self.member_subs = {}
+
+    def handle(self, args):
+        """Handle OAI-PMH request with args, return Flask Response.
+
+        args is a dict-like object of the request arguments, including
+        verb. Errors are reported in an OAI-PMH error response.
+        """
+        verb = None
+        try:
+            verb = args.get('verb')
+            arguments = request_arguments(args)
+            self.arguments = arguments
+            # What to do?
+            if (verb == 'Identify'):
+                return self.identify()
+            elif (verb == 'GetRecord'):
+                return self.get_record( **arguments )
+            elif (verb == 'ListIdentifiers'):
+                return self.list_either( False, **arguments )
+            elif (verb == 'ListRecords'):
+                return self.list_either( True, **arguments )
+            elif (verb == 'ListMetadataFormats'):
+                return self.list_metadata_formats( **arguments )
+            else: # 'ListSets'
+                return self.list_sets( **arguments )
+        except OAI_PMH_Exception as e:
+            return( self.error(e, verb) )
 
     def sub(self, xml):
         """Set up substitution of xml, return match string to insert."""
         self.sub_num += 1
-        match = "#-#-#-#-#--SUB--%d--#-#-#-#-#" % (self.sub_num)
+        match = SUB_MARKER % (self.sub_num)
         self.subs[match] = xml
         return( match )
 
-    def base_tree(self, verb):
-        """Create start of XML tree for OAI-PMH response.
+    def sub_member(self, member):
+        """Set up substitution of gzip member, return match string to insert."""
+        self.sub_num += 1
+        match = SUB_MARKER % (self.sub_num)
+        self.member_subs[match] = member
+        return( match )
 
-        This format applies to all OAI-PMH responses. Note that although
-        OAI-PMH responses are XML, there are a number of rather more specific
-        stipulations about namespaces that _MUST_ be used and such. See:
-        https://www.openarchives.org/OAI/openarchivesprotocol.html#XMLResponse
-        """
+    @property
+    def page_size(self):
+        """Maximum number of records in a list response."""
+        return( self.app.config.get('page_size', DEFAULT_PAGE_SIZE) )
+
+    @property
+    def token_lifetime(self):
+        """Seconds a resumptionToken keeps its repository generation, or None."""
+        return( self.app.config.get('token_lifetime', DEFAULT_TOKEN_LIFETIME) )
+
+    @property
+    def base_url(self):
+        """The baseURL for the repository this handler is for."""
         base_url = self.app.config['base_url']
-        root = Element('OAI-PMH',
-                       {'xmlns': 'http://www.openarchives.org/OAI/2.0/',
-                        'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-                        'xsi:schemaLocation': 'http://www.openarchives.org/OAI/2.0/ http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd'
-                        } )
-        TextSubElement( root, 'responseDate', '2002-02-08T12:00:01Z')
-        req = SubElement( root, 'request', {} if verb is None else {'verb': verb} )
-        req.text = base_url
-        self.root = root
+        if (self.repo_name is not None):
+            base_url += '/' + self.repo_name
+        return( base_url )
+
+    def base_tree(self, verb):
+        """Start OAI-PMH response for verb.
+
+        The part common to all OAI-PMH responses, with the namespaces
+        that _MUST_ be used and such, is the precomputed Envelope for
+        verb and the request arguments, see oaipmh_simulator.envelope
+        and https://www.openarchives.org/OAI/openarchivesprotocol.html#XMLResponse
+        With verb None the request element has no attributes. root is
+        set to an OAI-PMH element for the body of the response, only
+        the elements added under it are serialized.
+        """
+        (self.envelope, self.envelope_values) = get_envelope(self.base_url, verb, self.arguments)
+        self.root = self.serializer.Element('OAI-PMH')
 
     def add_header(self, parent, record):
         """Add OAI-PMH <header> block under parent in XML."""
@@ -144,29 +338,76 @@ class OAI_PMH_Handler(object):
 
         Support both inclusion of XML defined by the structured
         data in record.metadataow can we include some XML in here?
+        Nothing is added for a record without metadata, such as a
+        deleted record.
         """
-        TextSubElement( parent, 'metadata', self.sub(record.metadata) )
+        if (self.gzip and record.metadata_gzip is not None):
+            TextSubElement( parent, 'metadata', self.sub_member(record.metadata_gzip) )
+        else:
+            metadata = record.metadata
+            if (metadata is not None):
+                TextSubElement( parent, 'metadata', self.sub(metadata) )
 
     def serialize_tree(self):
-        """Serialize XML tree from root."""
-        tree = ElementTree(self.root);
-        xml_buf=io.StringIO()
-        if (sys.version_info < (2,7)):
-            tree.write(xml_buf,encoding='UTF-8')
-        elif (sys.version_info < (3,0)):
-            tree.write(xml_buf,encoding='UTF-8',xml_declaration=True,method='xml')
-        else:
-            tree.write(xml_buf,encoding="unicode",xml_declaration=True,method='xml')
-        xml = xml_buf.getvalue()
-        # Now if we have XML chunks to indert for the records, do that
-        # by string sustitution...
-        for match in self.subs:
-            xml = re.sub(match, self.subs[match], xml)
+        """Serialize response, the body under root in its envelope."""
+        return( self.envelope.start(self.envelope_values, self.response_date) +
+                self.substitute(self.serialize_body()) + self.envelope.end )
+
+    def serialize_body(self):
+        """Serialize the elements under root, without substitutions."""
+        return( ''.join([self.serializer.serialize_fragment(element) for element in self.root]) )
+
+    def serialize_fragment(self, element):
+        """Serialize element without XML declaration.
+
+        Substitutions are made as for serialize_tree() and then
+        discarded so that they don't accumulate when many fragments
+        are serialized by one handler.
+        """
+        xml = self.substitute(self.serializer.serialize_fragment(element))
+        self.subs = {}
         return(xml)
 
+    def substitute(self, xml):
+        """Insert the XML chunks set up with sub() into serialized xml."""
+        if (len(self.subs) == 0):
+            return(xml)
+        return( SUB_REGEX.sub(lambda m: self.subs[m.group(0)], xml) )
+
+    def serialize_gzip(self):
+        """Serialize XML tree from root as gzip encoded bytes.
+
+        Text between the gzip members set up with sub_member() is
+        compressed into members of its own, so that the response is a
+        series of gzip members and compressed metadata is never
+        decompressed.
+        """
+        xml = self.serialize_body()
+        parts = []
+        pending = [self.envelope.start(self.envelope_values, self.response_date)]
+        pos = 0
+        for m in SUB_REGEX.finditer(xml):
+            pending.append(xml[pos:m.start()])
+            pos = m.end()
+            if (m.group(0) in self.member_subs):
+                parts.append(gzip_member(''.join(pending).encode('utf-8')))
+                parts.append(self.member_subs[m.group(0)])
+                pending = []
+            else:
+                pending.append(self.subs[m.group(0)])
+        pending.append(xml[pos:])
+        pending.append(self.envelope.end)
+        parts.append(gzip_member(''.join(pending).encode('utf-8')))
+        return( b''.join(parts) )
+
     def make_xml_response(self):
-        """Make Flask Response for XML tree."""
-        response = make_response( self.serialize_tree() )
+        """Make Flask Response for XML tree, gzip encoded if gzip is set."""
+        if (self.gzip):
+            response = make_response( self.serialize_gzip() )
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+        else:
+            response = make_response( self.serialize_tree() )
         response.headers['Content-type'] = 'application/xml'
         return( response )
 
@@ -179,7 +420,7 @@ class OAI_PMH_Handler(object):
         self.base_tree(verb='Identify')
         resp = SubElement( self.root, 'Identify' )
         TextSubElement( resp, 'repositoryName', repo.repository_name )
-        TextSubElement( resp, 'baseURL', app.config['base_url'] )
+        TextSubElement( resp, 'baseURL', self.base_url )
         TextSubElement( resp, 'protocolVersion', repo.protocol_version )
         for ae in repo.admin_email:
             TextSubElement( resp, 'adminEmail', ae )
@@ -201,20 +442,99 @@ class OAI_PMH_Handler(object):
         self.add_metadata( resp, record )
         return self.make_xml_response()
 
+    def bulk_get_record(self, identifiers, metadataPrefix):
+        """Make streamed bulk GetRecord response, a non-standard extension.
+
+        Generator yielding the XML response in chunks. Each record is
+        rendered as for GetRecord and wrapped in a <record> element.
+        Each identifier that cannot be disseminated in metadataPrefix
+        is instead reported with an <error> element that has the
+        OAI-PMH error code and the identifier as attributes. Blank
+        identifiers are ignored.
+        """
+        repo = self.repo
+        marker = "#-#-#-#-#--BULK--#-#-#-#-#"
+        self.base_tree( verb='BulkGetRecord' )
+        resp = SubElement( self.root, 'BulkGetRecord' )
+        resp.text = marker
+        (head, tail) = self.serialize_tree().split(marker)
+        yield head
+        for identifier in identifiers:
+            identifier = identifier.strip()
+            if (identifier == ''):
+                continue
+            try:
+                record = repo.select_record( identifier, metadataPrefix )
+                element = self.serializer.Element( 'record' )
+                self.add_header( element, record )
+                if (record.has_metadata):
+                    self.add_metadata( element, record )
+            except (IdDoesNotExist, CannotDisseminateFormat) as e:
+                element = self.serializer.Element( 'error', {'code': e.code,
+                                             'identifier': identifier} )
+                element.text = str(e)
+            yield self.serialize_fragment(element)
+        yield tail
+
     def list_either(self, include_records=True, resumptionToken=None, **select_args):
-        """Make ListRecords or ListIdentifiers response."""
+        """Make ListRecords or ListIdentifiers response.
+
+        https://www.openarchives.org/OAI/openarchivesprotocol.html#ListRecords
+        https://www.openarchives.org/OAI/openarchivesprotocol.html#ListIdentifiers
+
+        Responses include at most page_size records, with a
+        resumptionToken to get the next page if there are more. The
+        token pins the repository generation the first page was
+        selected from, so that later pages come from the same
+        generation even if the repository changes, until the token
+        expires after token_lifetime seconds. With token_lifetime None
+        tokens have no generation and no expirationDate.
+        """
         repo = self.repo
+        verb = 'ListRecords' if include_records else 'ListIdentifiers'
+        offset = 0
+        after = None
+        expires = None
         if (resumptionToken is not None):
-            raise BadResumptionToken() # don't support yet
+            (select_args, offset, after, generation) = parse_resumption_token(resumptionToken)
+            if (generation is not None and not repo.has_generation(generation)):
+                raise BadResumptionToken(resumptionToken)
+        elif (self.token_lifetime is not None):
+            # Pin before selecting, else a change and gc() could drop
+            # the generation before the token for the next page pins it
+            (generation, expires) = repo.pin_current_generation(self.token_lifetime)
         else:
-            records = repo.select_records(**select_args)
-            self.base_tree( verb='ListIdentifiers' )
-            resp = SubElement( self.root, 'ListIdentifiers' )
-            for record in records:
-                self.add_header( resp, record )
-                if (include_records):
-                    self.add_metadata( resp, record )
-            return self.make_xml_response()
+            generation = repo.current_generation()
+        # Get one extra record to see whether there are more
+        records = list(repo.select_records(after=after, limit=self.page_size+1,
+                                           generation=generation, **select_args))
+        if (len(records) == 0):
+            if (resumptionToken is not None):
+                raise BadResumptionToken(resumptionToken)
+            raise NoRecordsMatch()
+        more = (len(records) > self.page_size)
+        records = records[:self.page_size]
+        self.base_tree( verb=verb )
+        resp = SubElement( self.root, verb )
+        for record in records:
+            parent = SubElement( resp, 'record' ) if include_records else resp
+            self.add_header( parent, record )
+            if (include_records and record.has_metadata):
+                self.add_metadata( parent, record )
+        if (offset > 0 or more):
+            # Empty resumptionToken element on last page of incomplete list
+            token = SubElement( resp, 'resumptionToken',
+                                {'cursor': str(offset)} )
+            if (more):
+                if (expires is None and generation is not None and self.token_lifetime is not None):
+                    expires = repo.pin_generation(generation, self.token_lifetime)
+                if (expires is None):
+                    generation = None
+                else:
+                    token.set('expirationDate', expires.strftime('%Y-%m-%dT%H:%M:%SZ'))
+                token.text = make_resumption_token(select_args, offset+len(records),
+                                                   records[-1], generation)
+        return self.make_xml_response()
 
     def list_metadata_formats(self, identifier=None):
         """Make ListMetadataFormats response.
@@ -257,7 +577,8 @@ class OAI_PMH_Handler(object):
                                 self.sub(description) )
         return self.make_xml_response()
 
-    def check_args(self, verb, arguments, optional=None, required=None, exclusive=None):
+    @staticmethod
+    def check_args(verb, arguments, optional=None, required=None, exclusive=None):
         """Check that only arguments allowed are not others are present.
 
         Will raise BadArgument exception if errors present.
@@ -288,7 +609,12 @@ class OAI_PMH_Handler(object):
             raise BadArgument("Arguments (%s) required but missing in %s request" % (','.join(sorted(missing)),verb))
 
     def error(self, e, verb ):
-        """Generate OAI-PMH XML error response for exception e."""
+        """Generate OAI-PMH XML error response for exception e.
+
+        For badVerb and badArgument errors the request is not echoed.
+        """
+        if (isinstance(e, (BadVerb, BadArgument))):
+            verb = None
         self.base_tree( verb=verb )
         err = SubElement( self.root, 'error', {'code': e.code} )
         err.text = str(e)
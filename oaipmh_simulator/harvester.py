@@ -0,0 +1,414 @@
+"""Concurrent OAI-PMH harvester and load generator for the simulator.
+
+Harvests ListRecords or ListIdentifiers as a number of concurrent
+streams, each following its own chain of resumptionTokens. Streams are
+partitioned either by set or by date range. Connections are kept alive
+and reused from a pool, and responses are parsed incrementally as they
+are read so that records are handled as soon as they arrive. Requests
+that get a 503 response with Retry-After, as sent by admission
+control, are made again after the time given.
+
+Each stream can be checked against the Repository the server is
+configured with: the sequence of records harvested must be exactly the
+sequence that Repository.select_records() gives for the same arguments,
+with matching headers and metadata. This makes the harvester both a
+throughput generator and an end-to-end check of paging and filtering.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import optparse
+import threading
+import time
+from xml.etree.ElementTree import iterparse, tostring, fromstring
+try: #python3
+    from urllib.parse import urlencode
+except ImportError: #python2
+    from urllib import urlencode
+
+from oaipmh_simulator._version import __version__
+from oaipmh_simulator.connection_pool import ConnectionPool
+from oaipmh_simulator.repository import Repository, OAI_PMH_Exception
+
+OAI_NS = '{http://www.openarchives.org/OAI/2.0/}'
+
+
+class HarvestError(Exception):
+    """Error response or unexpected HTTP status from server."""
+
+    def __init__(self, msg, code=None):
+        """Initialize HarvestError with message and OAI-PMH error code."""
+        super(HarvestError, self).__init__(msg)
+        self.code = code
+
+
+class HarvestedRecord(object):
+    """Record (or just header for ListIdentifiers) from harvest."""
+
+    def __init__(self, identifier=None, datestamp=None, set_specs=None, status=None, metadata=None):
+        """Create HarvestedRecord, metadata is an Element or None."""
+        self.identifier = identifier
+        self.datestamp = datestamp
+        self.set_specs = [] if set_specs is None else set_specs
+        self.status = status
+        self.metadata = metadata
+
+    @classmethod
+    def from_element(cls, element):
+        """Create from <record> or <header> element."""
+        if (element.tag == OAI_NS + 'header'):
+            header = element
+            metadata = None
+        else:
+            header = element.find(OAI_NS + 'header')
+            metadata = element.find(OAI_NS + 'metadata')
+        return( cls(identifier=header.findtext(OAI_NS + 'identifier'),
+                    datestamp=header.findtext(OAI_NS + 'datestamp'),
+                    set_specs=[e.text for e in header.findall(OAI_NS + 'setSpec')],
+                    status=header.findtext(OAI_NS + 'status'),
+                    metadata=metadata) )
+
+
+class CountingReader(object):
+    """Reader of HTTP response in chunks that counts the bytes read.
+
+    iterparse() reads the response through this as it parses.
+    """
+
+    def __init__(self, response, harvester):
+        """Initialize reader of response for harvester."""
+        self.response = response
+        self.harvester = harvester
+
+    def read(self, size=-1):
+        """Read the next chunk of up to harvester.chunk_size bytes."""
+        data = self.response.read(self.harvester.chunk_size)
+        self.harvester._count(num_bytes=len(data))
+        return( data )
+
+
+class Harvester(object):
+    """Harvester for ListRecords and ListIdentifiers requests.
+
+    Counters of requests, records and bytes read are updated by all
+    streams so that throughput can be reported.
+    """
+
+    def __init__(self, base_url, pool_size=10, chunk_size=65536, max_retries=10):
+        """Initialize Harvester for OAI-PMH baseURL.
+
+        A request that gets a 503 response with Retry-After is made
+        again after the time given, up to max_retries times.
+        """
+        self.base_url = base_url
+        self.pool = ConnectionPool(base_url, size=pool_size)
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.records = 0
+        self.bytes = 0
+        self.retries = 0
+
+    def _count(self, requests=0, records=0, num_bytes=0, retries=0):
+        """Update counters."""
+        with self.lock:
+            self.requests += requests
+            self.records += records
+            self.bytes += num_bytes
+            self.retries += retries
+
+    def _get(self, params):
+        """Make GET request with params, return (connection, response).
+
+        Honors Retry-After in 503 responses, see
+        https://www.openarchives.org/OAI/2.0/guidelines-repository.htm#FlowControl
+        """
+        path = self.pool.path + '?' + urlencode(sorted(params.items()))
+        retries = 0
+        while (True):
+            conn = self.pool.get()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+            except Exception:
+                # Server may have closed idle keep-alive connection, retry once
+                conn.close()
+                conn = self.pool.get()
+                conn.request('GET', path)
+                response = conn.getresponse()
+            retry_after = retry_seconds(response)
+            if (response.status != 503 or retry_after is None or retries >= self.max_retries):
+                return( (conn, response) )
+            response.read()
+            self.pool.put(conn)
+            retries += 1
+            self._count(retries=1)
+            time.sleep(retry_after)
+
+    def granularity(self):
+        """Datestamp granularity given in the server's Identify response."""
+        (conn, response) = self._get({'verb': 'Identify'})
+        data = response.read()
+        self.pool.put(conn)
+        if (response.status != 200):
+            raise HarvestError("HTTP status %d for Identify" % (response.status))
+        return( fromstring(data).findtext('%sIdentify/%sgranularity' % (OAI_NS, OAI_NS)) )
+
+    def request(self, params):
+        """Make request with params, yield parsed record and header elements.
+
+        The response is parsed as it is read. Record elements (header
+        elements for ListIdentifiers) are yielded as soon as they are
+        complete. Finally the resumptionToken element is yielded if there
+        is one. Will raise HarvestError if there is an HTTP or OAI-PMH
+        error, except that noRecordsMatch simply gives no records. A
+        503 response with Retry-After is retried, see _get().
+        """
+        (conn, response) = self._get(params)
+        if (response.status != 200):
+            response.read()
+            self.pool.put(conn)
+            raise HarvestError("HTTP status %d for %s" % (response.status, urlencode(sorted(params.items()))))
+        self._count(requests=1)
+        in_list = None # the ListRecords or ListIdentifiers element
+        try:
+            for (event, element) in iterparse(CountingReader(response, self), events=('start', 'end')):
+                if (event == 'start'):
+                    if (element.tag in (OAI_NS + 'ListRecords', OAI_NS + 'ListIdentifiers')):
+                        in_list = element
+                elif (element.tag == OAI_NS + 'error'):
+                    if (element.get('code') == 'noRecordsMatch'):
+                        continue
+                    raise HarvestError(element.text, element.get('code'))
+                elif (in_list is not None and
+                      ((element.tag == OAI_NS + 'record' and params.get('verb') == 'ListRecords') or
+                       (element.tag == OAI_NS + 'header' and params.get('verb') == 'ListIdentifiers') or
+                       element.tag == OAI_NS + 'resumptionToken')):
+                    yield element
+                    in_list.remove(element) # free memory as we go
+        finally:
+            if (response.will_close or not response.isclosed()):
+                conn.close()
+            self.pool.put(conn)
+
+    def harvest(self, verb='ListRecords', **args):
+        """Harvest with verb and args, following resumptionTokens.
+
+        Generator of HarvestedRecord objects. args are the OAI-PMH
+        arguments metadataPrefix, from, until and set.
+        """
+        params = dict(args)
+        params['verb'] = verb
+        while (True):
+            token = None
+            for element in self.request(params):
+                if (element.tag == OAI_NS + 'resumptionToken'):
+                    token = element.text
+                else:
+                    self._count(records=1)
+                    yield HarvestedRecord.from_element(element)
+            if (not token):
+                break
+            params = {'verb': verb, 'resumptionToken': token}
+
+    def harvest_streams(self, streams, verb='ListRecords', threads=10, consumer=None):
+        """Harvest several streams concurrently.
+
+        streams is a list of dicts of OAI-PMH arguments, one per
+        stream. Each stream is harvested in full by one of threads
+        worker threads. If consumer is given it is called as
+        consumer(stream_args, records) with a generator of records,
+        otherwise the records are simply counted. Returns list of
+        results from consumer (or record counts) in the order of
+        streams.
+        """
+        def run(stream_args):
+            records = self.harvest(verb, **stream_args)
+            if (consumer is not None):
+                return( consumer(stream_args, records) )
+            return( sum(1 for r in records) )
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return( list(executor.map(run, streams)) )
+
+
+def retry_seconds(response):
+    """Seconds to wait given by Retry-After header of response, or None.
+
+    Only the delay-seconds form of Retry-After is understood.
+    """
+    retry_after = response.getheader('Retry-After')
+    try:
+        return( max(0, int(retry_after)) )
+    except (TypeError, ValueError):
+        return( None )
+
+
+def set_partitions(repo, metadata_prefix):
+    """Streams for each top level set in repo, plus a stream for all records.
+
+    Records in the top level sets do not necessarily cover the whole
+    repository so the unrestricted stream is included too.
+    """
+    streams = [{'metadataPrefix': metadata_prefix}]
+    for set_spec in repo.set_specs():
+        if (':' not in set_spec):
+            streams.append({'metadataPrefix': metadata_prefix, 'set': set_spec})
+    return( streams )
+
+
+def date_partitions(metadata_prefix, start, end, num, granularity='YYYY-MM-DD'):
+    """Streams for num contiguous date ranges of whole days from start to end.
+
+    start and end are YYYY-MM-DD strings, granularity that of the
+    repository. Each range ends at the last datestamp, at that
+    granularity, before the next range starts: a day earlier with day
+    granularity, a second earlier with seconds granularity since a
+    day until is only the start of the day. The first range has no
+    from and the last no until so that the ranges together cover all
+    records.
+    """
+    if (granularity == 'YYYY-MM-DDThh:mm:ssZ'):
+        (date_format, step) = ('%Y-%m-%dT%H:%M:%SZ', timedelta(seconds=1))
+    else:
+        (date_format, step) = ('%Y-%m-%d', timedelta(days=1))
+    start_date = datetime.strptime(start, '%Y-%m-%d')
+    days = max(1, (datetime.strptime(end, '%Y-%m-%d') - start_date).days + 1)
+    num = max(1, min(num, days))
+    boundaries = [start_date + timedelta(days=n * days // num) for n in range(num + 1)]
+    streams = []
+    for n in range(num):
+        args = {'metadataPrefix': metadata_prefix}
+        if (n > 0):
+            args['from'] = boundaries[n].strftime(date_format)
+        if (n < num - 1):
+            args['until'] = (boundaries[n + 1] - step).strftime(date_format)
+        streams.append(args)
+    return( streams )
+
+
+def canonical_metadata(metadata):
+    """Canonical string for metadata Element, or fragment string, or None.
+
+    Fragments from the repository are parsed in the default namespace
+    of the OAI-PMH response they would be spliced into so that they
+    compare equal with the harvested elements.
+    """
+    if (metadata is None):
+        return( None )
+    if (not hasattr(metadata, 'tag')):
+        metadata = fromstring('<metadata xmlns="%s">%s</metadata>' % (OAI_NS[1:-1], metadata))
+    return( b''.join([tostring(child) for child in metadata]) )
+
+
+def verify_stream(repo, stream_args, records):
+    """Verify records harvested for stream_args against repo.
+
+    Returns (number of records, list of problem descriptions). The
+    harvested records must match, in order, the records selected by
+    repo for the same arguments.
+    """
+    try:
+        expected = repo.select_records(**stream_args)
+    except OAI_PMH_Exception:
+        expected = []
+    problems = []
+    n = 0
+    for (n, record) in enumerate(records, 1):
+        if (n > len(expected)):
+            problems.append("%s: unexpected extra record %s" % (stream_args, record.identifier))
+            continue
+        e = expected[n - 1]
+        if (record.identifier != e.identifier):
+            problems.append("%s: record %d is %s, expected %s" % (stream_args, n, record.identifier, e.identifier))
+            continue
+        if ((record.datestamp, record.set_specs, record.status) !=
+            (e.datestamp, e.set_specs, e.status)):
+            problems.append("%s: header mismatch for %s" % (stream_args, record.identifier))
+        if (record.metadata is not None and
+            canonical_metadata(record.metadata) != canonical_metadata(e.metadata)):
+            problems.append("%s: metadata mismatch for %s" % (stream_args, record.identifier))
+    if (n < len(expected)):
+        problems.append("%s: got %d records, expected %d" % (stream_args, n, len(expected)))
+    return( (n, problems) )
+
+
+def main():
+    """Command line harvester."""
+    p = optparse.OptionParser(description='OAI-PMH simulator harvester and load generator',
+                              usage='usage: %prog [options] baseURL   (-h for help)',
+                              version='%prog '+__version__ )
+    p.add_option('--verb', action='store', default='ListRecords',
+                 help='ListRecords or ListIdentifiers (default %default)')
+    p.add_option('--metadata-prefix', '-m', action='store', default='oai_dc',
+                 help='metadataPrefix to harvest (default %default)')
+    p.add_option('--partition', action='store', default='sets',
+                 help="'sets' for one stream per top level set, or 'dates:N' "
+                      "for N date ranges (default %default)")
+    p.add_option('--start', action='store', default='1970-01-01',
+                 help='start date for date partitions (default earliestDatestamp '
+                      'from --repo-json, else %default)')
+    p.add_option('--end', action='store', default=datetime.utcnow().strftime('%Y-%m-%d'),
+                 help='end date for date partitions (default %default)')
+    p.add_option('--repeat', action='store', type='int', default=1,
+                 help='number of times to harvest each stream (default %default)')
+    p.add_option('--threads', '-t', action='store', type='int', default=10,
+                 help='number of concurrent streams (default %default)')
+    p.add_option('--repo-json', '-r', action='store',
+                 help='JSON file describing repository the server uses, '
+                      'harvested records are verified against it')
+
+    (options, args) = p.parse_args()
+    if (len(args)!=1):
+        p.print_help()
+        return
+
+    repo = None
+    if (options.repo_json):
+        with open(options.repo_json, 'r') as fh:
+            repo = Repository( cfg=json.load(fh) )
+    if (options.partition == 'sets'):
+        if (repo is None):
+            p.error("--partition sets requires --repo-json")
+        streams = set_partitions(repo, options.metadata_prefix)
+    elif (options.partition.startswith('dates:')):
+        start = options.start
+        if (repo is not None and repo.earliest_datestamp):
+            start = repo.earliest_datestamp[:10]
+        if (repo is not None):
+            granularity = repo.granularity
+        else:
+            granularity = Harvester(args[0], pool_size=1).granularity()
+        streams = date_partitions(options.metadata_prefix, start, options.end,
+                                  int(options.partition[6:]), granularity)
+    else:
+        p.error("Bad --partition %s" % (options.partition))
+    streams = streams * options.repeat
+
+    harvester = Harvester(args[0], pool_size=options.threads)
+    consumer = None
+    if (repo is not None):
+        consumer = lambda stream_args, records: verify_stream(repo, stream_args, records)
+    start_time = time.time()
+    results = harvester.harvest_streams(streams, verb=options.verb,
+                                        threads=options.threads, consumer=consumer)
+    elapsed = time.time() - start_time
+    harvester.pool.close()
+    problems = []
+    if (repo is not None):
+        for (n, stream_problems) in results:
+            problems += stream_problems
+    print("%d streams, %d requests, %d records, %.1fMB in %.2fs: "
+          "%.1f requests/s, %.1f records/s, %d retries" % (
+              len(streams), harvester.requests, harvester.records,
+              harvester.bytes / 1048576.0, elapsed,
+              harvester.requests / elapsed, harvester.records / elapsed,
+              harvester.retries))
+    for problem in problems:
+        print(problem)
+    if (len(problems) > 0):
+        raise SystemExit("%d problems found" % (len(problems)))
+
+if __name__ == "__main__":
+    main()
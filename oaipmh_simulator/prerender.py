@@ -0,0 +1,265 @@
+"""Static pre-rendering of OAI-PMH responses for OAI-PMH simulator.
+
+Renders every response in a bounded request space to files so that
+they can be served by a plain static file server:
+
+  - Identify
+  - ListMetadataFormats, for the repository and for each item
+  - ListSets
+  - GetRecord for each record
+  - ListRecords and ListIdentifiers for each metadataPrefix, both for
+    the whole repository and for each set, following the chain of
+    resumptionTokens to the end
+
+Responses are rendered with the same OAI_PMH_Handler as the server so
+they are identical to what the server would send, except that the
+responseDate is the time of rendering and resumptionTokens have no
+expirationDate and do not keep the repository generation, since the
+files are served long after they are rendered. The file for each
+request is named by the SHA-1 of its canonical query string (arguments
+sorted, see canonical_query()) and urlmap.json in the output directory
+maps canonical query strings to file names.
+
+Rendering is done in a pool of processes and is incremental: each unit
+of work (a single request or a whole list chain) has a fingerprint of
+the repository data it depends on, and units whose fingerprint is the
+same as in the manifest from the last run are not rendered again.
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import re
+try: #python3
+    from urllib.parse import urlencode
+except ImportError: #python2
+    from urllib import urlencode
+from xml.sax.saxutils import unescape
+
+from oaipmh_simulator._version import __version__
+from oaipmh_simulator.blob_store import BlobStore
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.repository import NoSetHierarchy
+
+MANIFEST = 'manifest.json'
+URLMAP = 'urlmap.json'
+
+_NOT_SET = object()
+
+
+def canonical_query(args):
+    """Canonical query string for request args, arguments sorted."""
+    return( urlencode(sorted(args.items())) )
+
+
+def query_filename(query):
+    """File name, relative to the output directory, for canonical query."""
+    verb = re.search(r'(?:^|&)verb=([A-Za-z]+)', query)
+    return( os.path.join(verb.group(1) if verb else 'other',
+                         hashlib.sha1(query.encode('utf-8')).hexdigest() + '.xml') )
+
+
+def fingerprint(*parts):
+    """SHA-1 hex digest fingerprint of JSON-serializable parts."""
+    return( hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest() )
+
+
+def record_fingerprint(record):
+    """Fingerprint of a record's header and metadata."""
+    metadata_key = None if record.metadata is None else BlobStore.key(record.metadata)
+    return( fingerprint(record.identifier, record.metadataPrefix, record.datestamp,
+                        record.status, record.set_specs, sorted(record.about),
+                        metadata_key) )
+
+
+def request_units(repo, salt):
+    """List of (args, chain, fingerprint) units of work for repo.
+
+    args are the arguments of the (first) request, chain is True for
+    ListRecords and ListIdentifiers where the resumptionToken chain is
+    followed. salt is included in all fingerprints so that everything
+    is rendered again if it changes.
+    """
+    settings = fingerprint(salt, repo.repository_name, repo.protocol_version,
+                           repo.admin_email, repo.earliest_datestamp,
+                           repo.deleted_record, repo.granularity)
+    formats = repo.metadata_formats()
+    try:
+        set_specs = repo.set_specs()
+    except NoSetHierarchy:
+        set_specs = []
+    units = [({'verb': 'Identify'}, False, settings),
+             ({'verb': 'ListMetadataFormats'}, False, fingerprint(salt, formats)),
+             ({'verb': 'ListSets'}, False, fingerprint(salt, set_specs, repo.sets))]
+    record_fps = {}
+    for identifier in sorted(repo.items):
+        item = repo.select_item(identifier) # with crosswalked records
+        units.append( ({'verb': 'ListMetadataFormats', 'identifier': identifier}, False,
+                       fingerprint(salt, item.metadata_formats())) )
+        for (metadata_prefix, record) in sorted(item.records.items()):
+            fp = record_fingerprint(record)
+            record_fps[(identifier, metadata_prefix)] = fp
+            units.append( ({'verb': 'GetRecord', 'identifier': identifier,
+                            'metadataPrefix': metadata_prefix}, False, fingerprint(salt, fp)) )
+    for metadata_prefix in formats:
+        for set_spec in [None] + set_specs:
+            select_args = {'metadataPrefix': metadata_prefix}
+            if (set_spec is not None):
+                select_args['set'] = set_spec
+            fps = [record_fps[(r.identifier, metadata_prefix)]
+                   for r in repo.select_records(**select_args)]
+            fp = fingerprint(salt, fps)
+            for verb in ('ListRecords', 'ListIdentifiers'):
+                args = dict(select_args, verb=verb)
+                units.append( (args, True, fingerprint(verb, fp)) )
+    return( units )
+
+
+def render(handler_factory, args):
+    """Render response bytes for request args with a new handler."""
+    return( handler_factory().handle(args).get_data() )
+
+
+def render_unit(handler_factory, out_dir, args, chain):
+    """Render unit to files in out_dir, return list of (query, filename).
+
+    For a chain, each response is searched for a resumptionToken and
+    the next request made with it until there is none.
+    """
+    verb = args['verb']
+    files = []
+    while (args is not None):
+        data = render(handler_factory, args)
+        query = canonical_query(args)
+        filename = query_filename(query)
+        path = os.path.join(out_dir, filename)
+        if (not os.path.isdir(os.path.dirname(path))):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        files.append( (query, filename) )
+        args = None
+        if (chain):
+            m = re.search(br'<resumptionToken[^>]*>([^<]+)</resumptionToken>', data)
+            if (m):
+                args = {'verb': verb,
+                        'resumptionToken': unescape(m.group(1).decode('utf-8'))}
+    return( files )
+
+
+# Set in the parent before forking worker processes, and so inherited
+# by them, to avoid pickling the Flask app and repository
+_worker_state = {}
+
+
+def _init_worker():
+    """Set up worker process, storage may not share the parent's connection."""
+    after_fork = getattr(_worker_state['storage'], 'after_fork', None)
+    if (after_fork is not None):
+        after_fork()
+
+
+def fork_context():
+    """multiprocessing context that forks processes, None if fork is not available."""
+    if (not hasattr(multiprocessing, 'get_context')): #python2, forks where it can
+        return( multiprocessing if os.name == 'posix' else None )
+    if ('fork' not in multiprocessing.get_all_start_methods()):
+        return( None )
+    return( multiprocessing.get_context('fork') )
+
+
+def _render_unit_in_worker(unit):
+    """Render (args, chain) unit using _worker_state."""
+    (args, chain) = unit
+    with _worker_state['app'].app_context():
+        return( render_unit(_worker_state['handler_factory'], _worker_state['out_dir'],
+                            args, chain) )
+
+
+def prerender(app, out_dir, repo_name=None, processes=None):
+    """Pre-render responses for repository of app into out_dir.
+
+    Renders the repository app.config['repo'], or the one named
+    repo_name in app.config['repos']. Only units that have changed
+    since the last run into out_dir are rendered, and files for units
+    or pages that no longer exist are removed. Returns (number of
+    units rendered, number of units unchanged).
+
+    Units are rendered in a pool of processes (default one per CPU)
+    forked from this one, unless processes is 1 or fork is not
+    available.
+    """
+    logger = logging.getLogger('oaipmh_simulator')
+
+    def handler_factory():
+        return( OAI_PMH_Handler(app, repo_name) )
+    with app.app_context():
+        repo = handler_factory().repo
+        salt = fingerprint(__version__, handler_factory().base_url,
+                           handler_factory().page_size)
+        units = request_units(repo, salt)
+    if (not os.path.isdir(out_dir)):
+        os.makedirs(out_dir)
+    manifest_file = os.path.join(out_dir, MANIFEST)
+    old_manifest = {}
+    if (os.path.exists(manifest_file)):
+        with open(manifest_file, 'r') as fh:
+            old_manifest = json.load(fh)
+    manifest = {}
+    todo = []
+    for (args, chain, fp) in units:
+        key = canonical_query(args)
+        old = old_manifest.get(key)
+        if (old is not None and old['fingerprint'] == fp and
+            all([os.path.exists(os.path.join(out_dir, f)) for (q, f) in old['files']])):
+            manifest[key] = old
+        else:
+            todo.append( (key, args, chain, fp) )
+    logger.info("Pre-rendering %d units (%d unchanged)" % (len(todo), len(units)-len(todo)))
+    work = [(args, chain) for (key, args, chain, fp) in todo]
+    fork = fork_context()
+    if (fork is None):
+        processes = 1
+    # Tokens that do not expire, static files outlive any token_lifetime
+    token_lifetime = app.config.get('token_lifetime', _NOT_SET)
+    app.config['token_lifetime'] = None
+    try:
+        if (processes == 1 or len(work) < 2):
+            with app.app_context():
+                results = [render_unit(handler_factory, out_dir, args, chain)
+                           for (args, chain) in work]
+        else:
+            _worker_state['app'] = app
+            _worker_state['handler_factory'] = handler_factory
+            _worker_state['out_dir'] = out_dir
+            _worker_state['storage'] = repo.storage
+            pool = fork.Pool(processes, _init_worker)
+            try:
+                chunksize = max(1, len(work) // (4 * (processes or multiprocessing.cpu_count())))
+                results = pool.map(_render_unit_in_worker, work, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+                _worker_state.clear()
+    finally:
+        if (token_lifetime is _NOT_SET):
+            del app.config['token_lifetime']
+        else:
+            app.config['token_lifetime'] = token_lifetime
+    for ((key, args, chain, fp), files) in zip(todo, results):
+        manifest[key] = {'fingerprint': fp, 'files': files}
+    # Remove files no longer used
+    used = set([f for entry in manifest.values() for (q, f) in entry['files']])
+    for entry in old_manifest.values():
+        for (query, filename) in entry['files']:
+            if (filename not in used and os.path.exists(os.path.join(out_dir, filename))):
+                os.remove(os.path.join(out_dir, filename))
+    with open(manifest_file, 'w') as fh:
+        json.dump(manifest, fh, sort_keys=True)
+    with open(os.path.join(out_dir, URLMAP), 'w') as fh:
+        json.dump(dict([(q, f) for entry in manifest.values() for (q, f) in entry['files']]),
+                  fh, indent=1, sort_keys=True)
+    return( (len(todo), len(units)-len(todo)) )
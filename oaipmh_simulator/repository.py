@@ -1,18 +1,33 @@
 """Repository for OAI-PMH simulator."""
 
+try: #python3
+    from collections.abc import Mapping
+except ImportError: #python2
+    from collections import Mapping
+import bisect
+import collections
 from datetime import datetime
+import gc
+import glob
+import heapq
+import itertools
+import json
 import os
 import os.path
 import re
+import threading
 import time
 import logging
+import multiprocessing
 try: #python3
     from urllib.request import URLopener
     from urllib.parse import quote
 except ImportError: #python2
     from urllib import URLopener, quote
-from defusedxml.ElementTree import parse
 
+from oaipmh_simulator.blob_store import BlobStore, CompressedBlob, text
+from oaipmh_simulator.crosswalk import Crosswalks
+from oaipmh_simulator.validate import validate_fragments, ValidationCache
 
 class Repository(object):
     """Repository for OAI-PMH simulator.
@@ -21,9 +36,29 @@ class Repository(object):
     have metadata available in zero or more formats/
     """
 
-    def __init__(self, cfg=None):
-        """Initialize Repository object, taking settings from cfg."""
-        self.items = dict() #index by identifier
+    def __init__(self, cfg=None, blob_store=None, shards=None, processes=None, storage=None):
+        """Initialize Repository object, taking settings from cfg.
+
+        Metadata and set descriptions are held in blob_store which may
+        be shared with other Repository objects so that metadata common
+        to several repositories is stored only once. A private store is
+        created if none is given.
+
+        The repository definition may instead, or additionally, be split
+        across shards, either a list of JSON file names or a glob pattern
+        for them. See load_shards() for how they are combined.
+
+        Items and records are held in storage, by default a MemoryStorage.
+        If storage already has repository settings (e.g. a SQLiteStorage
+        file imported earlier) and no cfg is given, they are used.
+        """
+        self.storage = MemoryStorage() if storage is None else storage
+        # Incremented after every change made through this object so that
+        # anything derived from the repository state can be keyed on it;
+        # anything derived while a change is being made is then keyed on
+        # the generation before it and so is not kept once it is made
+        self.generation = 0
+        self.blob_store = BlobStore() if blob_store is None else blob_store
         self.repository_name = None
         self.protocol_version = None
         self.admin_email = []
@@ -32,70 +67,228 @@ class Repository(object):
         self.deleted_record = 'no'
         self.granularity = 'YYYY-MM-DD'
         self.sets = {}
+        self.crosswalks = Crosswalks()
         # Used internally only:
         self.logger = logging.getLogger('oaipmh_simulator')
         self.compiled_exclude_files = []
-        # Do we have config?
-        self.cfg = cfg
+        # Do we have config? Keep the settings but not the records, whose
+        # metadata is held in blob_store (perhaps compressed)
+        self.cfg = None
+        if (cfg is not None):
+            self.cfg = dict(cfg)
+            self.cfg.pop('records', None)
         if (cfg):
-            self.repository_name = cfg.get('repositoryName')
-            self.protocol_version = cfg.get('protocolVersion')
-            self.admin_email = cfg.get('adminEmail')
-            self.earliest_datestamp = cfg.get('earliestDatestamp')
-            if (self.earliest_datestamp):
-                self.earliest_ds = Datestamp(self.earliest_datestamp)
-            self.deleted_record = cfg.get('deletedRecord')
-            self.granularity = cfg.get('granularity')
-            self.sets = cfg.get('sets')
-            for r in cfg.get('records',[]):
-                # Make for find Item
-                identifier = r.get('identifier')
-                self.logger.info( "Adding %s" % (identifier) )
-                if (identifier in self.items):
-                    item = self.items[identifier]
-                    # fixme, check other data
-                else:
-                    item = Item( identifier=identifier, sets=r.get('sets') )
-                    self.add_item(item)
-                # Now make and add the Record data
-                record = Record( metadataPrefix=r.get('metadataPrefix'),
-                                 datestamp=r.get('datestamp'),
-                                 status=r.get('status'),
-                                 metadata=r.get('metadata'),
-                                 about=r.get('about') )
-                item.add_record( record )
+            self.configure(cfg)
+            self.add_records(cfg.get('records',[]))
+        elif (self.storage.load_settings() is not None):
+            self.configure(self.storage.load_settings())
+        if (shards is not None):
+            self.load_shards(shards, processes)
+        if (cfg or shards is not None):
             # Stats...
             self.logger.info("Repository initialized: %d items" % (len(self.items)))
 
+    @property
+    def items(self):
+        """Mapping of identifier to Item for all items in storage."""
+        return( self.storage.items )
+
+    def configure(self, cfg):
+        """Take repository level settings from cfg.
+
+        Sets are added to those already defined, the first definition
+        of any setSpec wins.
+        """
+        self.repository_name = cfg.get('repositoryName')
+        self.protocol_version = cfg.get('protocolVersion')
+        self.admin_email = cfg.get('adminEmail')
+        self.earliest_datestamp = cfg.get('earliestDatestamp')
+        if (self.earliest_datestamp):
+            self.earliest_ds = Datestamp(self.earliest_datestamp)
+        self.deleted_record = cfg.get('deletedRecord')
+        self.granularity = cfg.get('granularity')
+        for (set_spec, set_cfg) in (cfg.get('sets') or {}).items():
+            if (set_spec not in self.sets):
+                self.sets[self.blob_store.share(set_spec)] = {
+                    'name': self.blob_store.share(set_cfg.get('name')),
+                    'description': text(self.blob_store.add(set_cfg.get('description'))) }
+        self.crosswalks.configure(cfg.get('crosswalks'))
+        settings = dict(cfg)
+        settings.pop('records', None)
+        settings['sets'] = self.sets
+        self.storage.save_settings(settings)
+        self.generation += 1
+
+    def add_records(self, records):
+        """Add records from list of record definitions.
+
+        An Item is created for the first record with each identifier
+        and that record determines the sets the item is in. A later
+        record in the same metadataPrefix replaces an earlier one.
+        """
+        self.storage.add_records(records, self.blob_store)
+        self.generation += 1
+
+    def load_shards(self, shards, processes=None):
+        """Load repository definition split across shards.
+
+        shards is either a list of JSON file names or a glob pattern
+        (matches are taken in sorted order). Each shard is parsed, with
+        its datestamps and metadata content keys, in a pool of processes
+        (default one per CPU, processes=1 to load in this process) that
+        return compact rows for the records, see load_shard(). Items and
+        Records are then built from the rows of the shards in order in
+        one pass, following the same rules as add_records() as
+        if the records of all shards were concatenated: the first
+        appearance of an identifier sets the item's sets, and the last
+        record for any identifier and metadataPrefix pair wins.
+        Repository level settings not already set by a cfg passed to
+        __init__ are taken from the first shard that has them.
+        Raises ValueError if there are no shards.
+        """
+        pattern = shards
+        if (isinstance(shards, str)):
+            shards = sorted(glob.glob(shards))
+        if (len(shards) == 0):
+            raise ValueError("No shards match %s" % (pattern))
+        settings = {} if self.cfg is None else dict(self.cfg)
+        if (not self.storage.in_memory):
+            # Import one shard at a time to keep memory use bounded
+            for filename in shards:
+                with open(filename, 'r') as fh:
+                    cfg = json.load(fh)
+                self.add_records(cfg.pop('records',[]))
+                merge_settings(settings, cfg)
+            self.configure(settings)
+            return
+        # Everything made from here on is kept, so pause cyclic garbage
+        # collection rather than have it scan the objects over and over
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            if (processes == 1 or len(shards) < 2):
+                results = list(map(load_shard, shards))
+            else:
+                # Nor in the workers, which only make rows to return
+                pool = multiprocessing.Pool(processes, gc.disable)
+                try:
+                    results = pool.map(load_shard, shards, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            self._add_shard_rows(results, settings)
+        finally:
+            if (collecting):
+                gc.enable()
+
+    def _add_shard_rows(self, results, settings):
+        """Add settings and records from load_shard() results, see load_shards()."""
+        for (shard_settings, rows) in results:
+            merge_settings(settings, shard_settings)
+        self.configure(settings)
+        share = self.blob_store.share
+        add_blob = self.blob_store.add
+        merged = {} # identifier -> Item to store, in order of first appearance
+        for (shard_settings, rows) in results:
+            for (identifier, sets, metadata_prefix, datestamp, granularity, dt,
+                 status, metadata, about, key) in rows:
+                item = merged.get(identifier)
+                if (item is None):
+                    if (identifier in self.items):
+                        item = self.items[identifier].copy()
+                    else:
+                        item = Item( identifier=identifier, sets=sets )
+                        item.sets = set([share(s) for s in item.sets])
+                    merged[identifier] = item
+                item.add_record( Record( metadataPrefix=metadata_prefix,
+                                         datestamp=datestamp,
+                                         status=status,
+                                         metadata=add_blob(metadata, key),
+                                         about=about,
+                                         ds=Datestamp.parsed(datestamp, granularity, dt) ) )
+        self.storage.add_items(list(merged.values()))
+        self.generation += 1
+
     def add_item(self, item):
         """Add an Item to the repository."""
-        self.items[item.identifier] = item
+        self.storage.add_item(item)
+        self.generation += 1
 
     def select_item( self, identifier=None ):
         """Select item based on identifier.
 
         Raise appropriate exception if the specified item is not
-        available.
+        available. The records of the item include those that can be
+        crosswalked from its stored records, see crosswalk.Crosswalks.
         """
-        if (identifier not in self.items):
+        item = self.storage.get_item(identifier)
+        if (item is None):
             raise IdDoesNotExist(identifier)
-        return self.items[identifier]
+        return( self.crosswalks.item_view(item) )
 
     def select_record( self, identifier=None, metadataPrefix=None ):
         """Select record based on identifier and metadataPrefix.
 
         Raise appropriate exception if the specified record is not
-        available.
+        available. A record stored in metadataPrefix is used if there
+        is one, else one crosswalked from another format if possible.
         """
-        item = self.select_item( identifier )
-        if (metadataPrefix not in item.records):
+        item = self.storage.get_item(identifier)
+        if (item is None):
+            raise IdDoesNotExist(identifier)
+        if (metadataPrefix in item.records):
+            return( item.records[metadataPrefix] )
+        record = self.crosswalks.record(item, metadataPrefix)
+        if (record is None):
             raise CannotDisseminateFormat(metadataPrefix)
-        return( item.records[metadataPrefix] )
+        return( record )
+
+    def current_generation(self):
+        """Current storage generation, None if storage is not versioned."""
+        return( self.storage.generation if self.storage.versioned else None )
+
+    def has_generation(self, generation):
+        """True if storage generation can still be read."""
+        return( self.storage.versioned and self.storage.has_generation(generation) )
+
+    def pin_generation(self, generation, lifetime):
+        """Keep storage generation readable for at least lifetime seconds.
+
+        Used to keep the selection that a resumptionToken pages through
+        the same while the token is live. Returns the expiry datetime
+        or None if storage is not versioned or generation has already
+        been garbage collected.
+        """
+        if (not self.storage.versioned):
+            return( None )
+        expires = self.storage.pin(generation, lifetime)
+        return( None if expires is None else datetime.utcfromtimestamp(expires) )
+
+    def pin_current_generation(self, lifetime):
+        """Pin the current storage generation as pin_generation() does.
+
+        Unlike current_generation() followed by pin_generation(), a
+        change and garbage collection in between cannot drop the
+        generation. Returns (generation, expiry datetime), both None
+        if storage is not versioned.
+        """
+        if (not self.storage.versioned):
+            return( (None, None) )
+        (generation, expires) = self.storage.pin_current(lifetime)
+        return( (generation, datetime.utcfromtimestamp(expires)) )
 
-    def select_records( self, metadataPrefix=None, **args ):
+    def select_records( self, metadataPrefix=None, after=None, limit=None, generation=None, **args ):
         """Select records that match parameters.
 
-        Used to implement ListIdentifiers and ListRecords.
+        Used to implement ListIdentifiers and ListRecords. Records are
+        returned in datestamp order, ties in identifier order, so that
+        the same selection always gives the same sequence and can be
+        split into pages: if after, a (datetime, identifier) pair, is
+        given then only records after that position are selected, and
+        at most limit records are returned. The result is an iterable
+        which may be a list or may stream from storage. If generation
+        is given then records are selected as they were in that storage
+        generation (see has_generation()), otherwise as they are now.
 
         WARNING - using **args to deal with 'from' that
         can't be used as an argument name. Also do the same
@@ -111,44 +304,102 @@ class Repository(object):
         if (until_ds and until_ds < self.earliest_ds):
             raise NoRecordsMatch('Request for from before earliestDatestamp')
         set_spec = args['set'] if 'set' in args else None
-        records = []
-        for item in self.items.values():
-            if ( (set_spec is None or item.in_set(set_spec)) and
-                 (metadataPrefix in item.records) ):
-                record = item.records[metadataPrefix]
-                if ( (from_ds is None or from_ds<=record.ds) and
-                     (until_ds is None or record.ds<=until_ds) ):
-                    records.append(record)
-        return( records )
+        select = lambda prefix, after, limit: self.storage.select_records(
+            prefix, from_ds, until_ds, set_spec, after, limit, generation )
+        source = self.crosswalks.source(metadataPrefix)
+        if (source is None):
+            return( select(metadataPrefix, after, limit) )
+        # Merge stored records with those crosswalked for other items
+        key = lambda r: (r.ds.datetime, r.identifier)
+        streams = [ ((key(r), r) for r in select(metadataPrefix, after, limit)),
+                    ((key(r), r) for r in self._crosswalked_records(
+                        metadataPrefix, source, select, after, limit, generation)) ]
+        records = (r for (k, r) in heapq.merge(*streams))
+        return( list(itertools.islice(records, limit)) )
+
+    def _crosswalked_records(self, target, source, select, after, limit, generation):
+        """Generator of records crosswalked to target from those selected in source.
+
+        Items that have a record stored in target are skipped. Records
+        in source are selected limit at a time until limit crosswalked
+        records have been found or there are no more.
+        """
+        found = 0
+        while (True):
+            chunk = list(select(source, after, limit))
+            for record in chunk:
+                if (not self.storage.has_record(record.identifier, target, generation)):
+                    found += 1
+                    yield self.crosswalks.record(record.item, target)
+            if (limit is None or len(chunk) < limit or found >= limit):
+                return
+            after = (chunk[-1].ds.datetime, chunk[-1].identifier)
 
     def metadata_formats(self):
         """List all metdata formats used in this repository.
 
-        Simply does a brute force taversal of the repository aggregating
-        all metadata formats.
+        Includes formats that records can be crosswalked to.
         """
-        metadata_formats = set()
-        for i in self.items.values():
-            for m in i.metadata_formats():
-                if (m not in metadata_formats):
-                    metadata_formats.add(m)
-        return( sorted(metadata_formats) )
+        return( self.crosswalks.formats(self.storage.metadata_formats()) )
 
-    def set_specs(self):
-        """List all setSpec values used in this repository.
+    def prewarm_crosswalks(self, workers=4):
+        """Crosswalk records in the background to fill the memo cache.
 
-        Simply does a brute force taversal of the repository aggregating
-        all sets defined.
+        For each crosswalk target, records are taken in datestamp order
+        as a harvest would request them. Returns the executor, see
+        crosswalk.Crosswalks.prewarm().
         """
-        set_specs = set()
-        for item in self.items.values():
-            for set_spec in item.set_specs():
-                if (set_spec not in set_specs):
-                    set_specs.add(set_spec)
+        records = []
+        for target in sorted(self.crosswalks.crosswalks):
+            records += self.select_records(metadataPrefix=target,
+                                           limit=self.crosswalks.memo.size)
+        return( self.crosswalks.prewarm(records, workers) )
+
+    def set_specs(self):
+        """List all setSpec values used in this repository."""
+        set_specs = self.storage.set_specs()
         if (len(set_specs)==0):
             raise NoSetHierarchy()
         return( sorted(set_specs) )
 
+    def validate(self, processes=None, cache=None):
+        """Check that all metadata and set descriptions are well-formed.
+
+        Returns a list of (location, error) pairs, one for each place a
+        malformed fragment is used, sorted by location. An empty list
+        means all fragments are well-formed. See validate_fragments()
+        for processes and cache.
+
+        Metadata is validated once per distinct blob in blob_store,
+        using the content keys already held there, so with a compressing
+        store the blobs are decompressed one at a time. Locations are
+        found only for blobs that are malformed.
+        """
+        if (cache is None):
+            cache = ValidationCache()
+        errors = validate_fragments( self.blob_store.blobs, processes=processes, cache=cache )
+        bad = []
+        descriptions = {}
+        for (set_spec, set_cfg) in self.sets.items():
+            if (set_cfg.get('description') is not None):
+                descriptions[set_spec] = (BlobStore.key(set_cfg['description']), set_cfg['description'])
+        errors.update( validate_fragments( dict(descriptions.values()), processes=1, cache=cache ) )
+        for (set_spec, (key, description)) in descriptions.items():
+            if (key in errors):
+                bad.append( ("set %s description" % (set_spec), errors[key]) )
+        # stored blobs are shared by identity so match failures on that
+        failed = {}
+        for key in errors:
+            if (key in self.blob_store.blobs):
+                failed[id(self.blob_store.blobs[key])] = errors[key]
+        if (len(failed) > 0):
+            for item in self.items.values():
+                for record in item.records.values():
+                    if (id(record._metadata) in failed):
+                        bad.append( ("record %s %s metadata" % (item.identifier, record.metadataPrefix),
+                                     failed[id(record._metadata)]) )
+        return( sorted(bad) )
+
     def set_name_description(self, set_spec):
         """Set name if defined."""
         print("sets for %s" % (set_spec))
@@ -158,6 +409,389 @@ class Repository(object):
         return( None, None )
 
 
+def load_repositories(repo_dir, blob_store=None):
+    """Load a Repository from each JSON file in repo_dir.
+
+    Returns dict of Repository objects indexed by name, the name being
+    the file name without the .json extension. All repositories share
+    blob_store (a new one is created if none is given) so metadata that
+    is common to several of them is stored only once.
+    """
+    if (blob_store is None):
+        blob_store = BlobStore()
+    repos = {}
+    for filename in sorted(glob.glob(os.path.join(repo_dir, '*.json'))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        with open(filename, 'r') as fh:
+            repos[name] = Repository( cfg=json.load(fh), blob_store=blob_store )
+    return( repos )
+
+
+def merge_settings(settings, shard_settings):
+    """Merge repository level settings from a shard into settings.
+
+    Settings already present are kept, as are existing set definitions.
+    """
+    for (key, value) in shard_settings.items():
+        if (key not in settings):
+            settings[key] = value
+    settings['sets'] = dict(shard_settings.get('sets') or {},
+                            **(settings.get('sets') or {}))
+
+
+def load_shard(filename):
+    """Load one shard of a repository definition from JSON file.
+
+    Run in worker processes by Repository.load_shards(). Returns the
+    repository level settings of the shard and a list of rows, one for
+    each record in order, of plain values that are cheap to pass back
+    to the parent process: (identifier, sets, metadataPrefix,
+    datestamp, granularity, datetime, status, metadata, about, key)
+    where granularity and datetime are the parsed datestamp and key is
+    the metadata content key (see BlobStore.key()), so that the parent
+    need not calculate them again. sets is empty except in the first
+    row for each identifier. Repeated values are shared so that they
+    are pickled once.
+    """
+    with open(filename, 'r') as fh:
+        cfg = json.load(fh)
+    seen = set()
+    shared = {}
+    rows = []
+    for r in cfg.pop('records', []):
+        identifier = r.get('identifier')
+        sets = ()
+        if (identifier not in seen):
+            seen.add(identifier)
+            sets = tuple([shared.setdefault(s, s) for s in r.get('sets', [])])
+        metadata_prefix = r.get('metadataPrefix')
+        ds = Datestamp(r.get('datestamp'))
+        metadata = r.get('metadata')
+        rows.append( (identifier, sets, shared.setdefault(metadata_prefix, metadata_prefix),
+                      ds.date_str, ds.granularity, ds.datetime, r.get('status'), metadata,
+                      r.get('about'), None if metadata is None else BlobStore.key(metadata)) )
+    return( (cfg, rows) )
+
+
+def index_key(record):
+    """Key of record in datestamp index, (datetime, identifier)."""
+    return( (record.ds.datetime or datetime.min, record.identifier) )
+
+
+def sorted_contains(keys, key):
+    """True if sorted list keys contains key."""
+    n = bisect.bisect_left(keys, key)
+    return( n < len(keys) and keys[n] == key )
+
+
+class MemoryItems(Mapping):
+    """Read-only mapping of identifier to Item for items in MemoryStorage.
+
+    Shows the items as they were in generation, or as they are in the
+    current generation if generation is None.
+    """
+
+    def __init__(self, storage, generation=None):
+        """Initialize mapping for storage at generation."""
+        self.storage = storage
+        self.generation = generation
+
+    def __getitem__(self, identifier):
+        """Item with identifier, raise KeyError if there is none."""
+        item = self.storage.get_item(identifier, self.generation)
+        if (item is None):
+            raise KeyError(identifier)
+        return( item )
+
+    def __contains__(self, identifier):
+        """True if there is an item with identifier."""
+        return( self.storage.get_item(identifier, self.generation) is not None )
+
+    def __iter__(self):
+        """Iterate over identifiers."""
+        generation = self.storage.read_generation(self.generation)
+        for (identifier, versions) in list(self.storage.versions.items()):
+            if (versions[0][0] <= generation):
+                yield identifier
+
+    def __len__(self):
+        """Number of items."""
+        if (self.generation is None):
+            return( self.storage.num_items )
+        return( sum(1 for identifier in self) )
+
+
+class MemoryStorage(object):
+    """Storage of items and records in memory, the default.
+
+    Storage classes implement the item and record level operations
+    of Repository. Record selections walk a datestamp index that is
+    updated as records are added, other lists are made by brute force
+    traversal.
+
+    Storage is versioned: each change (a call to add_item(),
+    add_items() or add_records()) makes a new generation, and reads
+    may be made at any generation that has not been garbage collected.
+    For each identifier there is a list of versions of the Item, each
+    tagged with the generation it was made in, so a change copies only
+    the items it touches and all other items are shared with earlier
+    generations. Items stored must not be changed in place afterwards,
+    a changed copy (see Item.copy()) is stored instead.
+
+    A generation is kept while it is the current generation or has a
+    lease from pin(). Versions that are not visible in any kept
+    generation are dropped by gc().
+    """
+
+    in_memory = True
+    versioned = True
+
+    def __init__(self):
+        """Initialize empty MemoryStorage."""
+        self.generation = 0 # current generation, the one reads see by default
+        self.versions = dict() # identifier -> list of (generation, Item), oldest first
+        self.num_items = 0
+        self.items = MemoryItems(self)
+        self.leases = dict() # generation -> expiry time
+        # (generation, identifier) for each new version of an existing item,
+        # the older versions of which may become garbage
+        self.superseded = collections.deque()
+        self.lock = threading.RLock()
+        # Datestamp index: metadataPrefix -> sorted list of index_key()
+        # of records in any kept version. Lists are replaced, not changed,
+        # so that readers need no lock. Keys of records that are not
+        # current are counted in stale_keys and dropped from time to time
+        self.index = dict()
+        self.stale_keys = 0
+
+    def save_settings(self, settings):
+        """Repository settings are not stored."""
+        pass
+
+    def load_settings(self):
+        """No stored repository settings."""
+        return( None )
+
+    def read_generation(self, generation=None):
+        """Generation to read, the current one if generation is None."""
+        return( self.generation if generation is None else generation )
+
+    def has_generation(self, generation):
+        """True if generation can still be read."""
+        if (generation == self.generation):
+            return( True )
+        expires = self.leases.get(generation)
+        return( expires is not None and expires > time.time() )
+
+    def pin(self, generation, lifetime):
+        """Keep generation readable for at least lifetime seconds.
+
+        Returns the expiry time (seconds since the epoch), or None if
+        the generation has already been garbage collected.
+        """
+        with self.lock:
+            if (not self.has_generation(generation)):
+                return( None )
+            expires = max(self.leases.get(generation, 0), time.time() + lifetime)
+            self.leases[generation] = expires
+        return( expires )
+
+    def pin_current(self, lifetime):
+        """Pin the current generation as pin() does.
+
+        The generation is read and pinned under the lock so that it
+        cannot be changed and garbage collected in between. Returns
+        (generation, expiry time).
+        """
+        with self.lock:
+            generation = self.generation
+            return( (generation, self.pin(generation, lifetime)) )
+
+    def gc(self):
+        """Drop expired leases and versions no kept generation can see."""
+        with self.lock:
+            now = time.time()
+            for (generation, expires) in list(self.leases.items()):
+                if (expires <= now):
+                    del self.leases[generation]
+            oldest = min([self.generation] + list(self.leases.keys()))
+            dropped = False
+            while (len(self.superseded) > 0 and self.superseded[0][0] <= oldest):
+                (generation, identifier) = self.superseded.popleft()
+                versions = self.versions[identifier]
+                # Keep the newest version visible in oldest, and all later
+                n = 0
+                while (n + 1 < len(versions) and versions[n + 1][0] <= oldest):
+                    n += 1
+                if (n > 0):
+                    self.versions[identifier] = versions[n:]
+                    dropped = True
+            if (dropped and self.stale_keys * 2 > sum(map(len, self.index.values()))):
+                self._rebuild_index()
+
+    def _rebuild_index(self):
+        """Rebuild datestamp index from the versions kept, dropping stale keys."""
+        index = {}
+        current = 0
+        for versions in self.versions.values():
+            for (generation, item) in versions:
+                for (prefix, record) in item.records.items():
+                    index.setdefault(prefix, set()).add(index_key(record))
+            current += len(versions[-1][1].records)
+        self.index = dict([(prefix, sorted(keys)) for (prefix, keys) in index.items()])
+        self.stale_keys = sum(map(len, self.index.values())) - current
+
+    def _version(self, versions, generation):
+        """Item from versions visible in generation, None if none is."""
+        for (version_generation, item) in reversed(versions):
+            if (version_generation <= generation):
+                return( item )
+        return( None )
+
+    def _put(self, item, generation):
+        """Store item as its version in generation, not yet visible."""
+        versions = self.versions.get(item.identifier)
+        if (versions is None):
+            self.versions[item.identifier] = [(generation, item)]
+        elif (versions[-1][0] == generation):
+            versions[-1] = (generation, item)
+        else:
+            versions.append( (generation, item) )
+            self.superseded.append( (generation, item.identifier) )
+
+    def _commit(self, generation, items):
+        """Make generation, in which items were stored, the current one.
+
+        The datestamp index is updated for the records of items and
+        then garbage is collected.
+        """
+        new_keys = {} # metadataPrefix -> keys of records in items
+        for item in dict([(item.identifier, item) for item in items]).values():
+            versions = self.versions[item.identifier]
+            if (versions[0][0] == generation):
+                self.num_items += 1
+            elif (len(versions) > 1):
+                # Records of the previous version no longer current
+                for (prefix, record) in versions[-2][1].records.items():
+                    if (prefix not in item.records or
+                        index_key(item.records[prefix]) != index_key(record)):
+                        self.stale_keys += 1
+            for (prefix, record) in item.records.items():
+                new_keys.setdefault(prefix, []).append(index_key(record))
+        for (prefix, keys) in new_keys.items():
+            old = self.index.get(prefix, [])
+            keys = sorted(set([key for key in keys if not sorted_contains(old, key)]))
+            if (len(keys) == 0):
+                continue
+            if (len(old) == 0 or keys[0] > old[-1]):
+                self.index[prefix] = old + keys # usual case, new datestamps
+            else:
+                self.index[prefix] = sorted(old + keys)
+        self.generation = generation
+        self.gc()
+
+    def add_item(self, item):
+        """Add Item, replacing any with the same identifier."""
+        self.add_items([item])
+
+    def add_items(self, items):
+        """Add Items in one new generation, replacing any with the same identifiers."""
+        with self.lock:
+            generation = self.generation + 1
+            for item in items:
+                self._put(item, generation)
+            self._commit(generation, items)
+
+    def add_records(self, records, blob_store):
+        """Add records from list of record definitions.
+
+        See Repository.add_records(). Metadata is added to blob_store.
+        All the records are added in one new generation, an Item that
+        already exists is copied before records are added to it.
+        """
+        logger = logging.getLogger('oaipmh_simulator')
+        with self.lock:
+            generation = self.generation + 1
+            changed = {} # identifier -> Item in the new generation
+            for r in records:
+                # Make for find Item
+                identifier = r.get('identifier')
+                logger.debug( "Adding %s", identifier )
+                item = changed.get(identifier)
+                if (item is None):
+                    item = self.get_item(identifier)
+                    if (item is not None):
+                        item = item.copy()
+                        # fixme, check other data
+                    else:
+                        sets = [blob_store.share(s) for s in r.get('sets',[])]
+                        item = Item( identifier=identifier, sets=sets )
+                    changed[identifier] = item
+                    self._put(item, generation)
+                # Now make and add the Record data
+                record = Record( metadataPrefix=r.get('metadataPrefix'),
+                                 datestamp=r.get('datestamp'),
+                                 status=r.get('status'),
+                                 metadata=blob_store.add(r.get('metadata')),
+                                 about=r.get('about') )
+                item.add_record( record )
+            self._commit(generation, list(changed.values()))
+
+    def get_item(self, identifier, generation=None):
+        """Item with identifier in generation, None if there is none."""
+        versions = self.versions.get(identifier)
+        if (versions is None):
+            return( None )
+        return( self._version(versions, self.read_generation(generation)) )
+
+    def has_record(self, identifier, metadataPrefix, generation=None):
+        """True if item with identifier has a record in metadataPrefix in generation."""
+        item = self.get_item(identifier, generation)
+        return( item is not None and metadataPrefix in item.records )
+
+    def select_records(self, metadataPrefix, from_ds, until_ds, set_spec, after, limit, generation=None):
+        """List of records that match, see Repository.select_records().
+
+        Walks the datestamp index from the first possible position,
+        skipping keys of records not current in generation.
+        """
+        generation = self.read_generation(generation)
+        keys = self.index.get(metadataPrefix, []) # never changed in place
+        n = 0
+        if (from_ds is not None):
+            n = bisect.bisect_left(keys, (from_ds.datetime, ''))
+        if (after is not None):
+            n = max(n, bisect.bisect_right(keys, after))
+        until = None if until_ds is None else until_ds.datetime
+        records = []
+        while (n < len(keys) and (limit is None or len(records) < limit)):
+            key = keys[n]
+            n += 1
+            if (until is not None and key[0] > until):
+                break
+            item = self.get_item(key[1], generation)
+            if (item is None or (set_spec is not None and not item.in_set(set_spec))):
+                continue
+            record = item.records.get(metadataPrefix)
+            if (record is not None and index_key(record) == key):
+                records.append(record)
+        return( records )
+
+    def metadata_formats(self):
+        """Sorted list of all metadataPrefixes, by brute force traversal."""
+        metadata_formats = set()
+        for i in self.items.values():
+            metadata_formats.update(i.records.keys())
+        return( sorted(metadata_formats) )
+
+    def set_specs(self):
+        """Sorted list of all setSpecs, by brute force traversal."""
+        set_specs = set()
+        for item in self.items.values():
+            set_specs.update(item.sets)
+        return( sorted(set_specs) )
+
+
 class Item(object):
     """Item in OAI-PMH."""
 
@@ -184,6 +818,17 @@ class Item(object):
                 set_spec = set_spec+':'+part
                 # don't need to add full s because already in sets
 
+    def copy(self):
+        """Copy of this Item with copies of its Records.
+
+        Metadata and other values are shared, not copied.
+        """
+        item = Item( identifier=self.identifier )
+        item.sets = set(self.sets)
+        for record in self.records.values():
+            item.add_record( record.copy() )
+        return( item )
+
     def add_record(self, record ):
         """Add Record in specific metadataPrefix format to this Item."""
         self.records[record.metadataPrefix] = record
@@ -209,17 +854,48 @@ class Item(object):
 class Record(object):
     """Record in OAI-PMH."""
 
-    def __init__(self, metadataPrefix='oai_dc', datestamp=None, status=None, metadata=None, about=None, item=None):
-        """Create a Record object."""
+    def __init__(self, metadataPrefix='oai_dc', datestamp=None, status=None, metadata=None, about=None, item=None, ds=None):
+        """Create a Record object.
+
+        ds may be given as the Datestamp for datestamp if already parsed.
+        """
         self.metadataPrefix = metadataPrefix
         self.datestamp = datestamp
-        self.ds = Datestamp(self.datestamp)
+        self.ds = Datestamp(self.datestamp) if ds is None else ds
         self.status = status
         self.metadata = metadata
         self.about = set() if about is None else about
         # Link up to item this record is part of
         self.item = item
 
+    def copy(self):
+        """Shallow copy of this Record, without reparsing the datestamp."""
+        record = Record.__new__(Record)
+        record.__dict__.update(self.__dict__)
+        return( record )
+
+    @property
+    def metadata(self):
+        """Metadata XML string, decompressed if held compressed."""
+        return( text(self._metadata) )
+
+    @metadata.setter
+    def metadata(self, metadata):
+        """Set metadata, either a string or a CompressedBlob."""
+        self._metadata = metadata
+
+    @property
+    def has_metadata(self):
+        """True if the record has metadata, without decompressing it."""
+        return( self._metadata is not None )
+
+    @property
+    def metadata_gzip(self):
+        """Metadata as a gzip member if held compressed, else None."""
+        if (isinstance(self._metadata, CompressedBlob)):
+            return( self._metadata.member )
+        return( None )
+
     @property
     def identifier(self):
         """Identifier of parent item."""
@@ -231,6 +907,9 @@ class Record(object):
         return( self.item.set_specs() )
 
 
+DATESTAMP_PATTERN = re.compile(r'(\d\d\d\d)-(\d\d)-(\d\d)(?:T(\d\d):(\d\d):(\d\d)Z)?$')
+
+
 class Datestamp(object):
     """OAI-PMH specific datastamps."""
 
@@ -246,6 +925,15 @@ class Datestamp(object):
         if (self.date_str is not None):
             self.parse_date_str()
 
+    @classmethod
+    def parsed(cls, date_str, granularity, datetime):
+        """Datestamp for date_str already parsed to granularity and datetime."""
+        ds = cls.__new__(cls)
+        ds.date_str = date_str
+        ds.granularity = granularity
+        ds.datetime = datetime
+        return( ds )
+
     def parse_date_str(self):
         """Parse the date string.
 
@@ -254,15 +942,17 @@ class Datestamp(object):
         matches that.
         """
         date_str = self.date_str
-        m = re.match(r'\d\d\d\d-\d\d-\d\d(T\d\d:\d\d:\d\dZ)?$', date_str)
+        m = DATESTAMP_PATTERN.match(date_str)
         if (m):
-            if (m.group(1)):
+            if (m.group(4)):
                 granularity = 'seconds'
+                fields = m.group(1, 2, 3, 4, 5, 6)
             else:
-                date_str += 'T00:00:00Z'
                 granularity = 'days'
+                fields = m.group(1, 2, 3)
             try:
-                self.datetime = datetime.strptime(date_str,'%Y-%m-%dT%H:%M:%SZ')
+                # Faster than strptime, which dominates loading and updates
+                self.datetime = datetime(*[int(field) for field in fields])
             except ValueError as e:
                 raise BadArgument("Bad datetime %s: %s." % (sanitize(self.date_str), str(e)))
         else:
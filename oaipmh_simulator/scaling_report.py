@@ -0,0 +1,266 @@
+"""Startup time and memory footprint scaling report for OAI-PMH simulator.
+
+Builds repositories of increasing size, either by replicating the
+records of a repository definition in the bundled JSON format or from
+generated records, and measures for each size the time taken to
+construct the Repository, the peak RSS of the process and the memory
+retained by the Repository. Each size is measured in a fresh process
+so that measurements are independent. A straight line is fitted to
+each measure to give the fixed and per-record costs.
+
+On python2 the retained memory is not measured, as there is no
+tracemalloc, and the measurement processes are forked from this one,
+so that their peak RSS includes what this process had when forked.
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+try: #python3
+    from queue import Empty
+except ImportError: #python2
+    from Queue import Empty
+
+from oaipmh_simulator._version import __version__
+
+IMPORT_CODE = ("import time; t = time.time(); "
+               "import oaipmh_simulator.repository, oaipmh_simulator.flask_app; "
+               "print(time.time() - t)")
+
+
+def generate_cfg(num_items, formats=None, num_sets=10, template=None):
+    """Generate repository definition with num_items items.
+
+    Each item has a record in each of formats (default just oai_dc)
+    and is in one of num_sets sets. If template, a repository definition
+    in the bundled JSON format, is given then the repository level
+    settings are copied and its records are used cyclically as the
+    source of metadata for the generated records.
+    """
+    formats = ['oai_dc'] if formats is None else formats
+    cfg = {"repositoryName": "scaling-test",
+           "protocolVersion": "2.0",
+           "adminEmail": ["someone@example.com"],
+           "earliestDatestamp": "1999-01-01",
+           "deletedRecord": "no",
+           "granularity": "YYYY-MM-DD"}
+    sources = []
+    if (template is not None):
+        for (key, value) in template.items():
+            if (key != 'records'):
+                cfg[key] = value
+        sources = [r.get('metadata') for r in template.get('records', [])
+                   if r.get('metadata') is not None]
+    cfg['records'] = []
+    for n in range(num_items):
+        for (f, metadata_prefix) in enumerate(formats):
+            if (len(sources) > 0):
+                metadata = sources[(n * len(formats) + f) % len(sources)]
+            else:
+                metadata = ("<md:md xmlns:md=\"http://example.org/md\">"
+                            "<md:title>Item %d in %s</md:title></md:md>" %
+                            (n, metadata_prefix))
+            cfg['records'].append({
+                "identifier": "oai:example.org:item%d" % (n),
+                "datestamp": "%04d-%02d-%02d" % (2000 + n % 20, 1 + n % 12, 1 + n % 28),
+                "metadataPrefix": metadata_prefix,
+                "metadata": metadata,
+                "sets": ["set%d" % (n % num_sets)]})
+    return( cfg )
+
+
+def measure_import_time():
+    """Time to import the oaipmh_simulator modules in a fresh interpreter."""
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_CODE])
+    return( float(out.decode('utf-8').strip()) )
+
+
+def _measure_in_child(filename, compress, queue):
+    """Measure construction of Repository from filename, put results on queue.
+
+    Run in a fresh process. Construction is timed with no tracing, the
+    Repository is then discarded and built again under tracemalloc to
+    find the memory it retains once the parsed JSON has been released.
+    The retained memory is None if there is no tracemalloc (python2).
+    """
+    import gc
+    import resource
+    try:
+        import tracemalloc
+    except ImportError: #python2
+        tracemalloc = None
+    from oaipmh_simulator.blob_store import BlobStore
+    from oaipmh_simulator.repository import Repository
+    with open(filename, 'r') as fh:
+        cfg = json.load(fh)
+    start = time.time()
+    repo = Repository( cfg=cfg, blob_store=BlobStore(compress=compress) )
+    construct_time = time.time() - start
+    num_items = len(repo.items)
+    num_records = sum([len(item.records) for item in repo.items.values()])
+    del repo, cfg
+    gc.collect()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform != 'darwin'):
+        peak_rss *= 1024 # kilobytes except on macOS
+    retained = None
+    if (tracemalloc is not None):
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        with open(filename, 'r') as fh:
+            cfg = json.load(fh)
+        repo = Repository( cfg=cfg, blob_store=BlobStore(compress=compress) )
+        del cfg
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+    queue.put({'items': num_items,
+               'records': num_records,
+               'construct_time': construct_time,
+               'peak_rss': peak_rss,
+               'retained_bytes': retained})
+
+
+def measure(cfg, compress=False):
+    """Measure construction of Repository from cfg in a fresh process.
+
+    With compress, metadata is held compressed (see BlobStore).
+    Raises RuntimeError if the measurement process fails.
+    """
+    (fd, filename) = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(cfg, fh)
+        if (hasattr(multiprocessing, 'get_context')):
+            ctx = multiprocessing.get_context('spawn')
+        else: #python2, can only fork
+            ctx = multiprocessing
+        queue = ctx.Queue()
+        child = ctx.Process(target=_measure_in_child, args=(filename, compress, queue))
+        child.start()
+        result = None
+        while (result is None):
+            try:
+                result = queue.get(timeout=1.0)
+            except Empty:
+                if (not child.is_alive()):
+                    try: # result may have arrived as the process ended
+                        result = queue.get(timeout=1.0)
+                    except Empty:
+                        pass
+                    break
+        child.join()
+        if (result is None):
+            raise RuntimeError("Measurement process failed with exit code %s" % (child.exitcode))
+    finally:
+        os.remove(filename)
+    return( result )
+
+
+def fit_line(xs, ys):
+    """Least squares fit of y = a + b*x, return (a, b)."""
+    n = float(len(xs))
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    sxx = sum([(x - mean_x) ** 2 for x in xs])
+    if (sxx == 0):
+        return( (mean_y, 0.0) )
+    sxy = sum([(x - mean_x) * (y - mean_y) for (x, y) in zip(xs, ys)])
+    b = sxy / sxx
+    return( (mean_y - b * mean_x, b) )
+
+
+def scaling_report(sizes, formats=None, template=None, compress=False):
+    """Measure repositories of each of sizes (numbers of items).
+
+    With compress, metadata is held compressed.
+
+    Returns dict with the import time, a row of measurements for
+    each size, and fitted (fixed, per-record) costs for each measure,
+    None for a measure that was not made.
+    """
+    rows = []
+    for size in sizes:
+        rows.append( measure(generate_cfg(size, formats=formats, template=template),
+                             compress=compress) )
+    records = [row['records'] for row in rows]
+    fits = {}
+    for measure_name in ('construct_time', 'peak_rss', 'retained_bytes'):
+        values = [row[measure_name] for row in rows]
+        fits[measure_name] = None if None in values else fit_line(records, values)
+    return( {'import_time': measure_import_time(),
+             'rows': rows,
+             'fits': fits} )
+
+
+def format_report(report):
+    """Format report from scaling_report() as a text table."""
+    lines = ["Import time: %.3fs" % (report['import_time']),
+             "",
+             "%10s %10s %12s %14s %16s" % ('items', 'records', 'construct_s',
+                                            'peak_rss_MB', 'retained_MB')]
+    for row in report['rows']:
+        retained = row['retained_bytes']
+        lines.append("%10d %10d %12.3f %14.1f %16s" % (
+            row['items'], row['records'], row['construct_time'],
+            row['peak_rss'] / 1048576.0,
+            'n/a' if retained is None else '%.1f' % (retained / 1048576.0)))
+    fits = report['fits']
+    lines += ["",
+              "Fitted costs:      fixed   per-record",
+              "construct   %10.3fs %10.1fus" % (fits['construct_time'][0],
+                                                fits['construct_time'][1] * 1e6),
+              "peak RSS    %9.1fMB %11.0fB" % (fits['peak_rss'][0] / 1048576.0,
+                                                fits['peak_rss'][1])]
+    if (fits['retained_bytes'] is None):
+        lines.append("retained           n/a")
+    else:
+        lines.append("retained    %9.1fMB %11.0fB" % (fits['retained_bytes'][0] / 1048576.0,
+                                                      fits['retained_bytes'][1]))
+    return( "\n".join(lines) )
+
+
+def main():
+    """Command line scaling report."""
+    p = optparse.OptionParser(description='OAI-PMH simulator scaling report',
+                              usage='usage: %prog [options]   (-h for help)',
+                              version='%prog '+__version__ )
+    p.add_option('--sizes', action='store', default='1000,10000,100000',
+                 help='comma separated numbers of items (default %default)')
+    p.add_option('--formats', action='store', default='oai_dc',
+                 help='comma separated metadataPrefixes, each item has '
+                      'a record in each (default %default)')
+    p.add_option('--repo-json', '-r', action='store',
+                 help='JSON file describing repository to use as template '
+                      'for settings and metadata (default generate metadata)')
+    p.add_option('--compress-metadata', action='store_true',
+                 help="hold metadata compressed, as the simulator option")
+    p.add_option('--json', action='store_true',
+                 help="output report as JSON instead of text table")
+
+    (options, args) = p.parse_args()
+    if (len(args)>0):
+        p.print_help()
+        return
+
+    template = None
+    if (options.repo_json):
+        with open(options.repo_json, 'r') as fh:
+            template = json.load(fh)
+    report = scaling_report( [int(s) for s in options.sizes.split(',')],
+                             formats=options.formats.split(','),
+                             template=template,
+                             compress=options.compress_metadata )
+    if (options.json):
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+if __name__ == "__main__":
+    main()
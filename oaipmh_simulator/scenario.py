@@ -0,0 +1,341 @@
+"""Time-compressed growth scenarios for OAI-PMH simulator repositories.
+
+To test incremental harvesting a repository has to keep changing. A
+scenario adds new records, updates existing ones and deletes them at
+given rates per simulated hour, on a SimulatedClock that runs speedup
+times faster than real time, so that days of growth pass in minutes.
+A scenario is defined in JSON:
+
+    {
+      "start": "2020-01-01T00:00:00Z",
+      "speedup": 3600,
+      "interval": 1.0,
+      "seed": 1,
+      "metadataPrefix": "oai_dc",
+      "identifierPrefix": "oai:example.org:scenario",
+      "sets": ["set0", "set1"],
+      "perHour": {"new": 1000, "updated": 200, "deleted": 10}
+    }
+
+start is the simulated time at which the scenario starts (default
+now), interval the real seconds between batches. Each kind of event
+is a Poisson process with the rate given in perHour, the events of
+all kinds are kept in an EventScheduler (a heap) with the next event
+of each kind, and each event popped schedules the next of its kind.
+A ScenarioRunner applies the events due by the simulated time to the
+repository in one batch per interval, each batch making one new
+repository generation. Record datestamps are the simulated times of
+their events so that from/until harvests see the growth. While the
+runner is started the responseDate of responses is the simulated time
+up to which events have been applied, so that a harvester using the
+responseDate of one harvest as from for the next gets exactly the
+records changed in between.
+
+Run this module for a benchmark of the scheduler and of applying
+events to a repository.
+"""
+
+import calendar
+import heapq
+import itertools
+import math
+import optparse
+import random
+import threading
+import time
+
+from oaipmh_simulator._version import __version__
+from oaipmh_simulator.envelope import response_date
+from oaipmh_simulator.repository import Datestamp
+
+# Kinds of events, in the order they are scheduled
+EVENT_KINDS = ('new', 'updated', 'deleted')
+
+DEFAULT_METADATA = ('<md:md xmlns:md="http://example.org/md"><md:title>%(identifier)s</md:title>'
+                    '<md:date>%(datestamp)s</md:date></md:md>')
+
+
+class SimulatedClock(object):
+    """Clock running speedup times faster than real time.
+
+    Times are in seconds since the epoch, simulated time start is at
+    the real time the clock is made, and clock gives the real time.
+    """
+
+    def __init__(self, start=None, speedup=1.0, clock=time.time):
+        """Initialize clock at simulated time start, default now."""
+        self.clock = clock
+        self.real_start = clock()
+        self.start = self.real_start if start is None else start
+        self.speedup = float(speedup)
+
+    def now(self):
+        """Current simulated time."""
+        return( self.start + (self.clock() - self.real_start) * self.speedup )
+
+
+class EventScheduler(object):
+    """Priority queue of events by time, ties in the order scheduled."""
+
+    def __init__(self):
+        """Initialize with no events."""
+        self.queue = []
+        self.counter = itertools.count()
+
+    def schedule(self, when, event):
+        """Schedule event at time when."""
+        heapq.heappush(self.queue, (when, next(self.counter), event))
+
+    def next_time(self):
+        """Time of the next event, None if there is none."""
+        return( self.queue[0][0] if len(self.queue) > 0 else None )
+
+    def pop_due(self, until, recur=None):
+        """List of (when, event) for events due at or before until, in order.
+
+        If recur is given then recur(when, event) is called for each
+        event and if it returns a time the event is scheduled again at
+        that time, replacing it in the heap in one step.
+        """
+        queue = self.queue
+        counter = self.counter
+        due = []
+        while (len(queue) > 0 and queue[0][0] <= until):
+            (when, n, event) = queue[0]
+            due.append( (when, event) )
+            again = None if recur is None else recur(when, event)
+            if (again is None):
+                heapq.heappop(queue)
+            else:
+                heapq.heapreplace(queue, (again, next(counter), event))
+        return( due )
+
+    def __len__(self):
+        """Number of events scheduled."""
+        return( len(self.queue) )
+
+
+def epoch_seconds(datestamp):
+    """Seconds since the epoch for OAI-PMH datestamp string."""
+    return( calendar.timegm(Datestamp(datestamp).datetime.timetuple()) )
+
+
+class Scenario(object):
+    """Events of a growth scenario as record definitions for a repository.
+
+    Updates and deletions are of the records in metadataPrefix that
+    are not deleted, starting with those of repo if given.
+    """
+
+    def __init__(self, cfg, repo=None, start=None):
+        """Initialize scenario defined by cfg, starting at simulated time start.
+
+        start defaults to the start in cfg, else now. Datestamps have
+        the granularity of repo if given, else days.
+        """
+        self.random = random.Random(cfg.get('seed'))
+        self.metadata_prefix = cfg.get('metadataPrefix', 'oai_dc')
+        self.identifier_prefix = cfg.get('identifierPrefix', 'oai:example.org:scenario')
+        self.sets = list(cfg.get('sets', []))
+        self.metadata = cfg.get('metadata', DEFAULT_METADATA)
+        self.datestamp_format = '%Y-%m-%d'
+        if (repo is not None and repo.granularity == 'YYYY-MM-DDThh:mm:ssZ'):
+            self.datestamp_format = '%Y-%m-%dT%H:%M:%SZ'
+        self.last_datestamp = (None, None)
+        # Identifiers of records that may be updated or deleted, and their
+        # positions in the list for removal in constant time
+        self.live = []
+        self.positions = {}
+        if (repo is not None):
+            for identifier in sorted(repo.items):
+                record = repo.items[identifier].records.get(self.metadata_prefix)
+                if (record is not None and record.status != 'deleted'):
+                    self.add_live(identifier)
+        self.new_numbers = itertools.count(1)
+        if (start is None):
+            start = epoch_seconds(cfg['start']) if 'start' in cfg else time.time()
+        self.start = start
+        # Mean seconds between events of each kind
+        per_hour = cfg.get('perHour', {})
+        self.mean_intervals = {}
+        self.scheduler = EventScheduler()
+        for kind in EVENT_KINDS:
+            if (per_hour.get(kind, 0) > 0):
+                self.mean_intervals[kind] = 3600.0 / per_hour[kind]
+                self.scheduler.schedule(self.next_time(start, kind), kind)
+
+    def next_time(self, when, kind):
+        """Time of the event of kind after one at when."""
+        return( when + self.random.expovariate(1.0) * self.mean_intervals[kind] )
+
+    def add_live(self, identifier):
+        """Add identifier to those that may be updated or deleted."""
+        if (identifier not in self.positions):
+            self.positions[identifier] = len(self.live)
+            self.live.append(identifier)
+
+    def remove_live(self, identifier):
+        """Remove identifier from those that may be updated or deleted."""
+        n = self.positions.pop(identifier)
+        last = self.live.pop()
+        if (last != identifier):
+            self.live[n] = last
+            self.positions[last] = n
+
+    def datestamp(self, when):
+        """Datestamp string for simulated time when."""
+        second = int(when)
+        if (self.last_datestamp[0] != second):
+            self.last_datestamp = (second, time.strftime(self.datestamp_format, time.gmtime(second)))
+        return( self.last_datestamp[1] )
+
+    def record(self, when, kind):
+        """Record definition for event of kind at when, None if there is none.
+
+        There is no record for an update or deletion when there are no
+        records left to change.
+        """
+        if (kind == 'new'):
+            identifier = '%s%d' % (self.identifier_prefix, next(self.new_numbers))
+            self.add_live(identifier)
+        elif (len(self.live) == 0):
+            return( None )
+        else:
+            identifier = self.live[int(self.random.random() * len(self.live))]
+        datestamp = self.datestamp(when)
+        if (kind == 'deleted'):
+            self.remove_live(identifier)
+            return( {'identifier': identifier, 'datestamp': datestamp,
+                     'metadataPrefix': self.metadata_prefix, 'status': 'deleted'} )
+        record = {'identifier': identifier, 'datestamp': datestamp,
+                  'metadataPrefix': self.metadata_prefix,
+                  'metadata': self.metadata % {'identifier': identifier, 'datestamp': datestamp}}
+        if (kind == 'new' and len(self.sets) > 0):
+            record['sets'] = [self.sets[int(self.random.random() * len(self.sets))]]
+        return( record )
+
+    def events(self, until):
+        """List of record definitions for the events due by simulated time until."""
+        records = []
+        for (when, kind) in self.scheduler.pop_due(until, self.next_time):
+            record = self.record(when, kind)
+            if (record is not None):
+                records.append(record)
+        return( records )
+
+
+class ScenarioRunner(object):
+    """Apply the events of a Scenario to a Repository as simulated time passes."""
+
+    def __init__(self, repo, scenario, clock, interval=1.0):
+        """Initialize runner for scenario on repo, with simulated clock.
+
+        Batches are applied every interval real seconds once started.
+        """
+        self.repo = repo
+        self.scenario = scenario
+        self.clock = clock
+        self.interval = interval
+        self.applied = scenario.start # simulated time events are applied up to
+        self.events = 0
+        self.batches = 0
+        self.stopping = threading.Event()
+        self.thread = None
+        self.response_date_clock = None
+
+    def now(self):
+        """Simulated time up to which events have been applied."""
+        return( self.applied )
+
+    def step(self):
+        """Apply the events due now in one batch, return the number applied.
+
+        Events are applied up to the start of the current simulated
+        second, so that all have datestamps before the responseDate
+        of any later response.
+        """
+        until = math.floor(self.clock.now())
+        records = self.scenario.events(until)
+        if (len(records) > 0):
+            self.repo.add_records(records)
+            self.events += len(records)
+            self.batches += 1
+        self.applied = max(self.applied, until)
+        return( len(records) )
+
+    def start(self):
+        """Start applying batches in a background thread.
+
+        Until stopped, response_date gives the simulated time from now().
+        """
+        self.response_date_clock = response_date.clock
+        response_date.clock = self.now
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Apply batches every interval until stopped."""
+        while (not self.stopping.wait(self.interval)):
+            self.step()
+
+    def stop(self):
+        """Stop the background thread."""
+        self.stopping.set()
+        if (self.thread is not None):
+            self.thread.join()
+        if (self.response_date_clock is not None):
+            response_date.clock = self.response_date_clock
+            self.response_date_clock = None
+
+
+def runner_from_cfg(repo, cfg):
+    """ScenarioRunner for repo from scenario definition cfg, see module description."""
+    scenario = Scenario(cfg, repo)
+    clock = SimulatedClock(scenario.start, cfg.get('speedup', 1.0))
+    return( ScenarioRunner(repo, scenario, clock, cfg.get('interval', 1.0)) )
+
+
+def benchmark(num_events=100000, per_hour=None, batch_size=10000):
+    """Time scheduling and applying num_events events.
+
+    Returns dict with the events per second for the scheduler alone
+    (popping events and making record definitions) and for applying
+    them to an in-memory repository in batches of batch_size.
+    """
+    from oaipmh_simulator.repository import Repository
+    from oaipmh_simulator.scaling_report import generate_cfg
+    per_hour = {'new': 1000, 'updated': 500, 'deleted': 50} if per_hour is None else per_hour
+    cfg = {'seed': 1, 'perHour': per_hour, 'sets': ['set%d' % (n) for n in range(10)]}
+    hours = float(num_events) / sum(per_hour.values())
+    scenario = Scenario(cfg, start=0)
+    start = time.time()
+    records = scenario.events(hours * 3600.0)
+    schedule_seconds = time.time() - start
+    repo = Repository( cfg=generate_cfg(1000) )
+    start = time.time()
+    for n in range(0, len(records), batch_size):
+        repo.add_records(records[n:n + batch_size])
+    apply_seconds = time.time() - start
+    return( {'events': len(records),
+             'schedule_rate': len(records) / schedule_seconds,
+             'apply_rate': len(records) / apply_seconds} )
+
+
+def main():
+    """Command line scenario benchmark."""
+    p = optparse.OptionParser(description='OAI-PMH simulator growth scenario benchmark',
+                              usage='usage: %prog [options]   (-h for help)',
+                              version='%prog '+__version__ )
+    p.add_option('--events', action='store', type='int', default=100000,
+                 help='approximate number of events (default %default)')
+    p.add_option('--batch-size', action='store', type='int', default=10000,
+                 help='number of events applied in each batch (default %default)')
+    (options, args) = p.parse_args()
+    result = benchmark(options.events, batch_size=options.batch_size)
+    print("Events: %d" % (result['events']))
+    print("Scheduler: %.0f events/s" % (result['schedule_rate']))
+    print("Applied to repository: %.0f events/s" % (result['apply_rate']))
+
+if __name__ == "__main__":
+    main()
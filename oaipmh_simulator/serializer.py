@@ -0,0 +1,271 @@
+"""XML serializers for OAI-PMH simulator responses.
+
+OAI_PMH_Handler builds each response as an element tree using the
+Element() factory of a serializer and the SubElement() function here,
+and then has the serializer write it out. Two serializers give
+identical output:
+
+  - StdlibSerializer uses xml.etree.ElementTree, always available and
+    the default
+  - LxmlSerializer uses lxml, if installed (and python is 3.8 or
+    later), whose serialization is done in C
+
+lxml serializes a tree about three times faster than ElementTree but
+builds it about twice as slowly, so the overall gain is small and
+depends on the response. Run this module for a benchmark of the
+available serializers across verbs and page sizes to see which is
+better for a particular repository, and use get_serializer() to get
+one by name.
+"""
+
+import optparse
+import re
+import sys
+import time
+from xml.etree import ElementTree
+try:
+    from lxml import etree
+except ImportError: #lxml is optional
+    etree = None
+
+from oaipmh_simulator._version import __version__
+
+XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>\n"
+
+
+def SubElement( parent, tag, attrib={} ):
+    """Add and return element named tag with attrib under parent.
+
+    Works for elements of either ElementTree or lxml by letting the
+    parent make the child.
+    """
+    child = parent.makeelement( tag, attrib )
+    parent.append( child )
+    return( child )
+
+
+class StdlibSerializer(object):
+    """Serializer using xml.etree.ElementTree."""
+
+    name = 'stdlib'
+
+    def Element(self, tag, attrib={}):
+        """Make new root element named tag with attrib."""
+        return( ElementTree.Element(tag, attrib) )
+
+    def serialize(self, root):
+        """Serialize tree from root to string with XML declaration."""
+        return( XML_DECLARATION + self.serialize_fragment(root) )
+
+    def serialize_fragment(self, element):
+        """Serialize element to string without XML declaration."""
+        if (sys.version_info < (3,0)):
+            return( ElementTree.tostring(element, encoding='utf-8').decode('utf-8') )
+        return( ElementTree.tostring(element, encoding='unicode') )
+
+
+class LxmlSerializer(object):
+    """Serializer using lxml, output identical to StdlibSerializer.
+
+    lxml does not allow namespace declarations as attributes, so
+    xmlns attributes given to Element() are turned into a namespace
+    map and the element put in the default namespace. Children are
+    not in a namespace so that they are serialized without prefixes,
+    just as with ElementTree where the namespace declarations are
+    simply attributes.
+
+    Escaping differs in two cases, both fixed up after serialization:
+    lxml writes a tab in an attribute value as &#9; rather than &#09;
+    and an empty element as <x/> rather than <x />. lxml also escapes
+    a carriage return in text, which ElementTree does not; that is
+    rare enough that a tree with one is copied to ElementTree and
+    serialized with StdlibSerializer.
+
+    Before python 3.8 ElementTree writes attributes sorted by name
+    rather than in the order given, and python2 does not escape a tab
+    in an attribute value, so there the output could not be identical
+    and this serializer is not available.
+    """
+
+    name = 'lxml'
+
+    def __init__(self):
+        """Initialize, raise ImportError if lxml is not installed or python is before 3.8."""
+        if (etree is None):
+            raise ImportError("lxml is not installed")
+        if (sys.version_info < (3, 8)):
+            raise ImportError("lxml serializer needs python 3.8 or later")
+        self.stdlib = StdlibSerializer()
+
+    def Element(self, tag, attrib={}):
+        """Make new root element named tag with attrib."""
+        nsmap = {}
+        plain = []
+        for (name, value) in attrib.items():
+            if (name == 'xmlns'):
+                nsmap[None] = value
+            elif (name.startswith('xmlns:')):
+                nsmap[name[6:]] = value
+            else:
+                plain.append( (name, value) )
+        if (None in nsmap):
+            tag = '{%s}%s' % (nsmap[None], tag)
+        element = etree.Element(tag, nsmap=nsmap)
+        for (name, value) in plain:
+            if (':' in name):
+                (prefix, local) = name.split(':', 1)
+                name = '{%s}%s' % (nsmap[prefix], local)
+            element.set(name, value)
+        return( element )
+
+    def serialize(self, root):
+        """Serialize tree from root to string with XML declaration."""
+        return( XML_DECLARATION + self.serialize_fragment(root) )
+
+    def serialize_fragment(self, element):
+        """Serialize element to string without XML declaration."""
+        if (not isinstance(element, etree._Element)):
+            return( self.stdlib.serialize_fragment(element) )
+        xml = etree.tostring(element, encoding='unicode')
+        if ('&#13;' in xml):
+            return( self.stdlib.serialize_fragment(to_stdlib(element)) )
+        xml = re.sub(r'([^ ])/>', r'\1 />', xml)
+        return( xml.replace('&#9;', '&#09;') )
+
+
+def to_stdlib(element):
+    """Copy lxml tree from element to an ElementTree tree.
+
+    Namespaces are written back out as xmlns attributes, as they would
+    have been given to Element().
+    """
+    attrib = {}
+    tag = element.tag
+    if (tag.startswith('{')):
+        tag = tag.split('}', 1)[1]
+        for (prefix, uri) in element.nsmap.items():
+            if (element.getparent() is None or prefix not in element.getparent().nsmap):
+                attrib['xmlns' if prefix is None else 'xmlns:' + prefix] = uri
+    prefixes = dict([(uri, prefix) for (prefix, uri) in element.nsmap.items()])
+    for (name, value) in element.attrib.items():
+        if (name.startswith('{')):
+            (uri, local) = name[1:].split('}', 1)
+            name = prefixes[uri] + ':' + local
+        attrib[name] = value
+    copy = ElementTree.Element(tag, attrib)
+    copy.text = element.text
+    copy.tail = element.tail
+    for child in element:
+        copy.append(to_stdlib(child))
+    return( copy )
+
+
+SERIALIZERS = {'stdlib': StdlibSerializer, 'lxml': LxmlSerializer}
+
+
+def available_serializers():
+    """Sorted list of names of the serializers that can be used here."""
+    names = []
+    for (name, cls) in SERIALIZERS.items():
+        try:
+            cls()
+            names.append(name)
+        except ImportError:
+            pass
+    return( sorted(names) )
+
+
+def get_serializer(name=None):
+    """Serializer called name, StdlibSerializer if name is None.
+
+    Raises ValueError if name is unknown and ImportError if the library
+    it needs is not installed or cannot be used with this python.
+    """
+    if (name is None):
+        name = 'stdlib'
+    if (name not in SERIALIZERS):
+        raise ValueError("Unknown serializer %s, must be one of %s" %
+                         (name, ', '.join(sorted(SERIALIZERS))))
+    return( SERIALIZERS[name]() )
+
+
+def benchmark(names=None, page_sizes=None, num_items=1000, repeat=5):
+    """Time responses with each serializer across verbs and page sizes.
+
+    Returns a list of dicts, one for each request and serializer, with
+    the mean seconds per response and whether the response was the same
+    as with the first serializer in names (default all available).
+    """
+    from flask import Flask
+    from oaipmh_simulator.flask_app import OAI_PMH_Handler
+    from oaipmh_simulator.repository import Repository
+    from oaipmh_simulator.scaling_report import generate_cfg
+    names = available_serializers() if names is None else names
+    names = sorted(names, key=lambda name: name != 'stdlib') # baseline first
+    page_sizes = [10, 100, 1000] if page_sizes is None else page_sizes
+    app = Flask(__name__)
+    app.config['base_url'] = 'http://example.org/oai'
+    app.config['repo'] = Repository( cfg=generate_cfg(num_items) )
+    requests = [('Identify', None, {'verb': 'Identify'}),
+                ('ListSets', None, {'verb': 'ListSets'}),
+                ('GetRecord', None, {'verb': 'GetRecord', 'identifier': 'oai:example.org:item0',
+                                     'metadataPrefix': 'oai_dc'})]
+    for page_size in page_sizes:
+        for verb in ('ListIdentifiers', 'ListRecords'):
+            requests.append( (verb, page_size, {'verb': verb, 'metadataPrefix': 'oai_dc'}) )
+    rows = []
+    with app.app_context():
+        for (verb, page_size, args) in requests:
+            app.config['page_size'] = page_size or 100
+            reference = None
+            for name in names:
+                app.config['serializer'] = name
+                start = time.time()
+                for n in range(repeat):
+                    data = OAI_PMH_Handler(app).handle(args).get_data()
+                seconds = (time.time() - start) / repeat
+                # Compare without the responseDate, which may differ
+                data = re.sub(b'<responseDate>[^<]*</responseDate>', b'', data)
+                if (reference is None):
+                    reference = data
+                rows.append( {'verb': verb, 'page_size': page_size, 'serializer': name,
+                              'seconds': seconds, 'bytes': len(data),
+                              'identical': data == reference} )
+    return( rows )
+
+
+def format_benchmark(rows):
+    """Format benchmark rows as a text table with speedups."""
+    lines = ["%-16s %9s %-8s %10s %9s %8s %9s" %
+             ('verb', 'page_size', 'backend', 'ms', 'bytes', 'speedup', 'identical')]
+    base = {}
+    for row in rows:
+        key = (row['verb'], row['page_size'])
+        base.setdefault(key, row['seconds'])
+        lines.append( "%-16s %9s %-8s %10.3f %9d %7.2fx %9s" %
+                      (row['verb'], row['page_size'] or '-', row['serializer'],
+                       row['seconds'] * 1000.0, row['bytes'],
+                       base[key] / row['seconds'] if row['seconds'] > 0 else 0.0,
+                       'yes' if row['identical'] else 'NO') )
+    return( "\n".join(lines) )
+
+
+def main():
+    """Command line serializer benchmark."""
+    p = optparse.OptionParser(description='OAI-PMH simulator serializer benchmark',
+                              usage='usage: %prog [options]   (-h for help)',
+                              version='%prog '+__version__ )
+    p.add_option('--items', action='store', type='int', default=1000,
+                 help='number of items in the generated repository (default %default)')
+    p.add_option('--page-sizes', action='store', default='10,100,1000',
+                 help='comma separated page sizes for list verbs (default %default)')
+    p.add_option('--repeat', action='store', type='int', default=5,
+                 help='number of times to time each response (default %default)')
+    (options, args) = p.parse_args()
+    page_sizes = [int(s) for s in options.page_sizes.split(',')]
+    print("Serializers available: %s" % (', '.join(available_serializers())))
+    print(format_benchmark(benchmark(page_sizes=page_sizes, num_items=options.items,
+                                     repeat=options.repeat)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""Sharding of a repository across several OAI-PMH simulator nodes.
+
+For repositories too large for one process, items are assigned to
+shard nodes by consistent hashing of their identifiers (HashRing).
+Each shard node is an ordinary simulator holding only its part of the
+repository definition (see shard_cfg()), which also serves a small
+JSON interface at <path>/shard for a router (see shard_handler()).
+
+The router is a simulator whose repository is a ShardedRepository: it
+implements the parts of Repository used by OAI_PMH_Handler by asking
+the shards, so that responses, resumptionTokens and errors are made
+just as for a single repository. GetRecord and ListMetadataFormats for
+an identifier go to the shard that owns the identifier. ListRecords and
+ListIdentifiers k-way merge the shards' streams of records, each of
+which is in datestamp then identifier order, so paging works as with
+one repository.
+
+start_local_shards() runs the shards of a repository definition as
+local processes, for testing on one host.
+"""
+
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+try: #python3
+    from urllib.parse import urlencode
+except ImportError: #python2
+    from urllib import urlencode
+
+from flask import request, jsonify
+
+from oaipmh_simulator.flask_app import app, get_flask_app, oaipmh_baseurl_handler, OAI_PMH_Handler
+from oaipmh_simulator.connection_pool import ConnectionPool
+from oaipmh_simulator.repository import Repository, Item, Record, Datestamp, OAI_PMH_Exception, BadArgument, BadResumptionToken, BadVerb, CannotDisseminateFormat, IdDoesNotExist, NoMetadataFormats, NoRecordsMatch, NoSetHierarchy
+
+
+class ShardError(Exception):
+    """Unexpected response from a shard node."""
+
+    pass
+
+
+class HashRing(object):
+    """Consistent hash ring assigning identifiers to nodes.
+
+    Each node is placed on the ring at replicas points so that items
+    are spread evenly, and adding or removing a node moves only the
+    items of that node.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        """Initialize ring for list of node names."""
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            for n in range(replicas):
+                points.append( (self.hash('%s-%d' % (node, n)), node) )
+        points.sort()
+        self.points = [p for (p, node) in points]
+        self.point_nodes = [node for (p, node) in points]
+
+    @staticmethod
+    def hash(key):
+        """Position of key on the ring."""
+        return( int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16) )
+
+    def node(self, identifier):
+        """Name of the node that identifier is assigned to."""
+        n = bisect(self.points, self.hash(identifier)) % len(self.points)
+        return( self.point_nodes[n] )
+
+
+def shard_nodes(count):
+    """Names of count shard nodes, in order."""
+    return( ['shard%d' % (n) for n in range(count)] )
+
+
+def shard_cfg(cfg, index, count):
+    """Repository definition for shard index of count from cfg.
+
+    Repository level settings are copied, records are only those with
+    identifiers that HashRing assigns to the shard.
+    """
+    nodes = shard_nodes(count)
+    ring = HashRing(nodes)
+    shard = dict(cfg)
+    shard['records'] = [r for r in cfg.get('records', [])
+                        if ring.node(r.get('identifier')) == nodes[index]]
+    return( shard )
+
+
+def record_json(record):
+    """JSON-serializable dict for Record, including its item's sets."""
+    return( {'identifier': record.identifier,
+             'sets': sorted(record.item.sets),
+             'metadataPrefix': record.metadataPrefix,
+             'datestamp': record.datestamp,
+             'status': record.status,
+             'metadata': record.metadata,
+             'about': sorted(record.about)} )
+
+
+def record_from_json(r, item=None):
+    """Record from dict made by record_json(), in a new Item if item is None."""
+    if (item is None):
+        item = Item( identifier=r['identifier'], sets=r['sets'] )
+    record = Record( metadataPrefix=r['metadataPrefix'], datestamp=r['datestamp'],
+                     status=r['status'], metadata=r['metadata'], about=set(r['about']) )
+    item.add_record( record )
+    return( record )
+
+
+def shard_handler(repo_name=None):
+    """Support JSON requests from a router at <path>/shard.
+
+    The op argument selects what is returned:
+      - settings: repository level settings, with metadataFormats and
+        setSpecs in use
+      - item: records of the item with identifier
+      - records: records selected as Repository.select_records() with
+        metadataPrefix, from, until and set, after the position given
+        by afterDatestamp and afterIdentifier, and at most limit of them
+
+    OAI-PMH errors are returned as error code and message.
+    """
+    repo = OAI_PMH_Handler( app, repo_name ).repo
+    args = request.args
+    op = args.get('op')
+    try:
+        if (op == 'settings'):
+            return( jsonify( {'repositoryName': repo.repository_name,
+                              'protocolVersion': repo.protocol_version,
+                              'adminEmail': repo.admin_email,
+                              'earliestDatestamp': repo.earliest_datestamp,
+                              'deletedRecord': repo.deleted_record,
+                              'granularity': repo.granularity,
+                              'sets': repo.sets,
+                              'metadataFormats': repo.metadata_formats(),
+                              'setSpecs': repo.storage.set_specs()} ) )
+        elif (op == 'item'):
+            item = repo.select_item( args.get('identifier') )
+            return( jsonify( {'records': [record_json(r) for r in item.records.values()]} ) )
+        elif (op == 'records'):
+            select_args = dict([(k, args[k]) for k in ('metadataPrefix', 'from', 'until', 'set')
+                                if k in args])
+            after = None
+            if ('afterDatestamp' in args):
+                after = (Datestamp(args['afterDatestamp'], 'seconds').datetime,
+                         args['afterIdentifier'])
+            limit = int(args['limit']) if 'limit' in args else None
+            records = repo.select_records(after=after, limit=limit, **select_args)
+            return( jsonify( {'records': [record_json(r) for r in records]} ) )
+        else:
+            return( jsonify( {'error': 'badArgument', 'message': 'Unknown op'} ), 400 )
+    except OAI_PMH_Exception as e:
+        return( jsonify( {'error': e.code, 'message': str(e)} ) )
+
+
+# OAI-PMH exception classes by error code
+EXCEPTION_CLASSES = dict([(cls().code, cls) for cls in
+                          (BadArgument, BadResumptionToken, BadVerb, CannotDisseminateFormat,
+                           IdDoesNotExist, NoMetadataFormats, NoRecordsMatch, NoSetHierarchy)])
+
+def exception_from_json(data):
+    """OAI-PMH exception with the error code and message from a shard.
+
+    The exception is of the class for the error code, so that it is
+    handled as it would be for a single repository.
+    """
+    cls = EXCEPTION_CLASSES.get(data['error'], OAI_PMH_Exception)
+    e = cls.__new__(cls)
+    e.code = data['error']
+    e.msg = data['message']
+    return( e )
+
+
+class ShardedRepository(object):
+    """Repository split across shard nodes, for a router.
+
+    Implements the parts of Repository that OAI_PMH_Handler uses by
+    making requests to the shard_handler() of each shard, given by
+    their baseURLs in the order of shard_nodes(). Repository level
+    settings are taken from the first shard. Generations are not
+    pinned across shards, resumptionTokens made with a
+    ShardedRepository page through the current state of the shards.
+    """
+
+    def __init__(self, shard_urls, pool_size=10, chunk_size=1000, workers=None):
+        """Initialize ShardedRepository for shards at shard_urls.
+
+        Records are fetched from the shards chunk_size at a time when
+        there is no limit on the number selected. Requests to shards
+        are made by workers threads shared by all router requests,
+        default enough to use all pool_size connections to every shard.
+        """
+        self.shard_urls = list(shard_urls)
+        self.ring = HashRing(shard_nodes(len(self.shard_urls)))
+        self.pools = [ConnectionPool(url, size=pool_size) for url in self.shard_urls]
+        if (workers is None):
+            workers = pool_size * len(self.shard_urls)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.chunk_size = chunk_size
+        self.generation = 0
+        settings = self.get(0, {'op': 'settings'})
+        self.repository_name = settings['repositoryName']
+        self.protocol_version = settings['protocolVersion']
+        self.admin_email = settings['adminEmail']
+        self.earliest_datestamp = settings['earliestDatestamp']
+        self.deleted_record = settings['deletedRecord']
+        self.granularity = settings['granularity']
+        self.sets = settings['sets']
+
+    def get(self, shard, params):
+        """JSON response from shard number shard for params.
+
+        Raises the OAI-PMH exception if the response is an error.
+        """
+        pool = self.pools[shard]
+        path = pool.path + '/shard?' + urlencode(sorted(params.items()))
+        conn = pool.get()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+        except Exception:
+            # Shard may have closed idle keep-alive connection, retry once
+            conn.close()
+            conn = pool.get()
+            conn.request('GET', path)
+            response = conn.getresponse()
+        body = response.read()
+        pool.put(conn)
+        if (response.status != 200):
+            raise ShardError("HTTP status %d from %s" % (response.status, self.shard_urls[shard]))
+        data = json.loads(body.decode('utf-8'))
+        if ('error' in data):
+            raise exception_from_json(data)
+        return( data )
+
+    def get_all(self, params):
+        """List of JSON responses from all shards, requested concurrently."""
+        return( list(self.executor.map(lambda shard: self.get(shard, params),
+                                       range(len(self.shard_urls)))) )
+
+    def shard_for(self, identifier):
+        """Number of the shard that owns identifier."""
+        return( self.ring.nodes.index(self.ring.node(identifier)) )
+
+    def current_generation(self):
+        """None, generations are not pinned across shards."""
+        return( None )
+
+    def has_generation(self, generation):
+        """False, generations are not pinned across shards."""
+        return( False )
+
+    def pin_generation(self, generation, lifetime):
+        """None, generations are not pinned across shards."""
+        return( None )
+
+    def pin_current_generation(self, lifetime):
+        """(None, None), generations are not pinned across shards."""
+        return( (None, None) )
+
+    def select_item( self, identifier=None ):
+        """Select item based on identifier from the shard that owns it."""
+        if (identifier is None):
+            raise IdDoesNotExist(identifier)
+        item = Item( identifier=identifier )
+        for r in self.get(self.shard_for(identifier), {'op': 'item', 'identifier': identifier})['records']:
+            item.sets = set(r['sets'])
+            record_from_json(r, item)
+        return( item )
+
+    def select_record( self, identifier=None, metadataPrefix=None ):
+        """Select record based on identifier and metadataPrefix."""
+        item = self.select_item( identifier )
+        if (metadataPrefix not in item.records):
+            raise CannotDisseminateFormat(metadataPrefix)
+        return( item.records[metadataPrefix] )
+
+    def _shard_records(self, shard, params, first_chunk, chunk_size):
+        """Generator of (key, Record) from shard, key being (datetime, identifier).
+
+        Starts with the records already fetched in first_chunk and
+        fetches more chunk_size at a time if chunk_size is not None.
+        """
+        chunk = first_chunk
+        while (True):
+            for r in chunk:
+                record = record_from_json(r)
+                yield ( (record.ds.datetime, record.identifier), record )
+            if (chunk_size is None or len(chunk) < chunk_size):
+                break
+            params = dict(params, limit=str(chunk_size),
+                          afterDatestamp=record.ds.datetime.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                          afterIdentifier=record.identifier)
+            chunk = self.get(shard, params)['records']
+
+    def select_records( self, metadataPrefix=None, after=None, limit=None, generation=None, **args ):
+        """Select records that match parameters, see Repository.select_records().
+
+        The first chunk (of limit records, or chunk_size if there is no
+        limit) is requested from all shards concurrently, and the
+        shards' streams are merged in (datestamp, identifier) order.
+        generation is ignored.
+        """
+        params = {'op': 'records', 'metadataPrefix': metadataPrefix}
+        for k in ('from', 'until', 'set'):
+            if (k in args):
+                params[k] = args[k]
+        if (after is not None):
+            params['afterDatestamp'] = after[0].strftime('%Y-%m-%dT%H:%M:%SZ')
+            params['afterIdentifier'] = after[1]
+        params['limit'] = str(limit if limit is not None else self.chunk_size)
+        chunk_size = None if limit is not None else self.chunk_size
+        streams = []
+        for (shard, data) in enumerate(self.get_all(params)):
+            streams.append( self._shard_records(shard, params, data['records'], chunk_size) )
+        records = (record for (key, record) in heapq.merge(*streams))
+        if (limit is not None):
+            return( list(itertools.islice(records, limit)) )
+        return( records )
+
+    def metadata_formats(self):
+        """List all metadata formats used in any shard."""
+        formats = set()
+        for settings in self.get_all({'op': 'settings'}):
+            formats.update(settings['metadataFormats'])
+        return( sorted(formats) )
+
+    def set_specs(self):
+        """List all setSpec values used in any shard."""
+        set_specs = set()
+        for settings in self.get_all({'op': 'settings'}):
+            set_specs.update(settings['setSpecs'])
+        if (len(set_specs)==0):
+            raise NoSetHierarchy()
+        return( sorted(set_specs) )
+
+    def set_name_description(self, set_spec):
+        """Set name and description if defined."""
+        if (set_spec in self.sets):
+            return( self.sets[set_spec].get('name',None),
+                    self.sets[set_spec].get('description',None) )
+        return( None, None )
+
+
+def _serve_shard(cfg, index, count, path, page_size, queue):
+    """Serve shard index of count of cfg on a free local port.
+
+    Run in a new process by start_local_shards(), puts (index, baseURL)
+    on queue once listening.
+    """
+    from werkzeug.serving import make_server
+    app = get_flask_app()
+    app.config['no_post'] = False
+    app.config['page_size'] = page_size
+    app.config['repo'] = Repository( cfg=shard_cfg(cfg, index, count) )
+    app.add_url_rule(path, methods=("GET","POST"), view_func=oaipmh_baseurl_handler)
+    app.add_url_rule(path + '/shard', view_func=shard_handler)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    app.config['base_url'] = 'http://127.0.0.1:%d%s' % (server.server_port, path)
+    queue.put( (index, app.config['base_url']) )
+    server.serve_forever()
+
+
+def start_local_shards(cfg, count, path='/oai', page_size=100):
+    """Start count local processes, each serving one shard of cfg.
+
+    Returns (processes, shard_urls) with the baseURLs of the shards in
+    order, ready for ShardedRepository. Terminate the processes to stop
+    the shards. Processes are started fresh (spawn) so that each has
+    its own Flask app, except on python2 which can only fork them.
+    """
+    if (hasattr(multiprocessing, 'get_context')):
+        ctx = multiprocessing.get_context('spawn')
+    else: #python2
+        ctx = multiprocessing
+    queue = ctx.Queue()
+    processes = []
+    for index in range(count):
+        p = ctx.Process(target=_serve_shard, args=(cfg, index, count, path, page_size, queue))
+        p.daemon = True
+        p.start()
+        processes.append(p)
+    shard_urls = [None] * count
+    for n in range(count):
+        (index, url) = queue.get(timeout=60)
+        shard_urls[index] = url
+    return( (processes, shard_urls) )
@@ -0,0 +1,65 @@
+"""Single-flight coalescing of identical concurrent requests.
+
+When many clients make the same request at the same time only the
+first (the leader) computes the response, the others wait for it and
+share the result. Nothing is kept once the leader has finished so this
+is not a cache: a request that arrives after the response has been
+computed computes it again.
+"""
+
+import threading
+
+
+class _Call(object):
+    """In-flight call that waiters share."""
+
+    def __init__(self):
+        """Initialize call with no result yet."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key.
+
+    Counters record the number of calls that computed a result (leaders)
+    and the number that waited for and shared another's (coalesced).
+    """
+
+    def __init__(self):
+        """Initialize with no calls in flight."""
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Return fn(), or the result of an in-flight call with the same key.
+
+        If fn raises an exception then that is raised in the leader and
+        in all the callers waiting on it.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = (call is None)
+            if (leader):
+                call = _Call()
+                self.calls[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if (leader):
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if (call.error is not None):
+            raise call.error
+        return( call.result )
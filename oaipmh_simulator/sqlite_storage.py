@@ -0,0 +1,310 @@
+"""SQLite storage of items and records for OAI-PMH simulator.
+
+Alternative to MemoryStorage for fixtures too large to hold in memory.
+Use as Repository(storage=SQLiteStorage(filename)). Selections are
+done with indexed queries and list results stream from a cursor so
+that only the records of the current page are ever in memory.
+
+Metadata is stored once per distinct content in a blobs table keyed
+by content key (see BlobStore.key), as in memory.
+"""
+
+try: #python3
+    from collections.abc import Mapping
+except ImportError: #python2
+    from collections import Mapping
+import json
+import logging
+import sqlite3
+import threading
+
+from oaipmh_simulator.blob_store import BlobStore
+from oaipmh_simulator.repository import Item, Record, Datestamp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT );
+CREATE TABLE IF NOT EXISTS items (
+    identifier TEXT PRIMARY KEY,
+    batch INTEGER );
+CREATE TABLE IF NOT EXISTS item_sets (
+    set_spec TEXT,
+    identifier TEXT,
+    PRIMARY KEY (set_spec, identifier) ) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS item_sets_identifier ON item_sets (identifier);
+CREATE TABLE IF NOT EXISTS blobs (
+    key TEXT PRIMARY KEY,
+    content TEXT ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS records (
+    identifier TEXT,
+    metadataPrefix TEXT,
+    datestamp TEXT,
+    ds TEXT,
+    status TEXT,
+    metadata_key TEXT,
+    about TEXT,
+    PRIMARY KEY (identifier, metadataPrefix) );
+CREATE INDEX IF NOT EXISTS records_prefix_ds ON records (metadataPrefix, ds, identifier);
+"""
+
+# Columns selected to build Record objects, sets are concatenated with
+# spaces which cannot appear in a setSpec
+RECORD_COLUMNS = """r.identifier, r.metadataPrefix, r.datestamp, r.status, b.content, r.about,
+       (SELECT group_concat(s.set_spec, ' ') FROM item_sets s WHERE s.identifier = r.identifier)
+       FROM records r LEFT JOIN blobs b ON b.key = r.metadata_key"""
+
+
+def normalized_ds(datetime):
+    """Datestamp string with seconds granularity, these sort correctly."""
+    return( datetime.strftime('%Y-%m-%dT%H:%M:%SZ') )
+
+
+class SQLiteItems(Mapping):
+    """Read-only mapping of identifier to Item for items in SQLiteStorage."""
+
+    def __init__(self, storage):
+        """Initialize mapping for storage."""
+        self.storage = storage
+
+    def __getitem__(self, identifier):
+        """Item with identifier, raise KeyError if there is none."""
+        item = self.storage.get_item(identifier)
+        if (item is None):
+            raise KeyError(identifier)
+        return( item )
+
+    def __contains__(self, identifier):
+        """True if there is an item with identifier."""
+        return( self.storage.conn.execute(
+            "SELECT 1 FROM items WHERE identifier = ?", (identifier,)).fetchone() is not None )
+
+    def __iter__(self):
+        """Iterate over identifiers."""
+        for (identifier,) in self.storage.conn.execute("SELECT identifier FROM items"):
+            yield identifier
+
+    def __len__(self):
+        """Number of items."""
+        return( self.storage.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] )
+
+
+class SQLiteStorage(object):
+    """Storage of items and records in a SQLite database file.
+
+    Implements the same operations as MemoryStorage except that it is
+    not versioned, reads always see the current state. Each thread uses
+    its own connection to the database.
+    """
+
+    in_memory = False
+    versioned = False
+
+    def __init__(self, filename, batch_size=10000):
+        """Initialize SQLiteStorage using database filename.
+
+        The database is created if it does not exist. Records are
+        imported in batches of batch_size.
+        """
+        self.filename = filename
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.items = SQLiteItems(self)
+        self.logger = logging.getLogger('oaipmh_simulator')
+        self._metadata_formats = None
+        self._set_specs = None
+        self.conn.executescript(SCHEMA)
+        self.batch = self.conn.execute("SELECT COALESCE(MAX(batch), 0) FROM items").fetchone()[0]
+
+    @property
+    def conn(self):
+        """Connection to the database for this thread."""
+        conn = getattr(self.local, 'conn', None)
+        if (conn is None):
+            conn = sqlite3.connect(self.filename)
+            self.local.conn = conn
+        return( conn )
+
+    def after_fork(self):
+        """Drop any connection inherited from the parent process."""
+        self.local = threading.local()
+
+    def save_settings(self, settings):
+        """Store repository settings."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('repository', ?)",
+                              (json.dumps(settings),))
+
+    def load_settings(self):
+        """Stored repository settings, None if there are none."""
+        row = self.conn.execute("SELECT value FROM settings WHERE name = 'repository'").fetchone()
+        return( None if row is None else json.loads(row[0]) )
+
+    def add_item(self, item):
+        """Add Item and its records, replacing any with the same identifier."""
+        self.add_items([item])
+
+    def add_items(self, items):
+        """Add Items and their records, replacing any with the same identifiers."""
+        conn = self.conn
+        with conn:
+            for item in items:
+                self._replace_item(conn, item)
+        self._metadata_formats = None
+        self._set_specs = None
+
+    def _replace_item(self, conn, item):
+        """Replace Item and its records, within a transaction."""
+        conn.execute("DELETE FROM item_sets WHERE identifier = ?", (item.identifier,))
+        conn.execute("DELETE FROM records WHERE identifier = ?", (item.identifier,))
+        conn.execute("INSERT OR REPLACE INTO items (identifier, batch) VALUES (?, ?)",
+                     (item.identifier, self.batch))
+        conn.executemany("INSERT INTO item_sets (set_spec, identifier) VALUES (?, ?)",
+                         [(s, item.identifier) for s in item.sets])
+        for record in item.records.values():
+            self._insert_record(conn, item.identifier, record)
+
+    def _insert_record(self, conn, identifier, record):
+        """Insert or replace one Record."""
+        key = None
+        if (record.metadata is not None):
+            key = BlobStore.key(record.metadata)
+            conn.execute("INSERT OR IGNORE INTO blobs (key, content) VALUES (?, ?)",
+                         (key, record.metadata))
+        conn.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (identifier, record.metadataPrefix, record.datestamp,
+                      normalized_ds(record.ds.datetime), record.status, key,
+                      json.dumps(list(record.about))))
+
+    def add_records(self, records, blob_store=None):
+        """Add records from iterable of record definitions in batches.
+
+        Follows the same rules as MemoryStorage.add_records(). Each batch
+        is inserted in one transaction: items are inserted keeping any
+        existing item so the first appearance of an identifier wins, and
+        sets are inserted only for items created in this batch; records
+        are inserted replacing any existing record so the last wins.
+        blob_store is not used, metadata is stored in the database.
+        """
+        batch = []
+        for r in records:
+            batch.append(r)
+            if (len(batch) >= self.batch_size):
+                self._add_batch(batch)
+                batch = []
+        if (len(batch) > 0):
+            self._add_batch(batch)
+
+    def _add_batch(self, records):
+        """Add one batch of record definitions in one transaction."""
+        self.batch += 1
+        items = {} # identifier -> Item for first appearance in batch
+        blobs = {}
+        rows = []
+        for r in records:
+            identifier = r.get('identifier')
+            if (identifier not in items):
+                items[identifier] = Item( identifier=identifier, sets=r.get('sets',[]) )
+            metadata = r.get('metadata')
+            key = None
+            if (metadata is not None):
+                key = BlobStore.key(metadata)
+                blobs[key] = metadata
+            ds = Datestamp(r.get('datestamp'))
+            rows.append( (identifier, r.get('metadataPrefix'), r.get('datestamp'),
+                          normalized_ds(ds.datetime), r.get('status'), key,
+                          json.dumps(r.get('about') or [])) )
+        conn = self.conn
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO items (identifier, batch) VALUES (?, ?)",
+                             [(identifier, self.batch) for identifier in items])
+            conn.executemany("INSERT OR IGNORE INTO item_sets (set_spec, identifier) "
+                             "SELECT ?, identifier FROM items WHERE identifier = ? AND batch = ?",
+                             [(s, item.identifier, self.batch)
+                              for item in items.values() for s in item.sets])
+            conn.executemany("INSERT OR IGNORE INTO blobs (key, content) VALUES (?, ?)",
+                             blobs.items())
+            conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self._metadata_formats = None
+        self._set_specs = None
+        self.logger.info("Added batch of %d records" % (len(rows)))
+
+    def _make_record(self, row, item=None):
+        """Make Record (and Item if not given) from row of RECORD_COLUMNS."""
+        (identifier, metadata_prefix, datestamp, status, metadata, about, sets) = row
+        if (item is None):
+            item = Item( identifier=identifier )
+            item.sets = set(sets.split(' ')) if sets else set()
+        record = Record( metadataPrefix=metadata_prefix, datestamp=datestamp,
+                         status=status, metadata=metadata,
+                         about=set(json.loads(about)) if about else None )
+        item.add_record( record )
+        return( record )
+
+    def get_item(self, identifier):
+        """Item with identifier and all its records, None if there is none."""
+        if (identifier not in self.items):
+            return( None )
+        item = None
+        rows = self.conn.execute("SELECT " + RECORD_COLUMNS + " WHERE r.identifier = ?",
+                                 (identifier,)).fetchall()
+        for row in rows:
+            item = self._make_record(row, item).item
+        if (item is None):
+            item = Item( identifier=identifier )
+            item.sets = set([s for (s,) in self.conn.execute(
+                "SELECT set_spec FROM item_sets WHERE identifier = ?", (identifier,))])
+        return( item )
+
+    def has_record(self, identifier, metadataPrefix, generation=None):
+        """True if item with identifier has a record in metadataPrefix.
+
+        generation is ignored as storage is not versioned.
+        """
+        return( self.conn.execute("SELECT 1 FROM records WHERE identifier = ? AND metadataPrefix = ?",
+                                  (identifier, metadataPrefix)).fetchone() is not None )
+
+    def select_records(self, metadataPrefix, from_ds, until_ds, set_spec, after, limit, generation=None):
+        """Generator of records that match, see Repository.select_records().
+
+        generation is ignored as storage is not versioned.
+
+        The query uses the (metadataPrefix, ds, identifier) index for
+        ordering and the datestamp range, and the item_sets primary key
+        for set membership.
+        """
+        sql = "SELECT " + RECORD_COLUMNS + " WHERE r.metadataPrefix = ?"
+        params = [metadataPrefix]
+        if (from_ds is not None):
+            sql += " AND r.ds >= ?"
+            params.append(normalized_ds(from_ds.datetime))
+        if (until_ds is not None):
+            sql += " AND r.ds <= ?"
+            params.append(normalized_ds(until_ds.datetime))
+        if (after is not None):
+            sql += " AND (r.ds, r.identifier) > (?, ?)"
+            params += [normalized_ds(after[0]), after[1]]
+        if (set_spec is not None):
+            sql += (" AND EXISTS (SELECT 1 FROM item_sets s2 WHERE"
+                    " s2.set_spec = ? AND s2.identifier = r.identifier)")
+            params.append(set_spec)
+        sql += " ORDER BY r.ds, r.identifier"
+        if (limit is not None):
+            sql += " LIMIT ?"
+            params.append(limit)
+        for row in self.conn.execute(sql, params):
+            yield self._make_record(row)
+
+    def metadata_formats(self):
+        """Sorted list of all metadataPrefixes, cached until records change."""
+        if (self._metadata_formats is None):
+            self._metadata_formats = [m for (m,) in self.conn.execute(
+                "SELECT DISTINCT metadataPrefix FROM records ORDER BY metadataPrefix")]
+        return( self._metadata_formats )
+
+    def set_specs(self):
+        """Sorted list of all setSpecs, cached until records change."""
+        if (self._set_specs is None):
+            self._set_specs = [s for (s,) in self.conn.execute(
+                "SELECT DISTINCT set_spec FROM item_sets ORDER BY set_spec")]
+        return( self._set_specs )
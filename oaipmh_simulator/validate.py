@@ -0,0 +1,125 @@
+"""Load-time validation of XML fragments for OAI-PMH simulator.
+
+Metadata and set descriptions are spliced verbatim into responses so a
+malformed fragment otherwise shows up only when a harvester fails to
+parse a response. Checking is done with defusedxml across a pool of
+processes and results are cached by content key (see BlobStore.key) so
+unchanged fragments are checked only once, even across restarts if the
+cache is saved to a file.
+"""
+
+import json
+import logging
+import multiprocessing
+import os.path
+from xml.etree.ElementTree import ParseError
+from defusedxml import DefusedXmlException
+from defusedxml.ElementTree import fromstring
+
+from oaipmh_simulator.blob_store import BlobStore, CompressedBlob
+
+# Below this number of unchecked fragments it is quicker to check
+# in-process than to start a pool
+PARALLEL_THRESHOLD = 1000
+
+
+def check_fragment(fragment):
+    """Check that fragment is a well-formed XML fragment.
+
+    Returns None if the fragment is well-formed, else an error string.
+    """
+    try:
+        fromstring(fragment)
+    except (ParseError, DefusedXmlException) as e:
+        return( "%s: %s" % (e.__class__.__name__, str(e)) )
+    return( None )
+
+
+def _check_keyed_fragment(key_fragment):
+    """Check (key, fragment) pair, return (key, error)."""
+    (key, fragment) = key_fragment
+    return( (key, check_fragment(fragment)) )
+
+
+def _uncached_text(blob):
+    """String content of blob, not adding it to any HotCache."""
+    if (isinstance(blob, CompressedBlob)):
+        return( blob.decompress() )
+    return( blob )
+
+
+class ValidationCache(object):
+    """Cache of fragment validation results indexed by content key.
+
+    The value for each key is None for a well-formed fragment or an
+    error string. If filename is given then the cache is read from
+    that file if it exists, and save() writes it back.
+    """
+
+    def __init__(self, filename=None):
+        """Initialize ValidationCache, reading filename if present."""
+        self.filename = filename
+        self.results = {}
+        if (filename is not None and os.path.exists(filename)):
+            with open(filename, 'r') as fh:
+                self.results = json.load(fh)
+
+    def save(self):
+        """Write cache to file, if there is one."""
+        if (self.filename is not None):
+            with open(self.filename, 'w') as fh:
+                json.dump(self.results, fh)
+
+    def __contains__(self, key):
+        """True if there is a result for content key."""
+        return( key in self.results )
+
+    def __getitem__(self, key):
+        """Result for content key."""
+        return( self.results[key] )
+
+    def __setitem__(self, key, error):
+        """Set result for content key."""
+        self.results[key] = error
+
+
+def validate_fragments(fragments, processes=None, cache=None):
+    """Validate fragments, return dict of errors indexed by content key.
+
+    fragments is either an iterable of XML fragment strings or a dict
+    of fragments indexed by content key, such as BlobStore.blobs. In
+    the second case keys are not calculated again and CompressedBlob
+    fragments are decompressed one at a time only if they need to be
+    checked. Fragments with a result in cache are not checked again,
+    new results are added to cache. Checking is done with a pool of
+    processes (default one per CPU) unless processes is 1 or there are
+    few fragments to check.
+    """
+    if (cache is None):
+        cache = ValidationCache()
+    if (not hasattr(fragments, 'items')):
+        fragments = dict((BlobStore.key(f), f) for f in fragments)
+    todo = [key for key in fragments if key not in cache]
+    logging.getLogger('oaipmh_simulator').info(
+        "Validating %d fragments (%d cached)" % (len(todo), len(fragments)-len(todo)))
+    todo_items = ((key, _uncached_text(fragments[key])) for key in todo)
+    if (processes == 1 or len(todo) < PARALLEL_THRESHOLD):
+        results = map(_check_keyed_fragment, todo_items)
+    else:
+        if (processes is None):
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.imap_unordered(_check_keyed_fragment, todo_items,
+                                          chunksize=max(1, len(todo) // (4 * processes)))
+            results = list(results)
+        finally:
+            pool.close()
+            pool.join()
+    for (key, error) in results:
+        cache[key] = error
+    errors = {}
+    for key in fragments:
+        if (cache[key] is not None):
+            errors[key] = cache[key]
+    return( errors )
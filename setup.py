@@ -63,7 +63,11 @@ setup(
     install_requires=[
         "defusedxml>=0.4.1",
         "flask>=0.10.1",
+        "futures; python_version < '3.2'",
     ],
+    extras_require={
+        'lxml': ["lxml"],
+    },
     test_suite="tests",
     cmdclass={
         'coverage': Coverage,
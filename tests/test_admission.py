@@ -0,0 +1,84 @@
+import unittest
+import threading
+import time
+from oaipmh_simulator.admission import TokenBucket, AdmissionController
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return( self.now )
+
+class TestAdmission(unittest.TestCase):
+
+    def test01_token_bucket(self):
+        b = TokenBucket(2, 3, 0.0)
+        self.assertTrue( b.take(0.0) )
+        self.assertTrue( b.take(0.0) )
+        self.assertTrue( b.take(0.0) )
+        self.assertFalse( b.take(0.0) )
+        self.assertEqual( b.wait_time(), 0.5 )
+        self.assertFalse( b.take(0.25) )
+        self.assertTrue( b.take(0.5) )
+        # never more than burst
+        b.refill(100.0)
+        self.assertEqual( b.tokens, 3.0 )
+
+    def test02_no_limits(self):
+        ac = AdmissionController()
+        for n in range(5):
+            self.assertEqual( ac.admit('c'), (True, None) )
+        self.assertEqual( ac.counters()['in_flight'], 5 )
+        for n in range(5):
+            ac.release()
+        self.assertEqual( ac.counters()['admitted'], 5 )
+        self.assertEqual( ac.counters()['in_flight'], 0 )
+
+    def test03_client_rate(self):
+        clock = FakeClock()
+        ac = AdmissionController(client_rate=1, client_burst=2, clock=clock)
+        self.assertEqual( ac.admit('a'), (True, None) )
+        self.assertEqual( ac.admit('a'), (True, None) )
+        self.assertEqual( ac.admit('a'), (False, 1) )
+        # other clients unaffected
+        self.assertEqual( ac.admit('b'), (True, None) )
+        clock.now += 1.0
+        self.assertEqual( ac.admit('a'), (True, None) )
+        c = ac.counters()
+        self.assertEqual( (c['admitted'], c['rejected'], c['rate_limited']), (4, 1, 1) )
+
+    def test04_max_clients(self):
+        clock = FakeClock()
+        ac = AdmissionController(client_rate=1, max_clients=2, clock=clock)
+        ac.admit('a')
+        ac.admit('b')
+        clock.now += 10
+        ac.admit('c')
+        self.assertEqual( sorted(ac.buckets.keys()), ['c'] )
+
+    def test05_queue(self):
+        ac = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5)
+        self.assertEqual( ac.admit(), (True, None) )
+        results = []
+        t = threading.Thread(target=lambda: results.append(ac.admit()))
+        t.start()
+        while (ac.counters()['waiting'] < 1):
+            time.sleep(0.001)
+        # queue is full
+        self.assertEqual( ac.admit(), (False, 5) )
+        ac.release()
+        t.join()
+        self.assertEqual( results, [(True, None)] )
+        c = ac.counters()
+        self.assertEqual( (c['admitted'], c['queued'], c['rejected'], c['in_flight']), (2, 1, 1, 1) )
+
+    def test06_queue_timeout(self):
+        ac = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.01, retry_after=7)
+        ac.admit()
+        self.assertEqual( ac.admit(), (False, 7) )
+        self.assertEqual( ac.counters()['waiting'], 0 )
+
+if __name__ == '__main__':
+    unittest.main()
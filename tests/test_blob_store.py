@@ -0,0 +1,59 @@
+import unittest
+import gzip
+import io
+from oaipmh_simulator.blob_store import BlobStore, CompressedBlob, HotCache, gzip_member, text
+
+class TestBlobStore(unittest.TestCase):
+
+    def test01_add(self):
+        bs = BlobStore()
+        self.assertEqual( len(bs), 0 )
+        self.assertEqual( bs.add(None), None )
+        b1 = bs.add( '<a>x</a>' )
+        self.assertEqual( b1, '<a>x</a>' )
+        # build equal string that is a different object
+        b2 = bs.add( ''.join(['<a>', 'x', '</a>']) )
+        self.assertTrue( b1 is b2 )
+        self.assertEqual( len(bs), 1 )
+        bs.add( '<a>y</a>' )
+        self.assertEqual( len(bs), 2 )
+        self.assertEqual( bs.get(BlobStore.key('<a>y</a>')), '<a>y</a>' )
+        self.assertEqual( bs.get('not-a-key'), None )
+
+    def test02_key(self):
+        self.assertEqual( BlobStore.key(''), 'da39a3ee5e6b4b0d3255bfef95601890afd80709' )
+
+    def test03_share(self):
+        bs = BlobStore()
+        self.assertEqual( bs.share(None), None )
+        s1 = bs.share( 'set-a' )
+        s2 = bs.share( ''.join(['set', '-a']) )
+        self.assertTrue( s1 is s2 )
+        # strings are not blobs
+        self.assertEqual( len(bs), 0 )
+
+    def test04_gzip_member(self):
+        data = gzip_member(b'<a>') + gzip_member(b'x') + gzip_member(b'</a>')
+        self.assertEqual( gzip.GzipFile(fileobj=io.BytesIO(data)).read(), b'<a>x</a>' )
+
+    def test05_compress(self):
+        bs = BlobStore(compress=True, cache_size=2)
+        blob = '<a>' + 'x' * 1000 + '\u00e9</a>'
+        b1 = bs.add( blob )
+        self.assertTrue( isinstance(b1, CompressedBlob) )
+        self.assertTrue( len(b1.member) < 100 )
+        self.assertTrue( bs.add( ''.join([blob]) ) is b1 )
+        self.assertEqual( text(b1), blob )
+        self.assertEqual( bs.get(BlobStore.key(blob)), blob )
+        self.assertEqual( text(None), None )
+        self.assertEqual( text('abc'), 'abc' )
+        # hot cache
+        self.assertEqual( (bs.cache.hits, bs.cache.misses), (1, 1) )
+        b2 = bs.add( '<b/>' )
+        b3 = bs.add( '<c/>' )
+        self.assertEqual( [text(b) for b in (b2, b3, b1)], ['<b/>', '<c/>', blob] )
+        self.assertEqual( len(bs.cache.entries), 2 )
+        self.assertEqual( bs.cache.misses, 4 )
+
+if __name__ == '__main__':
+    unittest.main()
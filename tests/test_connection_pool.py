@@ -0,0 +1,35 @@
+import unittest
+
+from oaipmh_simulator.connection_pool import ConnectionPool
+
+class FakeConnection(object):
+    closed = False
+    def close(self):
+        self.closed = True
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test01_init(self):
+        pool = ConnectionPool('https://example.org:8443/oai')
+        self.assertEqual( (pool.netloc, pool.path), ('example.org:8443', '/oai') )
+        self.assertEqual( pool.connection_class.__name__, 'HTTPSConnection' )
+        pool = ConnectionPool('http://example.org')
+        self.assertEqual( (pool.connection_class.__name__, pool.path), ('HTTPConnection', '/') )
+        conn = pool.get()
+        self.assertEqual( (conn.host, conn.port, conn.timeout), ('example.org', 80, 60) )
+
+    def test02_reuse(self):
+        pool = ConnectionPool('http://example.org/oai', size=2)
+        (c1, c2, c3) = (FakeConnection(), FakeConnection(), FakeConnection())
+        for conn in (c1, c2, c3):
+            pool.put(conn)
+        # Pool full so the last one is closed
+        self.assertEqual( [c.closed for c in (c1, c2, c3)], [False, False, True] )
+        # Most recently returned first
+        self.assertTrue( pool.get() is c2 )
+        pool.close()
+        self.assertTrue( c1.closed )
+        self.assertFalse( isinstance(pool.get(), FakeConnection) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+import os.path
+import shutil
+import tempfile
+from flask import Flask
+
+from oaipmh_simulator.crosswalk import FieldCrosswalk, TransformCrosswalk, crosswalk_from_cfg
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.repository import Repository, CannotDisseminateFormat
+from oaipmh_simulator.sqlite_storage import SQLiteStorage
+
+MODS = '<mods xmlns="http://www.loc.gov/mods/v3"><titleInfo><title>%s</title></titleInfo>' \
+       '<name><namePart>A &amp; B</namePart></name><name><namePart>C</namePart></name></mods>'
+
+def mods_record(n, datestamp, sets):
+    return( {"identifier": "item%d" % (n), "datestamp": datestamp, "metadataPrefix": "mods",
+             "metadata": MODS % ('Title %d' % (n)), "sets": sets} )
+
+CFG = { "repositoryName": "crosswalks",
+        "earliestDatestamp": "2000-01-01",
+        "crosswalks": {
+            "oai_dc": { "source": "mods",
+                        "namespaces": {"mods": "http://www.loc.gov/mods/v3",
+                                       "oai_dc": "http://www.openarchives.org/OAI/2.0/oai_dc/",
+                                       "dc": "http://purl.org/dc/elements/1.1/"},
+                        "root": "oai_dc:dc",
+                        "fields": [["mods:titleInfo/mods:title", "dc:title"],
+                                   ["mods:name/mods:namePart", "dc:creator"]] },
+            "upper": { "source": "mods",
+                       "transform": "tests.test_crosswalk:upper" } },
+        "records": [ mods_record(1, "2001-01-01", ["a"]),
+                     mods_record(2, "2002-01-01", ["a", "b"]),
+                     { "identifier": "item2", "datestamp": "2002-06-01", "metadataPrefix": "oai_dc",
+                       "metadata": "<dc>stored</dc>" },
+                     mods_record(3, "2003-01-01", ["b"]),
+                     { "identifier": "item4", "datestamp": "2001-06-01", "metadataPrefix": "oai_dc",
+                       "metadata": "<dc>only dc</dc>" },
+                     { "identifier": "item5", "datestamp": "2004-01-01", "metadataPrefix": "mods",
+                       "status": "deleted" } ] }
+
+def upper(metadata):
+    return( metadata.upper() )
+
+class TestCrosswalk(unittest.TestCase):
+
+    def test01_field_crosswalk(self):
+        cw = crosswalk_from_cfg('oai_dc', CFG['crosswalks']['oai_dc'])
+        self.assertTrue( isinstance(cw, FieldCrosswalk) )
+        self.assertEqual( cw.transform(MODS % 'x &lt; y'),
+                          '<oai_dc:dc xmlns:dc="http://purl.org/dc/elements/1.1/" '
+                          'xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/">'
+                          '<dc:title>x &lt; y</dc:title><dc:creator>A &amp; B</dc:creator>'
+                          '<dc:creator>C</dc:creator></oai_dc:dc>' )
+        self.assertTrue( cw.transform('<bad').endswith('"></oai_dc:dc>') )
+        cw = crosswalk_from_cfg('upper', CFG['crosswalks']['upper'])
+        self.assertTrue( isinstance(cw, TransformCrosswalk) )
+        self.assertEqual( cw.transform('<a/>'), '<A/>' )
+        self.assertRaises( ValueError, crosswalk_from_cfg, 'x', {'source': 'mods'} )
+        self.assertRaises( ValueError, crosswalk_from_cfg, 'x', {'source': 'mods', 'transform': 'tests.nope:f'} )
+
+    def check_repository(self, repo):
+        self.assertEqual( repo.metadata_formats(), ['mods', 'oai_dc', 'upper'] )
+        r = repo.select_record('item1', 'oai_dc')
+        self.assertEqual( (r.identifier, r.metadataPrefix, r.datestamp, r.set_specs),
+                          ('item1', 'oai_dc', '2001-01-01', ['a']) )
+        self.assertTrue( '<dc:title>Title 1</dc:title>' in r.metadata )
+        self.assertEqual( repo.select_record('item1', 'upper').metadata, (MODS % 'Title 1').upper() )
+        # Stored record wins
+        self.assertEqual( repo.select_record('item2', 'oai_dc').metadata, '<dc>stored</dc>' )
+        self.assertRaises( CannotDisseminateFormat, repo.select_record, 'item4', 'upper' )
+        # Deleted
+        self.assertEqual( repo.select_record('item5', 'oai_dc').metadata, None )
+        self.assertEqual( repo.select_record('item5', 'oai_dc').status, 'deleted' )
+        self.assertEqual( repo.select_item('item1').metadata_formats(), ['mods', 'oai_dc', 'upper'] )
+        self.assertEqual( repo.select_item('item4').metadata_formats(), ['oai_dc'] )
+        # Selections merge stored and crosswalked records, in pages
+        ids = lambda records: [(r.identifier, r.datestamp) for r in records]
+        all_dc = [('item1', '2001-01-01'), ('item4', '2001-06-01'), ('item2', '2002-06-01'),
+                  ('item3', '2003-01-01'), ('item5', '2004-01-01')]
+        self.assertEqual( ids(repo.select_records(metadataPrefix='oai_dc')), all_dc )
+        self.assertEqual( ids(repo.select_records(metadataPrefix='oai_dc', limit=2)), all_dc[:2] )
+        after = repo.select_records(metadataPrefix='oai_dc', limit=2)[-1]
+        self.assertEqual( ids(repo.select_records(metadataPrefix='oai_dc', limit=2,
+                                                  after=(after.ds.datetime, after.identifier))),
+                          all_dc[2:4] )
+        self.assertEqual( ids(repo.select_records(metadataPrefix='oai_dc', set='b')), all_dc[2:4] )
+        self.assertEqual( ids(repo.select_records(metadataPrefix='upper', **{'from': '2002-01-01'})),
+                          [('item2', '2002-01-01'), ('item3', '2003-01-01'), ('item5', '2004-01-01')] )
+
+    def test02_repository(self):
+        self.check_repository( Repository( cfg=CFG ) )
+
+    def test03_sqlite(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            repo = Repository( cfg=CFG, storage=SQLiteStorage(os.path.join(tmpdir, 'repo.db')) )
+            self.check_repository( repo )
+            # Settings stored with crosswalks
+            self.check_repository( Repository( storage=SQLiteStorage(os.path.join(tmpdir, 'repo.db')) ) )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test04_memo(self):
+        repo = Repository( cfg=CFG )
+        memo = repo.crosswalks.memo
+        memo.size = 2
+        for n in range(3):
+            repo.select_record('item1', 'oai_dc').metadata
+        self.assertEqual( (memo.hits, memo.misses), (2, 1) )
+        repo.select_record('item3', 'oai_dc').metadata
+        repo.select_record('item1', 'upper').metadata
+        self.assertEqual( len(memo), 2 )
+        # Changed source record is crosswalked again
+        repo.add_records([dict(mods_record(3, "2005-01-01", ["b"]), metadata=MODS % 'New')])
+        self.assertTrue( 'New' in repo.select_record('item3', 'oai_dc').metadata )
+        self.assertEqual( memo.misses, 4 )
+        # Prewarm
+        memo.size = 10
+        repo.prewarm_crosswalks(workers=2).shutdown(wait=True)
+        self.assertEqual( len(memo), 5 ) # item1,3 in both, item2 in upper
+        hits = memo.hits
+        repo.select_record('item2', 'upper').metadata
+        self.assertEqual( memo.hits, hits + 1 )
+
+    def test05_responses(self):
+        app = Flask(__name__)
+        app.config['base_url'] = 'http://example.org/oai'
+        app.config['page_size'] = 2
+        app.config['repo'] = Repository( cfg=CFG )
+        with app.app_context():
+            data = OAI_PMH_Handler(app).handle({'verb': 'GetRecord', 'identifier': 'item3',
+                                                'metadataPrefix': 'oai_dc'}).get_data()
+            self.assertTrue( b'<metadata><oai_dc:dc xmlns:dc=' in data )
+            data = OAI_PMH_Handler(app).handle({'verb': 'ListMetadataFormats',
+                                                'identifier': 'item3'}).get_data()
+            self.assertTrue( b'<metadataPrefix>upper</metadataPrefix>' in data )
+            data = OAI_PMH_Handler(app).handle({'verb': 'ListIdentifiers',
+                                                'metadataPrefix': 'oai_dc'}).get_data()
+            self.assertTrue( b'<identifier>item4</identifier>' in data )
+            self.assertTrue( b'</resumptionToken>' in data )
@@ -0,0 +1,74 @@
+import unittest
+from flask import Flask
+
+from oaipmh_simulator.envelope import ResponseDate, Envelope, escape_attribute, get_envelope, response_date
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.repository import Repository
+from tests.test_repository import CFG1
+
+START = ("<?xml version='1.0' encoding='utf-8'?>\n"
+         '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" '
+         'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+         'xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ '
+         'http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd"><responseDate>')
+
+class TestEnvelope(unittest.TestCase):
+
+    def test01_response_date(self):
+        now = [1234567890.2]
+        rd = ResponseDate(clock=lambda: now[0])
+        self.assertEqual( rd(), '2009-02-13T23:31:30Z' )
+        last = rd.last
+        now[0] = 1234567890.9
+        self.assertEqual( rd(), '2009-02-13T23:31:30Z' )
+        self.assertTrue( rd.last is last )
+        now[0] = 1234567891.0
+        self.assertEqual( rd(), '2009-02-13T23:31:31Z' )
+        self.assertEqual( len(response_date()), 20 )
+
+    def test02_escape_attribute(self):
+        self.assertEqual( escape_attribute('abc'), 'abc' )
+        self.assertEqual( escape_attribute('a<b>&"\t\n\r'), 'a&lt;b&gt;&amp;&quot;&#09;&#10;&#13;' )
+
+    def test03_envelope(self):
+        e = Envelope('http://example.org/oai?a&b')
+        self.assertEqual( e.wrap('<x />', date='D'),
+                          START + 'D</responseDate><request>http://example.org/oai?a&amp;b</request>'
+                          '<x /></OAI-PMH>' )
+        e = Envelope('http://example.org/oai', 'ListRecords', ('metadataPrefix', 'set'))
+        self.assertEqual( e.start(['oai_dc', 'a"b'], 'D'),
+                          START + 'D</responseDate><request verb="ListRecords" metadataPrefix="oai_dc" '
+                          'set="a&quot;b">http://example.org/oai</request>' )
+        # Kept by verb and argument names, values in ARGUMENT_ORDER
+        (e1, values) = get_envelope('http://example.org/oai', 'GetRecord',
+                                    {'metadataPrefix': 'oai_dc', 'identifier': 'i1'})
+        self.assertEqual( (e1.names, values), (('identifier', 'metadataPrefix'), ['i1', 'oai_dc']) )
+        (e2, values) = get_envelope('http://example.org/oai', 'GetRecord',
+                                    {'metadataPrefix': 'x', 'identifier': 'i2'})
+        self.assertTrue( e1 is e2 )
+        self.assertEqual( values, ['i2', 'x'] )
+        (e3, values) = get_envelope('http://example.org/oai', None, {'identifier': 'i1'})
+        self.assertEqual( (e3.names, values), ((), ()) )
+
+    def test04_responses(self):
+        app = Flask(__name__)
+        app.config['base_url'] = 'http://example.org/oai'
+        app.config['repo'] = Repository( cfg=CFG1 )
+        def request_element(args):
+            with app.app_context():
+                data = OAI_PMH_Handler(app).handle(args).get_data().decode('utf-8')
+            return( data[data.index('<request'):data.index('</request>')] )
+        self.assertEqual( request_element({'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc',
+                                           'from': '2000-01-01'}),
+                          '<request verb="ListIdentifiers" metadataPrefix="oai_dc" from="2000-01-01">'
+                          'http://example.org/oai' )
+        # Arguments are echoed for errors other than badVerb and badArgument
+        self.assertEqual( request_element({'verb': 'GetRecord', 'identifier': 'nope',
+                                           'metadataPrefix': 'oai_dc'}),
+                          '<request verb="GetRecord" identifier="nope" metadataPrefix="oai_dc">'
+                          'http://example.org/oai' )
+        self.assertEqual( request_element({'verb': 'ListRecords', 'resumptionToken': 'bad'}),
+                          '<request verb="ListRecords" resumptionToken="bad">http://example.org/oai' )
+        for args in ({'verb': 'Nope'}, {'verb': 'Identify', 'x': '1'},
+                     {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'from': 'bad'}):
+            self.assertEqual( request_element(args), '<request>http://example.org/oai' )
@@ -0,0 +1,117 @@
+import unittest
+try:
+    import unittest.mock as mock
+except:
+    import mock
+from flask import Flask, Request
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from oaipmh_simulator.admission import AdmissionController
+from oaipmh_simulator.envelope import response_date
+from oaipmh_simulator.fast_path import FastPath, escape, text_element, parse_query
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.repository import Repository
+from tests.test_repository import CFG1
+
+QUERIES = [ 'verb=Identify',
+            'verb=Identify&verb=GetRecord',
+            'verb=Identify&x=1',
+            'verb=Bad',
+            'verb=Bad&x=1',
+            'verb=',
+            '',
+            'x=1',
+            'verb=ListMetadataFormats',
+            'verb=ListMetadataFormats&identifier=item1',
+            'verb=ListMetadataFormats&identifier=nope',
+            'verb=GetRecord&identifier=item1&metadataPrefix=oai_dc',
+            'verb=GetRecord&identifier=item1&metadataPrefix=oai_dc&identifier=item2',
+            'verb=GetRecord&identifier=item3&metadataPrefix=oai_dc',
+            'verb=GetRecord&identifier=item1&metadataPrefix=nope',
+            'verb=GetRecord&identifier=a%09b%0Dc%3C%3E%26%22&metadataPrefix=oai_dc',
+            'verb=GetRecord&identifier=%3Cb%3E',
+            'verb=ListRecords&metadataPrefix=oai_dc',
+            'verb=ListRecords&metadataPrefix=oai_dc&resumptionToken=abc',
+            'verb=ListSets' ]
+
+class TestFastPath(unittest.TestCase):
+
+    def setUp(self):
+        # Same responseDate in responses that are compared
+        patcher = mock.patch.object(response_date, 'clock', lambda: 1234567890)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = Flask(__name__)
+        self.app.config['base_url'] = 'http://example.org/oai'
+        self.app.config['path'] = '/oai'
+        self.app.config['repo'] = Repository( cfg=CFG1 )
+        self.app.config['repos'] = { 'r1': self.app.config['repo'] }
+        # Requests not handled by the fast path get an empty response
+        self.passed = []
+        def wsgi_app(environ, start_response):
+            self.passed.append( environ['PATH_INFO'] )
+            start_response('200 OK', [])
+            return( [b''] )
+        self.fast = Client(FastPath(self.app, wsgi_app), Response)
+
+    def expected(self, repo_name, query):
+        """Response data from OAI_PMH_Handler for query as from Flask."""
+        args = Request.from_values(query_string=query).args
+        with self.app.app_context():
+            return( OAI_PMH_Handler(self.app, repo_name).handle(args).get_data() )
+
+    def test01_escape(self):
+        self.assertEqual( escape('a<b>&c"\t'), 'a&lt;b&gt;&amp;c"\t' )
+        self.assertEqual( text_element('a', None), '' )
+        self.assertEqual( text_element('a', ''), '<a />' )
+        self.assertEqual( text_element('a', '<'), '<a>&lt;</a>' )
+        self.assertEqual( parse_query('verb=a&verb=b&x=%C3%A9&y='),
+                          {'verb': 'a', 'x': u'\u00e9', 'y': ''} )
+
+    def test02_same_responses(self):
+        for (path, repo_name) in (('/oai', None), ('/oai/r1', 'r1')):
+            for query in QUERIES:
+                rv = self.fast.get(path, query_string=query)
+                if (rv.data != b''):
+                    self.assertEqual( rv.data, self.expected(repo_name, query) )
+                    self.assertEqual( rv.headers['Content-Type'], 'application/xml' )
+        # Only the valid list verb requests went to Flask
+        self.assertEqual( self.passed, ['/oai'] * 2 + ['/oai/r1'] * 2 )
+        # Prebuilt responses follow changes in the repository
+        repo = self.app.config['repo']
+        rv = self.fast.get('/oai', query_string='verb=ListMetadataFormats')
+        self.assertFalse( b'<metadataPrefix>yyy</metadataPrefix>' in rv.data )
+        repo.add_records([{"identifier": "item9", "datestamp": "2009-01-01",
+                           "metadataPrefix": "yyy", "metadata": "<y/>"}])
+        rv = self.fast.get('/oai', query_string='verb=ListMetadataFormats')
+        self.assertTrue( b'<metadataPrefix>yyy</metadataPrefix>' in rv.data )
+
+    def test03_passed_to_flask(self):
+        self.fast.get('/')
+        self.fast.get('/oai/nope', query_string='verb=Identify')
+        self.fast.post('/oai', data={'verb': 'Identify'})
+        self.app.config['gzip'] = True
+        self.fast.get('/oai', query_string='verb=Identify', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual( self.passed, ['/', '/oai/nope', '/oai', '/oai'] )
+
+    def test04_admission(self):
+        self.app.config['admission'] = AdmissionController(client_rate=0.001, client_burst=1)
+        self.assertEqual( self.fast.get('/oai', query_string='verb=Identify').status_code, 200 )
+        rv = self.fast.get('/oai', query_string='verb=Identify')
+        self.assertEqual( rv.status_code, 503 )
+        self.assertTrue( int(rv.headers['Retry-After']) > 0 )
+
+    def test05_request_during_change(self):
+        # A request made while storage is being changed is not kept
+        # once the change is made
+        repo = self.app.config['repo']
+        add_records = repo.storage.add_records
+        def racing_add_records(records, blob_store):
+            self.fast.get('/oai', query_string='verb=ListMetadataFormats')
+            add_records(records, blob_store)
+        repo.storage.add_records = racing_add_records
+        repo.add_records([{"identifier": "item9", "datestamp": "2009-01-01",
+                           "metadataPrefix": "zzz", "metadata": "<z/>"}])
+        rv = self.fast.get('/oai', query_string='verb=ListMetadataFormats')
+        self.assertTrue( b'<metadataPrefix>zzz</metadataPrefix>' in rv.data )
@@ -2,6 +2,9 @@
 
 See http://flask.pocoo.org/docs/0.10/testing/#testing for testing intro.
 """
+import gzip
+import io
+import re
 import unittest
 from xml.etree.ElementTree import Element, dump
 try:
@@ -9,18 +12,35 @@ try:
 except:
     import mock
 
-from oaipmh_simulator.flask_app import get_flask_app, index_handler, oaipmh_baseurl_handler, OAI_PMH_Handler 
+from oaipmh_simulator.flask_app import get_flask_app, index_handler, oaipmh_baseurl_handler, bulk_get_record_handler, OAI_PMH_Handler, single_flight
+from oaipmh_simulator.admission import AdmissionController
+from oaipmh_simulator.blob_store import BlobStore
+from oaipmh_simulator.envelope import response_date
+from oaipmh_simulator.repository import Repository
+from tests.test_repository import CFG1
 
 class TestFlaskApp(unittest.TestCase):
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
+        # Flask does not allow rules to be added after the first request
         app = get_flask_app()
         app.add_url_rule('/', view_func=index_handler)
         app.add_url_rule('/oai' , view_func=oaipmh_baseurl_handler)
+        app.add_url_rule('/oai/bulk', methods=("POST",), view_func=bulk_get_record_handler)
+        app.add_url_rule('/multi/<repo_name>' , view_func=oaipmh_baseurl_handler)
         app.config['TESTING'] = True
         app.config['no_post'] = False
         app.config['base_url'] = 'http://example.org/oai'
-        self.app = app.test_client()
+        app.config['repo'] = Repository( cfg=CFG1 )
+        app.config['repos'] = { 'r1': app.config['repo'] }
+
+    def setUp(self):
+        self.app = get_flask_app().test_client()
+        # Same responseDate in responses that are compared
+        patcher = mock.patch.object(response_date, 'clock', lambda: 1234567890)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test01_base_tree(self):
         config = { 'base_url': 'http://example.org/abc',
@@ -28,12 +48,24 @@ class TestFlaskApp(unittest.TestCase):
         app = mock.Mock( config=config )
         h = OAI_PMH_Handler( app )
         h.base_tree( 'VerbyVerb' )
-        self.assertEqual( h.root.findtext('request'), 'http://example.org/abc' )
-        self.assertEqual( h.root.find('request').attrib['verb'], 'VerbyVerb' )
+        xml = h.serialize_tree()
+        self.assertTrue( xml.startswith("<?xml version='1.0' encoding='utf-8'?>\n<OAI-PMH ") )
+        self.assertTrue( '<responseDate>2009-02-13T23:31:30Z</responseDate>' in xml )
+        self.assertTrue( xml.endswith('<request verb="VerbyVerb">http://example.org/abc</request></OAI-PMH>') )
         app.config['base_url'] = 'http://example.org/ab1'
         h.base_tree( None )
-        self.assertEqual( h.root.findtext('request'), 'http://example.org/ab1' )
-        self.assertFalse( 'verb' in h.root.find('request').attrib )
+        self.assertTrue( '<request>http://example.org/ab1</request>' in h.serialize_tree() )
+        # request arguments are echoed
+        h.arguments = { 'metadataPrefix': 'oai_dc', 'identifier': 'a"b' }
+        h.base_tree( 'GetRecord' )
+        self.assertTrue( '<request verb="GetRecord" identifier="a&quot;b" metadataPrefix="oai_dc">'
+                         'http://example.org/ab1</request>' in h.serialize_tree() )
+        # handler for one of several repositories
+        config['repos'] = { 'r1': 'REPO1' }
+        h = OAI_PMH_Handler( app, 'r1' )
+        self.assertEqual( h.repo, 'REPO1' )
+        h.base_tree( 'Identify' )
+        self.assertTrue( '<request verb="Identify">http://example.org/ab1/r1</request>' in h.serialize_tree() )
 
     def test02_add_header(self):
         h = OAI_PMH_Handler()
@@ -63,9 +95,177 @@ class TestFlaskApp(unittest.TestCase):
         m1 = h.root.find('metadata')
         self.assertEqual( m1.text, '#-#-#-#-#--SUB--1--#-#-#-#-#' )
 
+    def test04_pinned_generation(self):
+        app = get_flask_app()
+        app.config['page_size'] = 1
+        app.config['no_coalesce'] = True
+        repo = Repository( cfg=CFG1 )
+        app.config['repos'] = { 'r1': app.config['repo'], 'r2': repo }
+        try:
+            rv = self.app.get('/multi/r2?verb=ListIdentifiers&metadataPrefix=oai_dc')
+            self.assertTrue( b'<identifier>item1</identifier>' in rv.data )
+            self.assertTrue( b'expirationDate="' in rv.data )
+            token = re.search(r'>([^<]+)</resumptionToken>', rv.data.decode('utf-8')).group(1)
+            token = token.replace('&amp;', '&')
+            # A change does not show up in the pages of the token
+            repo.add_records([ { "identifier": "item1b", "datestamp": "2001-06-01",
+                                 "metadataPrefix": "oai_dc" } ])
+            rv = self.app.get('/multi/r2', query_string={'verb': 'ListIdentifiers', 'resumptionToken': token})
+            self.assertTrue( b'<identifier>item2</identifier>' in rv.data )
+            # but a new list sees it
+            rv = self.app.get('/multi/r2?verb=ListIdentifiers&metadataPrefix=oai_dc&from=2001-02-01')
+            self.assertTrue( b'<identifier>item1b</identifier>' in rv.data )
+            # Expired generation
+            repo.storage.leases.clear()
+            repo.storage.gc()
+            rv = self.app.get('/multi/r2', query_string={'verb': 'ListIdentifiers', 'resumptionToken': token})
+            self.assertTrue( b'badResumptionToken' in rv.data )
+        finally:
+            app.config['repos'] = { 'r1': app.config['repo'] }
+            del app.config['page_size']
+            app.config['no_coalesce'] = False
+
+    def test05_gzip(self):
+        app = get_flask_app()
+        app.config['no_coalesce'] = True
+        repo = Repository( cfg=CFG1, blob_store=BlobStore(compress=True) )
+        app.config['repos'] = { 'r1': app.config['repo'], 'r2': repo }
+        try:
+            url = '/multi/r2?verb=ListRecords&metadataPrefix=oai_dc'
+            plain = self.app.get(url)
+            self.assertEqual( plain.headers.get('Content-Encoding'), None )
+            self.assertTrue( b'<md>item2_oai_dc</md>' in plain.data )
+            # not enabled
+            rv = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual( rv.headers.get('Content-Encoding'), None )
+            app.config['gzip'] = True
+            cache = repo.blob_store.cache
+            (hits, misses) = (cache.hits, cache.misses)
+            rv = self.app.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual( rv.headers['Content-Encoding'], 'gzip' )
+            self.assertEqual( gzip.GzipFile(fileobj=io.BytesIO(rv.data)).read(), plain.data )
+            # compressed metadata is passed through, never decompressed
+            self.assertEqual( (cache.hits, cache.misses), (hits, misses) )
+            # not accepted
+            rv = self.app.get(url, headers={'Accept-Encoding': 'identity'})
+            self.assertEqual( rv.data, plain.data )
+        finally:
+            app.config['repos'] = { 'r1': app.config['repo'] }
+            app.config['gzip'] = False
+            app.config['no_coalesce'] = False
+
     def test10_homepage(self):
         rv = self.app.get('/')
         assert b'<a href="http://example.org/oai">' in rv.data
+        assert b'<a href="http://example.org/oai/r1">' in rv.data
+
+    def test11_multiple_repositories(self):
+        rv = self.app.get('/multi/r1?verb=Identify')
+        self.assertTrue( b'<baseURL>http://example.org/oai/r1</baseURL>' in rv.data )
+        rv = self.app.get('/multi/r2?verb=Identify')
+        self.assertEqual( rv.status_code, 404 )
+
+    def test12_coalesce(self):
+        leaders = single_flight.leaders
+        rv = self.app.get('/oai?verb=ListIdentifiers&metadataPrefix=oai_dc')
+        self.assertTrue( b'<identifier>item2</identifier>' in rv.data )
+        self.assertEqual( rv.headers['Content-type'], 'application/xml' )
+        self.assertEqual( single_flight.leaders, leaders + 1 )
+        get_flask_app().config['no_coalesce'] = True
+        try:
+            rv2 = self.app.get('/oai?verb=ListIdentifiers&metadataPrefix=oai_dc')
+        finally:
+            get_flask_app().config['no_coalesce'] = False
+        self.assertEqual( rv2.data, rv.data )
+        self.assertEqual( single_flight.leaders, leaders + 1 )
+        # errors are shared responses too
+        rv = self.app.get('/oai?verb=Bogus')
+        self.assertTrue( b'<error code="badVerb">' in rv.data )
+
+    def test13_admission(self):
+        app = get_flask_app()
+        app.config['admission'] = AdmissionController(client_rate=0.001, client_burst=1)
+        try:
+            rv = self.app.get('/oai?verb=Identify')
+            self.assertEqual( rv.status_code, 200 )
+            rv = self.app.get('/oai?verb=Identify')
+            self.assertEqual( rv.status_code, 503 )
+            self.assertEqual( rv.headers['Retry-After'], '1000' )
+            rv = self.app.get('/')
+            self.assertTrue( b'<tr><td>rejected</td><td>1</td></tr>' in rv.data )
+        finally:
+            del app.config['admission']
+
+    def test14_bulk_get_record(self):
+        rv = self.app.post('/oai/bulk?metadataPrefix=oai_dc',
+                           data="item1\nitem2\n\nitem4\n",
+                           content_type='text/plain')
+        self.assertEqual( rv.status_code, 200 )
+        self.assertTrue( b'<request verb="BulkGetRecord">' in rv.data )
+        self.assertTrue( b'<md>item1_oai_dc</md>' in rv.data )
+        self.assertTrue( b'<md>item2_oai_dc</md>' in rv.data )
+        self.assertTrue( b'<error code="idDoesNotExist" identifier="item4">' in rv.data )
+        self.assertTrue( rv.data.endswith(b'</BulkGetRecord></OAI-PMH>') )
+        # identifiers as form parameter, format only for item1
+        rv = self.app.post('/oai/bulk', data={'metadataPrefix': 'xxx',
+                                              'identifiers': "item1\nitem2"})
+        self.assertTrue( b'<md>item1_xxx</md>' in rv.data )
+        self.assertTrue( b'<error code="cannotDisseminateFormat" identifier="item2">' in rv.data )
+        # identifiers as uploaded file
+        rv = self.app.post('/oai/bulk', data={'metadataPrefix': 'oai_dc',
+                                              'identifiers': (io.BytesIO(b"item2\nitem1\n"), 'ids.txt')},
+                           content_type='multipart/form-data')
+        self.assertEqual( rv.status_code, 200 )
+        self.assertTrue( b'<md>item1_oai_dc</md>' in rv.data )
+        self.assertTrue( b'<md>item2_oai_dc</md>' in rv.data )
+        self.assertTrue( rv.data.endswith(b'</BulkGetRecord></OAI-PMH>') )
+        # missing metadataPrefix
+        rv = self.app.post('/oai/bulk', data="item1")
+        self.assertTrue( b'<error code="badArgument">' in rv.data )
+
+    def test15_bulk_get_record_compressed(self):
+        app = get_flask_app()
+        repo = Repository( cfg=CFG1, blob_store=BlobStore(compress=True) )
+        app.config['repos'] = { 'r1': app.config['repo'], 'r2': repo }
+        try:
+            with app.app_context():
+                xml = ''.join(OAI_PMH_Handler( app, 'r2' ).bulk_get_record(['item1', 'item2'], 'oai_dc'))
+            self.assertTrue( '<md>item2_oai_dc</md>' in xml )
+            # each record decompressed just once, to be written out
+            cache = repo.blob_store.cache
+            self.assertEqual( (cache.hits, cache.misses), (0, 2) )
+        finally:
+            app.config['repos'] = { 'r1': app.config['repo'] }
+
+    def test16_pinned_before_select(self):
+        app = get_flask_app()
+        app.config['page_size'] = 1
+        app.config['no_coalesce'] = True
+        repo = Repository( cfg=CFG1 )
+        app.config['repos'] = { 'r1': app.config['repo'], 'r2': repo }
+        select_records = repo.select_records
+        def change_then_select(**args):
+            # A change and gc() while the first page is being selected
+            if (args.get('after') is None):
+                repo.add_records([ { "identifier": "item2", "datestamp": "2010-01-01",
+                                     "metadataPrefix": "oai_dc", "metadata": "<md>new</md>" } ])
+                repo.storage.gc()
+            return( select_records(**args) )
+        try:
+            with mock.patch.object(repo, 'select_records', change_then_select):
+                rv = self.app.get('/multi/r2?verb=ListRecords&metadataPrefix=oai_dc')
+                self.assertTrue( b'<identifier>item1</identifier>' in rv.data )
+                self.assertTrue( b'expirationDate="' in rv.data )
+                token = re.search(r'>([^<]+)</resumptionToken>', rv.data.decode('utf-8')).group(1)
+                token = token.replace('&amp;', '&')
+                # Next page still from the generation the first page was selected from
+                rv = self.app.get('/multi/r2', query_string={'verb': 'ListRecords', 'resumptionToken': token})
+                self.assertTrue( b'<identifier>item2</identifier>' in rv.data )
+                self.assertTrue( b'<md>item2_oai_dc</md>' in rv.data )
+        finally:
+            app.config['repos'] = { 'r1': app.config['repo'] }
+            del app.config['page_size']
+            app.config['no_coalesce'] = False
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import threading
+try:
+    import unittest.mock as mock
+except:
+    import mock
+from werkzeug.serving import make_server
+
+from oaipmh_simulator.flask_app import get_flask_app, oaipmh_baseurl_handler
+from oaipmh_simulator.harvester import Harvester, HarvestError, set_partitions, date_partitions, canonical_metadata, verify_stream
+from oaipmh_simulator.repository import Repository
+from oaipmh_simulator.scaling_report import generate_cfg
+
+class TestHarvester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        app = get_flask_app()
+        if ('/oai' not in [r.rule for r in app.url_map.iter_rules()]):
+            app.add_url_rule('/oai' , view_func=oaipmh_baseurl_handler)
+        cls.saved_config = dict(app.config)
+        app.config['no_post'] = False
+        app.config['base_url'] = 'http://example.org/oai'
+        app.config['page_size'] = 7
+        cls.repo = Repository( cfg=generate_cfg(100, formats=['oai_dc','xxx'], num_sets=4) )
+        app.config['repo'] = cls.repo
+        cls.server = make_server('127.0.0.1', 0, app, threaded=True)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.base_url = 'http://127.0.0.1:%d/oai' % (cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        app = get_flask_app()
+        app.config.clear()
+        app.config.update(cls.saved_config)
+
+    def test01_partitions(self):
+        streams = set_partitions(self.repo, 'oai_dc')
+        self.assertEqual( len(streams), 5 )
+        self.assertEqual( streams[1], {'metadataPrefix': 'oai_dc', 'set': 'set0'} )
+        streams = date_partitions('xxx', '2000-01-01', '2000-01-10', 3)
+        self.assertEqual( streams, [{'metadataPrefix': 'xxx', 'until': '2000-01-03'},
+                                    {'metadataPrefix': 'xxx', 'from': '2000-01-04', 'until': '2000-01-06'},
+                                    {'metadataPrefix': 'xxx', 'from': '2000-01-07'}] )
+        self.assertEqual( len(date_partitions('xxx', '2000-01-01', '2000-01-02', 5)), 2 )
+        streams = date_partitions('xxx', '2000-01-01', '2000-01-10', 2, 'YYYY-MM-DDThh:mm:ssZ')
+        self.assertEqual( streams, [{'metadataPrefix': 'xxx', 'until': '2000-01-05T23:59:59Z'},
+                                    {'metadataPrefix': 'xxx', 'from': '2000-01-06T00:00:00Z'}] )
+
+    def test02_canonical_metadata(self):
+        self.assertEqual( canonical_metadata(None), None )
+        self.assertEqual( canonical_metadata('<a xmlns="http://example.org/a">b</a>'),
+                          b'<ns0:a xmlns:ns0="http://example.org/a">b</ns0:a>' )
+
+    def test03_harvest(self):
+        h = Harvester(self.base_url, pool_size=2)
+        records = list(h.harvest('ListRecords', metadataPrefix='oai_dc'))
+        self.assertEqual( len(records), 100 )
+        self.assertEqual( h.requests, 15 )
+        (n, problems) = verify_stream(self.repo, {'metadataPrefix': 'oai_dc'}, records)
+        self.assertEqual( (n, problems), (100, []) )
+        headers = list(h.harvest('ListIdentifiers', metadataPrefix='xxx', set='set1'))
+        self.assertEqual( len(headers), 25 )
+        self.assertEqual( headers[0].metadata, None )
+        self.assertEqual( verify_stream(self.repo, {'metadataPrefix': 'xxx', 'set': 'set1'}, headers),
+                          (25, []) )
+        # noRecordsMatch is an empty list
+        self.assertEqual( list(h.harvest('ListRecords', metadataPrefix='zzz')), [] )
+        # other errors raise
+        self.assertRaises( HarvestError, list, h.harvest('ListRecords') )
+
+    def test04_verify_problems(self):
+        h = Harvester(self.base_url)
+        records = list(h.harvest('ListIdentifiers', metadataPrefix='oai_dc', set='set2'))
+        (n, problems) = verify_stream(self.repo, {'metadataPrefix': 'oai_dc', 'set': 'set3'}, records)
+        self.assertEqual( n, 25 )
+        self.assertTrue( 'record 1 is oai:example.org:item' in problems[0] )
+        (n, problems) = verify_stream(self.repo, {'metadataPrefix': 'oai_dc'}, records[:3])
+        self.assertTrue( 'got 3 records, expected 100' in problems[-1] )
+
+    def test05_harvest_streams(self):
+        h = Harvester(self.base_url, pool_size=4)
+        streams = set_partitions(self.repo, 'oai_dc') + \
+                  date_partitions('xxx', '2000-01-01', '2020-12-31', 6)
+        results = h.harvest_streams(streams, threads=4,
+                                    consumer=lambda s, r: verify_stream(self.repo, s, r))
+        self.assertEqual( [n for (n, p) in results[:5]], [100, 25, 25, 25, 25] )
+        self.assertEqual( sum([n for (n, p) in results[5:]]), 100 )
+        self.assertEqual( [p for (n, p) in results], [[]] * len(streams) )
+        self.assertEqual( h.records, 300 )
+
+    def test06_retry_after(self):
+        app = get_flask_app()
+        class Refuse(object):
+            # Refuses the first two requests
+            refused = 0
+            def admit(self, client):
+                if (self.refused < 2):
+                    self.refused += 1
+                    return( (False, 3) )
+                return( (True, 0) )
+            def release(self):
+                pass
+        app.config['admission'] = Refuse()
+        try:
+            h = Harvester(self.base_url)
+            with mock.patch('oaipmh_simulator.harvester.time.sleep') as sleep:
+                self.assertEqual( len(list(h.harvest('ListIdentifiers', metadataPrefix='oai_dc'))), 100 )
+                self.assertEqual( h.granularity(), 'YYYY-MM-DD' )
+            self.assertEqual( [c[0] for c in sleep.call_args_list], [(3,), (3,)] )
+            self.assertEqual( h.retries, 2 )
+            # Still refused after max_retries is an error
+            app.config['admission'].refused = 0
+            h = Harvester(self.base_url, max_retries=1)
+            with mock.patch('oaipmh_simulator.harvester.time.sleep'):
+                self.assertRaises( HarvestError, list, h.harvest('ListIdentifiers', metadataPrefix='oai_dc') )
+        finally:
+            del app.config['admission']
+
+    def test07_partitions_cover(self):
+        # One record a day at noon, every one in exactly one range
+        records = [{'identifier': 'item%d' % (day), 'datestamp': '2000-01-%02dT12:00:00Z' % (day),
+                    'metadataPrefix': 'oai_dc', 'metadata': '<md/>'} for day in range(1, 11)]
+        for (granularity, datestamp) in (('YYYY-MM-DDThh:mm:ssZ', '2000-01-01T00:00:00Z'),
+                                         ('YYYY-MM-DD', '2000-01-01')):
+            cfg = {'granularity': granularity, 'earliestDatestamp': datestamp,
+                   'records': [dict(r, datestamp=r['datestamp'][:len(datestamp)]) for r in records]}
+            repo = Repository( cfg=cfg )
+            for num in range(1, 11):
+                identifiers = []
+                for args in date_partitions('oai_dc', '2000-01-01', '2000-01-10', num, granularity):
+                    identifiers += [r.identifier for r in repo.select_records(**args)]
+                self.assertEqual( sorted(identifiers), sorted([r['identifier'] for r in records]) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import json
+import os.path
+import shutil
+import tempfile
+try:
+    import unittest.mock as mock
+except:
+    import mock
+from flask import Flask
+
+from oaipmh_simulator.envelope import response_date
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.prerender import canonical_query, query_filename, prerender, fork_context, URLMAP
+from oaipmh_simulator.repository import Repository
+from tests.test_repository import CFG1
+
+class TestPrerender(unittest.TestCase):
+
+    def setUp(self):
+        # Same responseDate in responses that are compared
+        patcher = mock.patch.object(response_date, 'clock', lambda: 1234567890)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config['base_url'] = 'http://example.org/oai'
+        self.app.config['page_size'] = 1
+        self.app.config['repo'] = Repository( cfg=CFG1 )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def urlmap(self):
+        with open(os.path.join(self.tmpdir, URLMAP), 'r') as fh:
+            return( json.load(fh) )
+
+    def test01_canonical_query(self):
+        self.assertEqual( canonical_query({'verb': 'GetRecord', 'identifier': 'a b', 'metadataPrefix': 'oai_dc'}),
+                          'identifier=a+b&metadataPrefix=oai_dc&verb=GetRecord' )
+        self.assertTrue( query_filename('verb=Identify').startswith('Identify') )
+        self.assertTrue( query_filename('verb=Identify').endswith('.xml') )
+
+    def test02_prerender(self):
+        (rendered, unchanged) = prerender(self.app, self.tmpdir, processes=2)
+        # Identify, ListMetadataFormats x4, ListSets, GetRecord x4,
+        # List* x2 for oai_dc with 5 set options and xxx with 5
+        self.assertEqual( (rendered, unchanged), (10 + 20, 0) )
+        urlmap = self.urlmap()
+        self.assertTrue( 'verb=Identify' in urlmap )
+        self.assertTrue( 'verb=ListSets' in urlmap )
+        args = {'verb': 'GetRecord', 'identifier': 'item2', 'metadataPrefix': 'oai_dc'}
+        with open(os.path.join(self.tmpdir, urlmap[canonical_query(args)]), 'rb') as fh:
+            data = fh.read()
+        with self.app.app_context():
+            self.assertEqual( data, OAI_PMH_Handler(self.app).handle(args).get_data() )
+        # Three pages of ListRecords with page_size 1
+        pages = [q for q in urlmap if 'verb=ListRecords' in q and
+                 ('oai_dc' in q or 'resumptionToken' in q)]
+        self.assertTrue( 'metadataPrefix=oai_dc&verb=ListRecords' in pages )
+        with open(os.path.join(self.tmpdir, urlmap['metadataPrefix=oai_dc&verb=ListRecords']), 'rb') as fh:
+            data = fh.read()
+        self.assertTrue( b'<identifier>item1</identifier>' in data )
+        self.assertTrue( b'<resumptionToken' in data )
+        tokens = [q for q in urlmap if q.startswith('resumptionToken=') and q.endswith('verb=ListRecords')]
+        # 2 more for oai_dc, 1 more for oai_dc in set a
+        self.assertEqual( len(tokens), 3 )
+        # Tokens in static files do not expire or keep a generation
+        self.assertFalse( b'expirationDate' in data )
+        self.assertFalse( any(['generation' in q for q in tokens]) )
+        self.assertFalse( 'token_lifetime' in self.app.config )
+
+    def test03_incremental(self):
+        prerender(self.app, self.tmpdir, processes=1)
+        self.assertEqual( prerender(self.app, self.tmpdir, processes=1), (0, 30) )
+        # Change item2, affects its GetRecord and the oai_dc lists that
+        # include it (all, a, a:b, a:b:c) for both verbs
+        self.app.config['repo'].add_records([
+            { "identifier": "item2",
+              "datestamp": "2002-02-03",
+              "metadataPrefix": "oai_dc",
+              "metadata": "<md>item2_oai_dc changed</md>" }])
+        self.assertEqual( prerender(self.app, self.tmpdir, processes=1), (9, 21) )
+        urlmap = self.urlmap()
+        args = {'verb': 'GetRecord', 'identifier': 'item2', 'metadataPrefix': 'oai_dc'}
+        with open(os.path.join(self.tmpdir, urlmap[canonical_query(args)]), 'rb') as fh:
+            self.assertTrue( b'changed' in fh.read() )
+        # Files in the output match the urlmap
+        files = set()
+        for (dirpath, dirnames, filenames) in os.walk(self.tmpdir):
+            for f in filenames:
+                if (f.endswith('.xml')):
+                    files.add(os.path.relpath(os.path.join(dirpath, f), self.tmpdir))
+        self.assertEqual( files, set(urlmap.values()) )
+
+    def test04_fork_context(self):
+        fork = fork_context()
+        if (fork is not None):
+            self.assertTrue( hasattr(fork, 'Pool') )
+        with mock.patch('oaipmh_simulator.prerender.multiprocessing') as mp:
+            mp.get_all_start_methods.return_value = ['spawn']
+            self.assertEqual( fork_context(), None )
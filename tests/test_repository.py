@@ -1,6 +1,15 @@
 import unittest
 import datetime
-from oaipmh_simulator.repository import Repository, Item, Record, Datestamp, OAI_PMH_Exception, BadArgument, BadVerb, BadResumptionToken, IdDoesNotExist, NoMetadataFormats, CannotDisseminateFormat, NoRecordsMatch, NoSetHierarchy
+import json
+import os.path
+import shutil
+import tempfile
+try:
+    import unittest.mock as mock
+except:
+    import mock
+from oaipmh_simulator.blob_store import BlobStore
+from oaipmh_simulator.repository import load_repositories, load_shard, Repository, MemoryItems, Item, Record, Datestamp, OAI_PMH_Exception, BadArgument, BadVerb, BadResumptionToken, IdDoesNotExist, NoMetadataFormats, CannotDisseminateFormat, NoRecordsMatch, NoSetHierarchy
 
 # Some test data
 CFG1 = {
@@ -100,6 +109,172 @@ class TestRepository(unittest.TestCase):
         ss = repo.set_specs()
         self.assertEqual( ss, ['a','a:b','a:b:c','d'] )
 
+    def test06_shared_blob_store(self):
+        bs = BlobStore()
+        cfg2 = json.loads(json.dumps(CFG1)) #deep copy
+        cfg2['sets'] = { 'a': { 'name': 'set-a', 'description': '<d>a</d>' } }
+        cfg3 = json.loads(json.dumps(cfg2))
+        r2 = Repository( cfg=cfg2, blob_store=bs )
+        r3 = Repository( cfg=cfg3, blob_store=bs )
+        self.assertTrue( r2.select_record('item1','oai_dc').metadata is
+                         r3.select_record('item1','oai_dc').metadata )
+        self.assertTrue( r2.sets['a']['name'] is r3.sets['a']['name'] )
+        self.assertEqual( r3.set_name_description('a'), ('set-a', '<d>a</d>') )
+        self.assertEqual( len(bs), 4 )
+
+    def test07_load_repositories(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ('r1', 'r2'):
+                with open(os.path.join(tmpdir, name + '.json'), 'w') as fh:
+                    json.dump(CFG1, fh)
+            with open(os.path.join(tmpdir, 'ignored.txt'), 'w') as fh:
+                fh.write('not a repository')
+            repos = load_repositories(tmpdir)
+            self.assertEqual( sorted(repos.keys()), ['r1','r2'] )
+            self.assertTrue( repos['r1'].blob_store is repos['r2'].blob_store )
+            self.assertTrue( repos['r1'].select_record('item2','oai_dc').metadata is
+                             repos['r2'].select_record('item2','oai_dc').metadata )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test08_validate(self):
+        repo = Repository( cfg=CFG1 )
+        self.assertEqual( repo.validate(processes=1), [] )
+        repo.sets = { 'a': { 'name': 'A', 'description': '<unclosed>' } }
+        repo.select_record('item1','xxx').metadata = repo.blob_store.add('<x:md>unbound prefix</x:md>')
+        bad = repo.validate(processes=1)
+        self.assertEqual( [l for (l, e) in bad],
+                          ['record item1 xxx metadata', 'set a description'] )
+
+    def test09_shards(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shard1 = { "repositoryName": "shard1",
+                       "earliestDatestamp": "1999-01-01",
+                       "sets": { "a": { "name": "A1" } },
+                       "records": CFG1['records'][:2] }
+            shard2 = { "repositoryName": "shard2",
+                       "sets": { "a": { "name": "A2" }, "d": { "name": "D" } },
+                       "records": CFG1['records'][2:] + [
+                           { "identifier": "item1",
+                             "datestamp": "2005-05-05",
+                             "metadataPrefix": "oai_dc",
+                             "metadata": "<md>item1_oai_dc_v2</md>",
+                             "sets": [ "ignored" ] } ] }
+            for (name, shard) in (('s1', shard1), ('s2', shard2)):
+                with open(os.path.join(tmpdir, name + '.json'), 'w') as fh:
+                    json.dump(shard, fh)
+            for processes in (1, 2):
+                repo = Repository( shards=os.path.join(tmpdir, 's*.json'),
+                                   processes=processes )
+                self.assertEqual( repo.repository_name, 'shard1' )
+                self.assertEqual( repo.set_name_description('a'), ('A1', None) )
+                self.assertEqual( repo.set_name_description('d'), ('D', None) )
+                self.assertEqual( len(repo.items), 3 )
+                # later shard wins for record, first appearance for sets
+                r = repo.select_record('item1', 'oai_dc')
+                self.assertEqual( r.metadata, '<md>item1_oai_dc_v2</md>' )
+                self.assertEqual( r.set_specs, ['a'] )
+                self.assertEqual( repo.select_record('item1', 'xxx').datestamp, '2001-01-02' )
+                self.assertEqual( repo.set_specs(), ['a','a:b','a:b:c','d'] )
+                self.assertEqual( len(repo.select_records(metadataPrefix='oai_dc')), 3 )
+            # Shards are passed back from workers as rows of plain values
+            (settings, rows) = load_shard(os.path.join(tmpdir, 's1.json'))
+            self.assertEqual( settings['repositoryName'], 'shard1' )
+            self.assertEqual( rows[0][:6], ('item1', ('a',), 'oai_dc', '2001-01-01', 'days',
+                                            datetime.datetime(2001, 1, 1)) )
+            self.assertEqual( rows[0][-1], BlobStore.key('<md>item1_oai_dc</md>') )
+            self.assertEqual( rows[1][1], () )
+            self.assertEqual( repo.select_record('item2', 'oai_dc').ds.datetime,
+                              datetime.datetime(2002, 2, 2) )
+            # cfg settings take precedence
+            repo = Repository( cfg={ "repositoryName": "cfg" },
+                               shards=[os.path.join(tmpdir, 's2.json')] )
+            self.assertEqual( repo.repository_name, 'cfg' )
+            self.assertEqual( len(repo.items), 3 )
+            # no shards is an error, not an empty repository
+            self.assertRaises( ValueError, Repository, shards=os.path.join(tmpdir, 'x*.json') )
+            self.assertRaises( ValueError, Repository, shards=[] )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test10_generations(self):
+        repo = Repository( cfg=CFG1 )
+        storage = repo.storage
+        g = repo.current_generation()
+        self.assertTrue( repo.pin_generation(g, 60) is not None )
+        repo.add_records([
+            { "identifier": "item2", "datestamp": "2004-04-04",
+              "metadataPrefix": "oai_dc", "metadata": "<md>new</md>" },
+            { "identifier": "item4", "datestamp": "2004-04-04",
+              "metadataPrefix": "oai_dc", "metadata": "<md>item4</md>" } ])
+        self.assertEqual( repo.current_generation(), g + 1 )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc')]
+        self.assertEqual( ids, ['item1','item3','item2','item4'] )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc', generation=g)]
+        self.assertEqual( ids, ['item1','item2','item3'] )
+        self.assertEqual( storage.get_item('item2', g).records['oai_dc'].metadata, '<md>item2_oai_dc</md>' )
+        self.assertEqual( len(repo.items), 4 )
+        self.assertEqual( len(MemoryItems(storage, g)), 3 )
+        self.assertFalse( 'item4' in MemoryItems(storage, g) )
+        # Unchanged items are shared, changed ones copied
+        self.assertTrue( storage.get_item('item1', g) is storage.get_item('item1') )
+        self.assertFalse( storage.get_item('item2', g) is storage.get_item('item2') )
+        self.assertEqual( storage.get_item('item2').set_specs(), ['a','a:b','a:b:c'] )
+        # Old versions are collected once the lease expires
+        self.assertEqual( len(storage.versions['item2']), 2 )
+        storage.leases[g] = 0
+        storage.gc()
+        self.assertFalse( repo.has_generation(g) )
+        self.assertTrue( repo.has_generation(g + 1) )
+        self.assertEqual( repo.pin_generation(g, 60), None )
+        (current, expires) = repo.pin_current_generation(60)
+        self.assertEqual( current, g + 1 )
+        self.assertTrue( g + 1 in storage.leases and expires is not None )
+        self.assertEqual( len(storage.versions['item2']), 1 )
+        self.assertEqual( storage.get_item('item2').records['oai_dc'].metadata, '<md>new</md>' )
+
+    def test11_datestamp_index(self):
+        repo = Repository( cfg=CFG1 )
+        storage = repo.storage
+        self.assertEqual( [k[1] for k in storage.index['oai_dc']], ['item1','item2','item3'] )
+        # Updates add keys, the old ones are stale and skipped
+        for day in range(1, 6):
+            repo.add_records([{ "identifier": "item1", "datestamp": "2010-01-0%d" % (day),
+                                "metadataPrefix": "oai_dc", "metadata": "<md>%d</md>" % (day) }])
+        ids = [(r.identifier, r.datestamp) for r in repo.select_records(metadataPrefix='oai_dc')]
+        self.assertEqual( ids, [('item2','2002-02-02'), ('item3','2003-03-03'), ('item1','2010-01-05')] )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc', limit=1,
+                                                         **{'from': '2003-01-01', 'until': '2010-01-02'})]
+        self.assertEqual( ids, ['item3'] )
+        # Index rebuilt once more than half the keys are stale
+        self.assertEqual( len(storage.index['oai_dc']), 3 )
+        self.assertEqual( storage.stale_keys, 0 )
+        # Index is not changed in place by adding a record before the last
+        keys = storage.index['oai_dc']
+        repo.add_records([{ "identifier": "item0", "datestamp": "2000-01-01",
+                            "metadataPrefix": "oai_dc", "metadata": "<md>0</md>" }])
+        self.assertEqual( len(keys), 3 )
+        self.assertEqual( [k[1] for k in storage.index['oai_dc']], ['item0','item2','item3','item1'] )
+
+    def test12_validate_compressed(self):
+        blob_store = BlobStore(compress=True)
+        cfg = dict(CFG1)
+        cfg['records'] = CFG1['records'] + [
+            { "identifier": "item4", "datestamp": "2004-04-04", "metadataPrefix": "oai_dc",
+              "metadata": "<md>unclosed" },
+            { "identifier": "item5", "datestamp": "2005-05-05", "metadataPrefix": "oai_dc",
+              "metadata": "<md>unclosed" } ]
+        repo = Repository( cfg=cfg, blob_store=blob_store )
+        # Blobs are checked by their stored keys, without using the hot cache
+        with mock.patch.object(BlobStore, 'key') as key:
+            bad = repo.validate(processes=1)
+            self.assertEqual( key.call_count, 0 )
+        self.assertEqual( blob_store.cache.misses, 0 )
+        self.assertEqual( [l for (l, e) in bad],
+                          ['record item4 oai_dc metadata', 'record item5 oai_dc metadata'] )
+
     def test10_item_init(self):
         i = Item('item1')
 
@@ -0,0 +1,68 @@
+import sys
+import unittest
+from oaipmh_simulator.repository import Repository
+from oaipmh_simulator.scaling_report import generate_cfg, fit_line, measure, format_report
+from tests.test_repository import CFG1
+
+# Retained memory is measured with tracemalloc, python 3.4 on
+TRACEMALLOC = (sys.version_info >= (3, 4))
+
+class TestScalingReport(unittest.TestCase):
+
+    def test01_generate_cfg(self):
+        cfg = generate_cfg(10, formats=['oai_dc','xxx'], num_sets=3)
+        self.assertEqual( len(cfg['records']), 20 )
+        repo = Repository( cfg=cfg )
+        self.assertEqual( len(repo.items), 10 )
+        self.assertEqual( repo.metadata_formats(), ['oai_dc','xxx'] )
+        self.assertEqual( repo.set_specs(), ['set0','set1','set2'] )
+        # from template
+        cfg = generate_cfg(5, template=CFG1)
+        self.assertEqual( cfg['repositoryName'], 'myname' )
+        self.assertEqual( cfg['records'][0]['metadata'], '<md>item1_oai_dc</md>' )
+        self.assertEqual( cfg['records'][3]['metadata'], '<md>item1_oai_dc</md>' )
+
+    def test02_fit_line(self):
+        self.assertEqual( fit_line([1,2,3], [5,7,9]), (3.0, 2.0) )
+        self.assertEqual( fit_line([2,2], [1,3]), (2.0, 0.0) )
+
+    def test03_measure(self):
+        row = measure(generate_cfg(50))
+        self.assertEqual( row['items'], 50 )
+        self.assertEqual( row['records'], 50 )
+        if (TRACEMALLOC):
+            self.assertTrue( row['retained_bytes'] > 0 )
+        else:
+            self.assertEqual( row['retained_bytes'], None )
+        self.assertTrue( row['peak_rss'] > 0 )
+        text = format_report({'import_time': 0.1, 'rows': [row, row],
+                              'fits': {'construct_time': (0.0, 1e-5),
+                                       'peak_rss': (1e7, 1000.0),
+                                       'retained_bytes': (0.0, 800.0)}})
+        self.assertTrue( 'Import time: 0.100s' in text )
+        self.assertTrue( '10.0us' in text )
+        row = dict(row, retained_bytes=None)
+        text = format_report({'import_time': 0.1, 'rows': [row],
+                              'fits': {'construct_time': (0.0, 1e-5),
+                                       'peak_rss': (1e7, 1000.0),
+                                       'retained_bytes': None}})
+        self.assertTrue( 'retained           n/a' in text )
+
+    @unittest.skipUnless(TRACEMALLOC, 'tracemalloc not available')
+    def test04_measure_compressed(self):
+        words = ' '.join(['word%d' % (n % 50) for n in range(500)])
+        cfg = generate_cfg(200)
+        for r in cfg['records']:
+            r['metadata'] = '<md:md xmlns:md="http://example.org/md"><md:text>%s %s</md:text></md:md>' % (r['identifier'], words)
+        plain = measure(cfg)
+        compressed = measure(cfg, compress=True)
+        self.assertEqual( compressed['records'], 200 )
+        self.assertTrue( plain['retained_bytes'] > 2 * compressed['retained_bytes'] )
+
+    def test05_measure_fails(self):
+        cfg = generate_cfg(5)
+        cfg['records'][0]['datestamp'] = 'bad'
+        self.assertRaises( RuntimeError, measure, cfg )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import re
+import unittest
+from flask import Flask
+
+from oaipmh_simulator.envelope import response_date
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.repository import Repository
+from oaipmh_simulator.scenario import SimulatedClock, EventScheduler, Scenario, ScenarioRunner, runner_from_cfg, epoch_seconds
+from tests.test_repository import CFG1
+
+SCENARIO = { "start": "2020-01-01T00:00:00Z",
+             "speedup": 3600,
+             "seed": 1,
+             "sets": ["set1", "set2"],
+             "perHour": {"new": 100, "updated": 20, "deleted": 5} }
+
+class FakeClock(object):
+    def __init__(self):
+        self.t = 1000.0
+    def __call__(self):
+        return( self.t )
+
+class TestScenario(unittest.TestCase):
+
+    def test01_clock(self):
+        fake = FakeClock()
+        clock = SimulatedClock(start=0, speedup=60, clock=fake)
+        self.assertEqual( clock.now(), 0 )
+        fake.t += 2.5
+        self.assertEqual( clock.now(), 150 )
+        self.assertEqual( SimulatedClock(clock=fake).now(), fake.t )
+
+    def test02_scheduler(self):
+        s = EventScheduler()
+        for (when, event) in ((3, 'c'), (1, 'a'), (2, 'b1'), (2, 'b2')):
+            s.schedule(when, event)
+        self.assertEqual( s.next_time(), 1 )
+        self.assertEqual( s.pop_due(2), [(1, 'a'), (2, 'b1'), (2, 'b2')] )
+        self.assertEqual( len(s), 1 )
+        self.assertEqual( s.pop_due(2), [] )
+        # Recurring event
+        every = lambda when, event: when + 10
+        self.assertEqual( s.pop_due(25, every), [(3, 'c'), (13, 'c'), (23, 'c')] )
+        self.assertEqual( (len(s), s.next_time()), (1, 33) )
+        s.pop_due(100)
+        self.assertEqual( s.next_time(), None )
+
+    def test03_events(self):
+        scenario = Scenario(SCENARIO)
+        start = epoch_seconds("2020-01-01T00:00:00Z")
+        self.assertEqual( scenario.start, start )
+        records = scenario.events(start + 10 * 3600)
+        counts = {}
+        for r in records:
+            kind = 'deleted' if r.get('status') == 'deleted' else 'new' if 'sets' in r else 'updated'
+            counts[kind] = counts.get(kind, 0) + 1
+        # Roughly the rates given
+        self.assertTrue( 800 < counts['new'] < 1200 )
+        self.assertTrue( 120 < counts['updated'] < 280 )
+        self.assertTrue( 20 < counts['deleted'] < 80 )
+        # In time order, in the scenario period
+        datestamps = [r['datestamp'] for r in records]
+        self.assertEqual( datestamps, sorted(datestamps) )
+        self.assertEqual( (datestamps[0], datestamps[-1]), ('2020-01-01', '2020-01-01') )
+        # Nothing deleted twice or changed after deletion
+        deleted = set()
+        for r in records:
+            self.assertFalse( r['identifier'] in deleted )
+            if (r.get('status') == 'deleted'):
+                deleted.add(r['identifier'])
+        self.assertEqual( len(scenario.live), counts['new'] - counts['deleted'] )
+        # Same events from same seed
+        self.assertEqual( Scenario(SCENARIO).events(start + 10 * 3600), records )
+        self.assertEqual( scenario.events(start + 10 * 3600), [] )
+
+    def test04_runner(self):
+        repo = Repository( cfg=dict(CFG1, granularity='YYYY-MM-DDThh:mm:ssZ') )
+        fake = FakeClock()
+        runner = ScenarioRunner(repo, Scenario(SCENARIO, repo), SimulatedClock(
+            epoch_seconds("2020-01-01T00:00:00Z"), speedup=3600, clock=fake))
+        self.assertEqual( runner.scenario.datestamp_format, '%Y-%m-%dT%H:%M:%SZ' )
+        self.assertEqual( runner.step(), 0 )
+        generation = repo.generation
+        fake.t += 24.0 # one simulated day
+        n = runner.step()
+        self.assertTrue( n > 2000 )
+        self.assertEqual( (runner.events, runner.batches), (n, 1) )
+        self.assertEqual( repo.generation, generation + 1 )
+        # Harvest of the new day sees the growth, in datestamp order
+        records = repo.select_records(metadataPrefix='oai_dc', **{'from': '2020-01-01T00:00:00Z'})
+        self.assertTrue( len(records) > 2000 )
+        datestamps = [r.datestamp for r in records]
+        self.assertEqual( datestamps, sorted(datestamps) )
+        self.assertTrue( datestamps[-1] < '2020-01-02T00:00:01Z' )
+        self.assertEqual( len(repo.select_records(metadataPrefix='oai_dc', set='set2',
+                                                  **{'from': '2020-01-01T00:00:00Z'})),
+                          len([r for r in records if 'set2' in r.set_specs]) )
+
+    def test05_runner_thread(self):
+        repo = Repository( cfg=CFG1 )
+        runner = runner_from_cfg(repo, dict(SCENARIO, speedup=360000, interval=0.01))
+        runner.start()
+        try:
+            while (runner.batches < 2):
+                runner.stopping.wait(0.01)
+        finally:
+            runner.stop()
+        self.assertFalse( runner.thread.is_alive() )
+        self.assertTrue( len(repo.items) > len(CFG1['records']) )
+
+    def test06_incremental_harvest(self):
+        repo = Repository( cfg=dict(CFG1, granularity='YYYY-MM-DDThh:mm:ssZ') )
+        start = epoch_seconds("2020-01-01T00:00:00Z")
+        fake = FakeClock()
+        runner = ScenarioRunner(repo, Scenario(SCENARIO, repo),
+                                SimulatedClock(start, speedup=3600, clock=fake), interval=3600)
+        # Same events from the same seed, to see what each batch changed
+        twin = Scenario(SCENARIO, repo)
+        app = Flask(__name__)
+        app.config['base_url'] = 'http://example.org/oai'
+        app.config['page_size'] = 10000
+        app.config['repo'] = repo
+        def harvest(**args):
+            args.update({'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'})
+            with app.app_context():
+                data = OAI_PMH_Handler(app).handle(args).get_data().decode('utf-8')
+            return( (re.search(r'<responseDate>([^<]+)<', data).group(1),
+                     set(re.findall(r'<identifier>([^<]+)<', data))) )
+        clock = response_date.clock
+        runner.start()
+        try:
+            self.assertEqual( harvest()[0], '2020-01-01T00:00:00Z' )
+            fake.t += 1.25 # 1h15m
+            runner.step()
+            (date1, identifiers) = harvest()
+            self.assertEqual( date1, '2020-01-01T01:15:00Z' )
+            batch1 = set([r['identifier'] for r in twin.events(start + 4500)])
+            self.assertTrue( batch1 < identifiers )
+            fake.t += 1.5
+            runner.step()
+            fake.t += 0.7 # not yet applied
+            (date2, identifiers) = harvest(**{'from': date1})
+            self.assertEqual( date2, '2020-01-01T02:45:00Z' )
+            batch2 = set([r['identifier'] for r in twin.events(start + 9900)])
+            self.assertEqual( identifiers, batch2 )
+            self.assertTrue( len(batch2) > 100 )
+        finally:
+            runner.stop()
+        self.assertTrue( response_date.clock is clock )
@@ -0,0 +1,92 @@
+import sys
+import unittest
+try:
+    import unittest.mock as mock
+except:
+    import mock
+from flask import Flask
+
+from oaipmh_simulator.envelope import response_date
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.repository import Repository
+from oaipmh_simulator.serializer import SubElement, StdlibSerializer, LxmlSerializer, available_serializers, get_serializer, benchmark, format_benchmark
+from tests.test_repository import CFG1
+
+REQUESTS = [ {'verb': 'Identify'},
+             {'verb': 'ListSets'},
+             {'verb': 'ListMetadataFormats'},
+             {'verb': 'ListMetadataFormats', 'identifier': 'item1'},
+             {'verb': 'GetRecord', 'identifier': 'item1', 'metadataPrefix': 'oai_dc'},
+             {'verb': 'GetRecord', 'identifier': 'item3', 'metadataPrefix': 'oai_dc'},
+             {'verb': 'GetRecord', 'identifier': 'a\tb\rc<>&"', 'metadataPrefix': 'oai_dc'},
+             {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'},
+             {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'},
+             {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': 'a'},
+             {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': 'zz'},
+             {'verb': 'Bad'} ]
+
+class TestSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['base_url'] = 'http://example.org/oai'
+        self.app.config['repo'] = Repository( cfg=CFG1 )
+        # Same responseDate in responses that are compared
+        patcher = mock.patch.object(response_date, 'clock', lambda: 1234567890)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self, serializer, args, page_size):
+        self.app.config['serializer'] = serializer
+        self.app.config['page_size'] = page_size
+        with self.app.app_context():
+            return( OAI_PMH_Handler(self.app).handle(args).get_data() )
+
+    def test01_get_serializer(self):
+        self.assertEqual( get_serializer('stdlib').name, 'stdlib' )
+        self.assertRaises( ValueError, get_serializer, 'xyz' )
+        self.assertTrue( 'stdlib' in available_serializers() )
+        self.assertEqual( get_serializer().name, 'stdlib' )
+
+    def test02_stdlib(self):
+        s = StdlibSerializer()
+        root = s.Element('a', {'xmlns': 'http://example.org/', 'x': '1\t2'})
+        SubElement( root, 'b' ).text = 'x < y'
+        SubElement( root, 'c' )
+        # ElementTree sorts attributes before python 3.8, and python2
+        # does not escape a tab in an attribute value
+        if (sys.version_info >= (3, 8)):
+            start = '<a xmlns="http://example.org/" x="1&#09;2">'
+        elif (sys.version_info >= (3, 0)):
+            start = '<a x="1&#09;2" xmlns="http://example.org/">'
+        else:
+            start = '<a x="1\t2" xmlns="http://example.org/">'
+        self.assertEqual( s.serialize(root),
+                          "<?xml version='1.0' encoding='utf-8'?>\n" +
+                          start + '<b>x &lt; y</b><c /></a>' )
+
+    @unittest.skipUnless('lxml' in available_serializers(), 'lxml not installed')
+    def test03_lxml_identical(self):
+        s = LxmlSerializer()
+        root = s.Element('a', {'xmlns': 'http://example.org/', 'xmlns:p': 'http://example.org/p',
+                               'p:y': 'z', 'x': '1\t2'})
+        SubElement( root, 'b' ).text = 'x < y'
+        SubElement( root, 'c' )
+        self.assertEqual( s.serialize(root),
+                          "<?xml version='1.0' encoding='utf-8'?>\n"
+                          '<a xmlns="http://example.org/" xmlns:p="http://example.org/p" p:y="z" x="1&#09;2">'
+                          '<b>x &lt; y</b><c /></a>' )
+        # Carriage return in text falls back to stdlib
+        SubElement( root, 'd' ).text = 'x\ry'
+        self.assertTrue( '<d>x\ry</d>' in s.serialize(root) )
+        for page_size in (1, 2, 100):
+            for args in REQUESTS:
+                self.assertEqual( self.render('lxml', args, page_size),
+                                  self.render('stdlib', args, page_size) )
+
+    def test04_benchmark(self):
+        rows = benchmark(page_sizes=[2], num_items=5, repeat=1)
+        self.assertEqual( len(rows), 5 * len(available_serializers()) )
+        self.assertTrue( all([row['identical'] for row in rows]) )
+        self.assertEqual( rows[0]['serializer'], 'stdlib' )
+        self.assertTrue( 'ListRecords' in format_benchmark(rows) )
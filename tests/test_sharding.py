@@ -0,0 +1,125 @@
+import unittest
+try:
+    import unittest.mock as mock
+except:
+    import mock
+import re
+from flask import Flask
+
+from oaipmh_simulator.envelope import response_date
+from oaipmh_simulator.flask_app import OAI_PMH_Handler
+from oaipmh_simulator.repository import Repository, BadArgument, NoRecordsMatch
+from oaipmh_simulator.scaling_report import generate_cfg
+from oaipmh_simulator.sharding import HashRing, shard_nodes, shard_cfg, record_json, record_from_json, ShardedRepository, start_local_shards
+from tests.test_repository import CFG1
+
+class TestSharding(unittest.TestCase):
+
+    def test01_hash_ring(self):
+        ring = HashRing(shard_nodes(4))
+        ids = ['oai:example.org:item%d' % n for n in range(4000)]
+        nodes = [ring.node(i) for i in ids]
+        self.assertEqual( nodes, [HashRing(shard_nodes(4)).node(i) for i in ids] )
+        for node in shard_nodes(4):
+            self.assertTrue( 600 < nodes.count(node) < 1400 )
+        # Adding a node only moves items to it
+        ring5 = HashRing(shard_nodes(5))
+        for (i, node) in zip(ids, nodes):
+            self.assertTrue( ring5.node(i) in (node, 'shard4') )
+
+    def test02_shard_cfg(self):
+        cfg = generate_cfg(50)
+        shards = [shard_cfg(cfg, n, 3) for n in range(3)]
+        self.assertEqual( shards[0]['repositoryName'], 'scaling-test' )
+        records = sorted([r['identifier'] for s in shards for r in s['records']])
+        self.assertEqual( records, sorted([r['identifier'] for r in cfg['records']]) )
+
+    def test03_record_json(self):
+        repo = Repository( cfg=CFG1 )
+        r = record_from_json(record_json(repo.select_record('item2', 'oai_dc')))
+        self.assertEqual( r.identifier, 'item2' )
+        self.assertEqual( r.set_specs, ['a','a:b','a:b:c'] )
+        self.assertEqual( r.metadata, '<md>item2_oai_dc</md>' )
+
+
+class TestShardedRepository(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cfg = generate_cfg(60, formats=['oai_dc','xxx'], num_sets=4)
+        cfg['records'].append( {"identifier": "oai:example.org:deleted", "datestamp": "2001-02-03",
+                                "metadataPrefix": "oai_dc", "status": "deleted", "sets": ["set1"]} )
+        (cls.processes, cls.shard_urls) = start_local_shards(cfg, 3)
+        cls.single = Flask(__name__)
+        cls.router = Flask(__name__)
+        for (app, repo) in ((cls.single, Repository( cfg=cfg )),
+                            (cls.router, ShardedRepository( cls.shard_urls ))):
+            app.config['base_url'] = 'http://example.org/oai'
+            app.config['page_size'] = 7
+            app.config['repo'] = repo
+
+    @classmethod
+    def tearDownClass(cls):
+        for p in cls.processes:
+            p.terminate()
+            p.join()
+
+    def setUp(self):
+        # Same responseDate in responses that are compared
+        patcher = mock.patch.object(response_date, 'clock', lambda: 1234567890)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def response(self, app, args):
+        with app.app_context():
+            return( OAI_PMH_Handler(app).handle(args).get_data() )
+
+    def harvest(self, app, args):
+        """Identifiers from following resumptionTokens, without the tokens."""
+        identifiers = []
+        while (True):
+            data = self.response(app, args).decode('utf-8')
+            identifiers += re.findall(r'<identifier>([^<]+)</identifier>', data)
+            m = re.search(r'>([^<]+)</resumptionToken>', data)
+            if (not m):
+                return( identifiers )
+            args = {'verb': args['verb'], 'resumptionToken': m.group(1).replace('&amp;', '&')}
+
+    def test01_same_responses(self):
+        for args in [ {'verb': 'Identify'},
+                      {'verb': 'ListSets'},
+                      {'verb': 'ListMetadataFormats'},
+                      {'verb': 'ListMetadataFormats', 'identifier': 'oai:example.org:item7'},
+                      {'verb': 'ListMetadataFormats', 'identifier': 'oai:example.org:nope'},
+                      {'verb': 'GetRecord', 'identifier': 'oai:example.org:item3', 'metadataPrefix': 'xxx'},
+                      {'verb': 'GetRecord', 'identifier': 'oai:example.org:deleted', 'metadataPrefix': 'oai_dc'},
+                      {'verb': 'GetRecord', 'identifier': 'oai:example.org:item3', 'metadataPrefix': 'yyy'},
+                      {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': 'set2',
+                       'from': '2005-01-01', 'until': '2012-01-01'},
+                      {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'set': 'nope'},
+                      {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc',
+                       'from': '2005-01-01', 'until': '2001-01-01'},
+                      {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'from': 'bad'},
+                      {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'until': '2001-13-01'} ]:
+            self.assertEqual( self.response(self.router, args), self.response(self.single, args) )
+        # badArgument from a shard does not echo the request
+        data = self.response(self.router, {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'from': 'bad'})
+        self.assertTrue( b'<request>http://example.org/oai</request><error code="badArgument">' in data )
+
+    def test02_merged_lists(self):
+        for args in [ {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'},
+                      {'verb': 'ListIdentifiers', 'metadataPrefix': 'xxx', 'set': 'set1'},
+                      {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'from': '2010-01-01'} ]:
+            expected = self.harvest(self.single, args)
+            self.assertTrue( len(expected) > 7 )
+            self.assertEqual( self.harvest(self.router, args), expected )
+        # Unlimited selection is fetched in chunks
+        repo = self.router.config['repo']
+        repo.chunk_size = 5
+        self.assertEqual( repo.executor._max_workers, 30 )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc')]
+        self.assertEqual( ids, [r.identifier for r in self.single.config['repo'].select_records(metadataPrefix='oai_dc')] )
+        self.assertEqual( len(ids), 61 )
+        # Exceptions from shards have the class for their error code
+        self.assertRaises( NoRecordsMatch, repo.select_records, metadataPrefix='oai_dc', until='1900-01-01' )
+        self.assertRaises( BadArgument, repo.select_records, metadataPrefix='oai_dc', until='bad' )
@@ -0,0 +1,51 @@
+import unittest
+import threading
+import time
+from oaipmh_simulator.single_flight import SingleFlight
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test01_single_call(self):
+        sf = SingleFlight()
+        self.assertEqual( sf.do('k', lambda: 42), 42 )
+        self.assertEqual( sf.do('k', lambda: 43), 43 ) # not a cache
+        self.assertEqual( (sf.leaders, sf.coalesced), (2, 0) )
+        self.assertEqual( sf.calls, {} )
+
+    def test02_concurrent_calls(self):
+        sf = SingleFlight()
+        release = threading.Event()
+        calls = []
+        def slow():
+            calls.append(1)
+            release.wait()
+            return( b'response' )
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(sf.do('k', slow)))
+                   for n in range(10)]
+        for t in threads:
+            t.start()
+        while (sf.leaders + sf.coalesced < 10):
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual( len(calls), 1 )
+        self.assertEqual( results, [b'response'] * 10 )
+        self.assertEqual( (sf.leaders, sf.coalesced), (1, 9) )
+
+    def test03_different_keys(self):
+        sf = SingleFlight()
+        self.assertEqual( sf.do('a', lambda: 1), 1 )
+        self.assertEqual( sf.do('b', lambda: 2), 2 )
+        self.assertEqual( sf.leaders, 2 )
+
+    def test04_exception(self):
+        sf = SingleFlight()
+        def bad():
+            raise ValueError('oops')
+        self.assertRaises( ValueError, sf.do, 'k', bad )
+        self.assertEqual( sf.calls, {} )
+
+if __name__ == '__main__':
+    unittest.main()
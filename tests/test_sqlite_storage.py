@@ -0,0 +1,93 @@
+import unittest
+import datetime
+import json
+import os.path
+import shutil
+import tempfile
+from oaipmh_simulator.repository import Repository, IdDoesNotExist, CannotDisseminateFormat, NoSetHierarchy
+from oaipmh_simulator.sqlite_storage import SQLiteStorage
+from tests.test_repository import CFG1
+
+class TestSQLiteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, 'repo.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test01_empty(self):
+        repo = Repository( storage=SQLiteStorage(self.db) )
+        self.assertEqual( repo.repository_name, None )
+        self.assertEqual( len(repo.items), 0 )
+        self.assertEqual( repo.metadata_formats(), [] )
+        self.assertRaises( NoSetHierarchy, repo.set_specs )
+
+    def test02_import_and_select(self):
+        repo = Repository( cfg=CFG1, storage=SQLiteStorage(self.db, batch_size=2) )
+        self.assertEqual( len(repo.items), 3 )
+        self.assertTrue( 'item2' in repo.items )
+        self.assertEqual( sorted(repo.items), ['item1','item2','item3'] )
+        self.assertEqual( repo.metadata_formats(), ['oai_dc','xxx'] )
+        self.assertEqual( repo.set_specs(), ['a','a:b','a:b:c','d'] )
+        item = repo.select_item('item1')
+        self.assertEqual( item.metadata_formats(), ['oai_dc','xxx'] )
+        # sets from first appearance even though in a different batch
+        self.assertEqual( item.set_specs(), ['a'] )
+        r = repo.select_record('item2', 'oai_dc')
+        self.assertEqual( r.metadata, '<md>item2_oai_dc</md>' )
+        self.assertEqual( r.set_specs, ['a','a:b','a:b:c'] )
+        self.assertRaises( IdDoesNotExist, repo.select_record, 'x', 'oai_dc' )
+        self.assertRaises( CannotDisseminateFormat, repo.select_record, 'item1', 'y' )
+        self.assertEqual( repo.select_record('item3', 'oai_dc').status, 'deleted' )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc')]
+        self.assertEqual( ids, ['item1','item2','item3'] )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc', set='a')]
+        self.assertEqual( ids, ['item1','item2'] )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc', **{'from': '2002-01-01'})]
+        self.assertEqual( ids, ['item2','item3'] )
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc', until='2002-02-02')]
+        self.assertEqual( ids, ['item1','item2'] )
+        # paging
+        after = (datetime.datetime(2001, 1, 1), 'item1')
+        ids = [r.identifier for r in repo.select_records(metadataPrefix='oai_dc', after=after, limit=1)]
+        self.assertEqual( ids, ['item2'] )
+        self.assertEqual( repo.validate(processes=1), [] )
+
+    def test03_reopen(self):
+        Repository( cfg=CFG1, storage=SQLiteStorage(self.db) )
+        repo = Repository( storage=SQLiteStorage(self.db) )
+        self.assertEqual( repo.repository_name, 'myname' )
+        self.assertEqual( repo.earliest_datestamp, '1999-01-01' )
+        self.assertEqual( len(repo.items), 3 )
+        # later records replace earlier, dedup of metadata in blobs
+        repo.add_records([{ "identifier": "item1", "datestamp": "2009-09-09",
+                            "metadataPrefix": "oai_dc", "metadata": "<md>item2_oai_dc</md>",
+                            "sets": [ "zzz" ] }])
+        r = repo.select_record('item1', 'oai_dc')
+        self.assertEqual( r.datestamp, '2009-09-09' )
+        self.assertEqual( r.set_specs, ['a'] )
+        conn = repo.storage.conn
+        self.assertEqual( conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0], 3 )
+        self.assertEqual( repo.set_specs(), ['a','a:b','a:b:c','d'] )
+
+    def test04_shards(self):
+        for (n, records) in enumerate((CFG1['records'][:2], CFG1['records'][2:])):
+            with open(os.path.join(self.tmpdir, 's%d.json' % n), 'w') as fh:
+                json.dump({ "repositoryName": "shard%d" % n, "records": records }, fh)
+        repo = Repository( shards=os.path.join(self.tmpdir, 's*.json'),
+                           storage=SQLiteStorage(self.db) )
+        self.assertEqual( repo.repository_name, 'shard0' )
+        self.assertEqual( len(repo.items), 3 )
+
+    def test05_query_plan(self):
+        storage = SQLiteStorage(self.db)
+        plan = ' '.join([row[-1] for row in storage.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT identifier FROM records WHERE metadataPrefix = ? "
+            "AND ds >= ? ORDER BY ds, identifier", ('oai_dc', '2000'))])
+        self.assertTrue( 'records_prefix_ds' in plan )
+        self.assertFalse( 'TEMP B-TREE' in plan )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import os.path
+import shutil
+import tempfile
+try:
+    import unittest.mock as mock
+except:
+    import mock
+import oaipmh_simulator.validate
+from oaipmh_simulator.blob_store import BlobStore
+from oaipmh_simulator.validate import check_fragment, validate_fragments, ValidationCache
+
+GOOD = '<a xmlns:x="http://example.org/x"><x:b>ok</x:b></a>'
+BAD1 = '<a><b>not closed</a>'
+BAD2 = '<x:a>unbound prefix</x:a>'
+BOMB = '<!DOCTYPE a [<!ENTITY e "eeee">]><a>&e;</a>'
+
+class TestValidate(unittest.TestCase):
+
+    def test01_check_fragment(self):
+        self.assertEqual( check_fragment(GOOD), None )
+        self.assertTrue( 'ParseError' in check_fragment(BAD1) )
+        self.assertTrue( 'ParseError' in check_fragment(BAD2) )
+        self.assertTrue( 'EntitiesForbidden' in check_fragment(BOMB) )
+
+    def test02_validate_fragments(self):
+        cache = ValidationCache()
+        errors = validate_fragments( [GOOD, BAD1, GOOD], processes=1, cache=cache )
+        self.assertEqual( list(errors.keys()), [BlobStore.key(BAD1)] )
+        self.assertEqual( len(cache.results), 2 )
+        # cached results are not checked again
+        with mock.patch('oaipmh_simulator.validate.check_fragment') as cf:
+            errors = validate_fragments( [GOOD, BAD1], processes=1, cache=cache )
+            self.assertFalse( cf.called )
+        self.assertEqual( len(errors), 1 )
+
+    def test03_validate_fragments_pool(self):
+        fragments = ['<a>%d</a>' % n for n in range(20)] + [BAD2]
+        with mock.patch.object(oaipmh_simulator.validate, 'PARALLEL_THRESHOLD', 10):
+            errors = validate_fragments( fragments, processes=2 )
+        self.assertEqual( list(errors.keys()), [BlobStore.key(BAD2)] )
+
+    def test04_cache_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'cache.json')
+            cache = ValidationCache(filename)
+            validate_fragments( [GOOD, BAD1], cache=cache )
+            cache.save()
+            cache = ValidationCache(filename)
+            self.assertTrue( BlobStore.key(GOOD) in cache )
+            self.assertEqual( cache[BlobStore.key(GOOD)], None )
+            self.assertTrue( 'ParseError' in cache[BlobStore.key(BAD1)] )
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()